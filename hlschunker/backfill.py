@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+import os, sys, time, logging
+import asyncio
+from datetime import datetime, timedelta
+
+# local
+from index import HLSSegment, HLSPullDiscontinuity
+from yaml_storage import YAMLReader, YAMLWriter
+import metrics
+
+# Backfill of complete (VOD, archive) playlists: segments are downloaded with wide parallelism and
+# stored out of order, segments lists (and chunks) are written in order once all downloads are done.
+# Completed downloads are journaled to state file in feed directory, so interrupted backfill resumes
+# with the remaining segments.
+
+logger = logging.getLogger(__name__)
+
+backfill_segments = metrics.Counter('hlschunker_backfill_segments_total', 'Segments stored by backfill',
+                                    ['feed', 'result'])
+backfill_bytes = metrics.Counter('hlschunker_backfill_bytes_total', 'Bytes downloaded by backfill', ['feed'])
+
+
+class BackfillState:
+    """Journal of backfill: header (playlist url, first sequence, segment count, start datetime)
+    followed by [sequence, size] of every stored segment"""
+    filename = '.backfill.yaml'
+    def __init__(self, root):
+        self.writer = YAMLWriter(self.filename, root=root)
+        self.header = None
+        self.done = {}      # sequence -> size
+    def load(self):
+        self.header = None
+        self.done = {}
+        try:
+            with open(self.writer.full_path, 'r') as f:
+                for line in f:
+                    item = YAMLReader.parse_line(line)
+                    if type(item) is dict:
+                        self.header = item
+                    elif type(item) is list:
+                        self.done[item[0]] = item[1]
+        except FileNotFoundError:
+            pass
+        return self
+    def matches(self, url, sequence, count):
+        return self.header is not None and self.header.get('url') == url and \
+               self.header.get('sequence') == sequence and self.header.get('count') == count
+    def start(self, url, sequence, count, start):
+        self.writer.close()
+        self.writer.mode = 'w'
+        self.writer.write(dict(url=url, sequence=sequence, count=count, datetime=start))
+        self.writer.close()
+        self.writer.mode = 'a'
+        self.header = dict(url=url, sequence=sequence, count=count, datetime=start)
+        self.done = {}
+    def write(self, sequence, size):
+        self.writer.write([sequence, size])
+        self.done[sequence] = size
+    def remove(self):
+        self.writer.close()
+        try:
+            os.remove(self.writer.full_path)
+        except FileNotFoundError:
+            pass
+
+
+class Backfill:
+    """Stores complete playlist with storage (YAMLSegmentsStorage); start: datetime of first segment
+    of playlists without EXT-X-PROGRAM-DATE-TIME (default: playlist ends at time of first attempt)"""
+    progress_interval = 10      # seconds between progress reports
+
+    def __init__(self, storage, parallel_downloads=32, start=None, loop=None, feed=None):
+        self.storage = storage
+        self.parallel_downloads = parallel_downloads
+        self.start = YAMLReader.parse_datetime(start) if type(start) is str else start
+        self.loop = loop
+        self.feed = feed
+        self.state = BackfillState(storage.root)
+        self.total = 0
+        self.completed = 0
+        self.failed = 0
+        self.bytes = 0
+        self.started = None
+        self.last_report = 0
+
+    async def __call__(self, url, segments):
+        """Store all items of segments (SegmentsList of complete playlist), consumed as by live storing"""
+        items = []
+        while segments:
+            items.append(segments.popleft())
+        media = [item for item in items if type(item) is HLSSegment]
+        if not media:
+            for item in items:
+                self.storage.list.write(item)
+            return
+        first = self.storage.sequence
+        state = self.state.load()
+        if not state.matches(url, first, len(media)):
+            start = media[0].datetime or self.start or \
+                    datetime.utcnow() - timedelta(seconds=sum(item.duration for item in media))
+            state.start(url, first, len(media), start)
+        elif state.done:
+            logger.info('Stream %s: resuming backfill of %s, %i of %i segments stored'
+                        % (self.feed, url, len(state.done), len(media)))
+        start = YAMLReader.parse_datetime(state.header['datetime']) if type(state.header['datetime']) is str \
+                else state.header['datetime']
+        for i, item in enumerate(media):
+            item.sequence = first + i
+            if item.datetime is None:
+                item.datetime = start
+                start += timedelta(seconds=item.duration)
+        self.storage.sequence = first + len(media)
+
+        pending = [item for item in media if item.sequence not in state.done]
+        self.total = len(pending)
+        self.completed = self.failed = self.bytes = 0
+        self.started = self.last_report = time.time()
+        semaphore = asyncio.Semaphore(self.parallel_downloads)
+        async def download(item):
+            async with semaphore:
+                if self.storage.stop:
+                    return
+                stored = await self.storage.download_segment(item)
+                if stored:
+                    size = os.path.getsize(os.path.join(self.storage.root, self.storage.formatter.path(item)))
+                    state.write(item.sequence, size)
+                    self.completed += 1
+                    self.bytes += size
+                    backfill_segments.labels(feed=self.feed, result='done').inc()
+                    backfill_bytes.labels(feed=self.feed).inc(size)
+                elif stored is False:
+                    self.failed += 1
+                    backfill_segments.labels(feed=self.feed, result='failed').inc()
+                if time.time() - self.last_report >= self.progress_interval:
+                    self.report()
+        await asyncio.gather(*(download(item) for item in pending))
+        self.report()
+        if self.storage.stop:
+            logger.info('Stream %s: backfill interrupted, %i segments left' % (self.feed, self.total - self.completed))
+            return
+
+        # segments lists in order, failed segments are replaced by discontinuity
+        for item in items:
+            if type(item) is HLSSegment:
+                if item.sequence in state.done:
+                    self.storage.list.write(item)
+                elif self.storage.list.last_item is not HLSPullDiscontinuity:
+                    self.storage.list.write(HLSPullDiscontinuity)
+            else:
+                self.storage.list.write(item)
+        state.remove()
+
+    @property
+    def progress(self):
+        elapsed = time.time() - self.started
+        done = self.completed + self.failed
+        rate = self.bytes / elapsed if elapsed > 0 else 0
+        eta = elapsed / done * (self.total - done) if done else None
+        return dict(done=done, total=self.total, failed=self.failed, bytes=self.bytes, bytes_per_second=rate,
+                    elapsed=elapsed, eta=eta)
+
+    def report(self):
+        self.last_report = time.time()
+        progress = self.progress
+        print('Stream %s: backfill %i/%i segments (%.1f%%), %i failed, %.1f MB at %.1f MB/s, ETA %s'
+              % (self.feed, progress['done'], progress['total'],
+                 progress['done'] * 100 / progress['total'] if progress['total'] else 100, progress['failed'],
+                 progress['bytes'] / 1e6, progress['bytes_per_second'] / 1e6,
+                 timedelta(seconds=int(progress['eta'])) if progress['eta'] is not None else '-'))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import os, sys, time, tempfile, shutil
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# local
+from fixtures import synthetic_ts
+from report import environment, write_report
+import mpegts
+
+# Audio extraction throughput: synthetic segments are extracted by pools of 1..N worker processes
+# (as the storage stage does), reported as MB/s of input in total and per worker (core).
+
+
+def extract_segments(paths, workers, format, repeat):
+    with ProcessPoolExecutor(workers) as executor:
+        # warm up workers
+        list(executor.map(mpegts.extract_audio_file, paths[:workers], [path + '.out' for path in paths[:workers]],
+                          [format] * workers))
+        jobs = paths * repeat
+        start = time.perf_counter()
+        results = list(executor.map(mpegts.extract_audio_file, jobs, ['%s.%i.out' % (path, i) for i, path in enumerate(jobs)],
+                                    [format] * len(jobs)))
+        elapsed = time.perf_counter() - start
+    size = sum(result[0] for result in results)
+    written = sum(result[1] for result in results)
+    return dict(workers=workers, segments=len(jobs), seconds=elapsed, mb_per_s=size / elapsed / 1e6,
+                mb_per_s_per_core=size / elapsed / 1e6 / workers, output_ratio=written / size)
+
+def run(segment_size=2000000, audio_ratio=0.1, segments=8, repeat=4, max_workers=None, format='ts'):
+    workdir = tempfile.mkdtemp(prefix='hlschunker-extract-')
+    try:
+        paths = []
+        for i in range(segments):
+            path = os.path.join(workdir, 'segment-%i.ts' % i)
+            with open(path, 'wb') as f:
+                f.write(synthetic_ts(segment_size, audio_ratio))
+            paths.append(path)
+        results = []
+        max_workers = max_workers or os.cpu_count() or 1
+        for workers in sorted({2**i for i in range(max_workers.bit_length()) if 2**i <= max_workers} | {max_workers}):
+            results.append(extract_segments(paths, workers, format, repeat))
+            print('%2i worker(s): %8.1f MB/s, %8.1f MB/s per core' % (workers, results[-1]['mb_per_s'],
+                  results[-1]['mb_per_s_per_core']), file=sys.stderr)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return dict(benchmark='extract', environment=environment(),
+                params=dict(segment_size=segment_size, audio_ratio=audio_ratio, segments=segments, repeat=repeat,
+                            format=format),
+                results=results)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Audio extraction throughput benchmark', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--segment-size', type=int, default=2000000, help='segment size in bytes')
+    parser.add_argument('--audio-ratio', type=float, default=0.1, help='fraction of audio packets in segments')
+    parser.add_argument('--segments', type=int, default=8, help='number of distinct segments')
+    parser.add_argument('--repeat', type=int, default=4, help='times each segment is extracted')
+    parser.add_argument('--max-workers', type=int, help='max worker processes (default: CPU count)')
+    parser.add_argument('--format', type=str, default='ts', choices=sorted(mpegts.extensions), help='output format')
+    parser.add_argument('--output', '-o', type=str, default='-', help='JSON report file')
+
+    args = parser.parse_args()
+
+    write_report(run(args.segment_size, args.audio_ratio, args.segments, args.repeat, args.max_workers, args.format),
+                 args.output)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import os, sys, struct
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# local
+from mpegts import crc32_mpeg2
+
+# Synthetic data for benchmarks: MPEG-TS segments with one video and one audio stream,
+# and HLS media playlists of arbitrary length.
+
+TS_PACKET_SIZE = 188
+PAT_PID = 0x0000
+PMT_PID = 0x1000
+VIDEO_PID = 0x0100
+AUDIO_PID = 0x0101
+
+
+def psi_packet(pid, table_id, table_id_ext, body, continuity=0):
+    section_length = 5 + len(body) + 4
+    section = struct.pack('>BHHBBB', table_id, 0xb000 | section_length, table_id_ext, 0xc1, 0, 0) + body
+    section += struct.pack('>I', crc32_mpeg2(section))
+    payload = b'\x00' + section     # pointer field
+    header = struct.pack('>BHB', 0x47, 0x4000 | pid, 0x10 | (continuity & 0x0f))
+    return header + payload + b'\xff' * (TS_PACKET_SIZE - 4 - len(payload))
+
+def pat_packet(continuity=0):
+    return psi_packet(PAT_PID, 0x00, 1, struct.pack('>HH', 1, 0xe000 | PMT_PID), continuity)
+
+def pmt_packet(continuity=0):
+    body = struct.pack('>HH', 0xe000 | VIDEO_PID, 0xf000)     # PCR PID, no program info
+    body += struct.pack('>BHH', 0x1b, 0xe000 | VIDEO_PID, 0xf000)     # H.264
+    body += struct.pack('>BHH', 0x0f, 0xe000 | AUDIO_PID, 0xf000)     # AAC ADTS
+    return psi_packet(PMT_PID, 0x02, 1, body, continuity)
+
+def pes_packets(pid, stream_id, payload, continuity, pcr=None):
+    """Split PES packet into TS packets, last packet padded with adaptation field stuffing"""
+    pes = b'\x00\x00\x01' + bytes([stream_id]) + struct.pack('>H', 0 if stream_id == 0xe0 else len(payload) + 3) \
+          + b'\x80\x00\x00' + payload
+    packets = []
+    first = True
+    while pes:
+        adaptation = b''
+        if first and pcr is not None:
+            base = pcr & 0x1ffffffff
+            adaptation = b'\x10' + struct.pack('>IH', base >> 1, ((base & 1) << 15) | 0x7e00)
+        room = TS_PACKET_SIZE - 4 - (len(adaptation) + 1 if adaptation else 0)
+        if len(pes) < room:
+            # stuffing
+            stuffing = room - len(pes)
+            if adaptation:
+                adaptation += b'\xff' * stuffing
+            elif stuffing == 1:
+                adaptation = None       # adaptation field length byte only
+            else:
+                adaptation = b'\x00' + b'\xff' * (stuffing - 2)
+        chunk, pes = pes[:room], pes[room:]
+        if adaptation is None:
+            control, field = 0x30, b'\x00'
+        elif adaptation:
+            control, field = 0x30, bytes([len(adaptation)]) + adaptation
+        else:
+            control, field = 0x10, b''
+        header = struct.pack('>BHB', 0x47, (0x4000 if first else 0) | pid, control | (continuity & 0x0f))
+        packet = header + field + chunk
+        assert len(packet) == TS_PACKET_SIZE, len(packet)
+        packets.append(packet)
+        continuity += 1
+        first = False
+    return packets, continuity
+
+def adts_frame(size=256):
+    """ADTS header (AAC LC, 48 kHz, stereo) followed by dummy data"""
+    length = size
+    header = bytes([0xff, 0xf1, 0x4c, 0x80 | (length >> 11), (length >> 3) & 0xff, ((length & 7) << 5) | 0x1f, 0xfc])
+    return header + bytes(size - 7)
+
+def synthetic_ts(size, audio_ratio=0.1, video_pes_size=15000, audio_frames_per_pes=4):
+    """Generate MPEG-TS data of about given size in bytes; audio_ratio: fraction of audio packets"""
+    packets = [pat_packet(), pmt_packet()]
+    cc = dict(video=0, audio=0)
+    audio_bytes = 0
+    video_bytes = 0
+    pcr = 0
+    total = size // TS_PACKET_SIZE
+    while len(packets) < total:
+        if audio_bytes <= audio_ratio * (audio_bytes + video_bytes):
+            payload = b''.join(adts_frame() for i in range(audio_frames_per_pes))
+            new, cc['audio'] = pes_packets(AUDIO_PID, 0xc0, payload, cc['audio'])
+            audio_bytes += len(new) * TS_PACKET_SIZE
+        else:
+            pcr += 3600
+            new, cc['video'] = pes_packets(VIDEO_PID, 0xe0, os.urandom(16) * (video_pes_size // 16), cc['video'], pcr)
+            video_bytes += len(new) * TS_PACKET_SIZE
+        packets.extend(new)
+    return b''.join(packets[:total])
+
+def media_playlist(segments, target_duration=6, sequence=0, start=None, complete=False,
+                   discontinuity_every=0, url_template='segment-{n}.ts'):
+    """Generate HLS media playlist text with given number of segments"""
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:%i' % target_duration,
+             '#EXT-X-MEDIA-SEQUENCE:%i' % sequence]
+    if start is not None:
+        lines.append('#EXT-X-PROGRAM-DATE-TIME:%s' % start.strftime('%Y-%m-%dT%H:%M:%S.000+00:00'))
+    for n in range(sequence, sequence + segments):
+        if discontinuity_every and n and n % discontinuity_every == 0:
+            lines.append('#EXT-X-DISCONTINUITY')
+        lines.append('#EXTINF:%.3f,' % target_duration)
+        lines.append(url_template.format(n=n))
+    if complete:
+        lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 3:
+        print('usage: %s [output.ts] [size in bytes]' % sys.argv[0])
+        sys.exit(0)
+
+    with open(sys.argv[1], 'wb') as f:
+        f.write(synthetic_ts(int(sys.argv[2])))
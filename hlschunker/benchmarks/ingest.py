@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import os, sys, time, shutil, tempfile, resource, asyncio, logging, calendar
+from multiprocessing import Process, Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# local
+from origin import run_origin, feed_names
+from report import environment, percentile, write_report
+from pull import HLSPull
+from storage import ChunkNotifier
+import metrics
+
+# End-to-end ingest benchmark: starts the synthetic origin with N live feeds and one HLSPull
+# process per feed (like chunker.py) storing into a temporary directory, and reports throughput,
+# CPU and memory per feed, refresh lag (segment published -> stored) and chunk close latency.
+
+logger = logging.getLogger(__name__)
+
+
+class RecordingNotifier(ChunkNotifier):
+    """Records chunk close latency (chunk end in stream time -> notification) instead of sending"""
+    def __init__(self, latencies):
+        super().__init__(None, metadata={})
+        self.latencies = latencies
+    def __call__(self, path, start=None, end=None, **kwargs):
+        self.latencies.append(time.time() - calendar.timegm(end.timetuple()))
+
+
+def rusage_cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def feed_worker(name, url, root, duration, kwargs, results):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    chunk_latencies = []
+    pull = HLSPull(url, root, chunk_notifier=RecordingNotifier(chunk_latencies), metadata=dict(id=name),
+                   loop=loop, **kwargs)
+    lags = []
+    done = pull.storage.list.done
+    def timed_done(item):
+        # segment is complete at origin when its duration has passed since publish epoch in url
+        lags.append(time.time() - (item.epoch + item.duration))
+        done(item)
+    pull.storage.list.done = timed_done
+    def stop():
+        pull.stop = True
+    loop.call_later(duration, stop)
+    cpu = rusage_cpu()
+    start = time.time()
+    error = None
+    try:
+        loop.run_until_complete(pull(True))
+    except Exception as e:
+        error = str(e)
+    elapsed = time.time() - start
+    dump = {data['name']: data for data in metrics.REGISTRY.dump()}
+    def total(name, **labels):
+        return sum(value for key, value in dump[name]['values']
+                   if all(dict(zip(dump[name]['labelnames'], key)).get(k) == v for k, v in labels.items()))
+    results.put(dict(feed=name, elapsed=elapsed, cpu=rusage_cpu() - cpu, error=error,
+                     max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                     segments=total('hlschunker_segments_total', result='done'),
+                     failed=total('hlschunker_segments_total', result='failed') +
+                            total('hlschunker_segments_total', result='expired'),
+                     bytes=total('hlschunker_segment_bytes_written_total'),
+                     refresh_lags=lags, chunk_close_latencies=chunk_latencies))
+
+def run(feeds=4, duration=60, port=6100, target_duration=2, segment_size=500000, window=10, latency=0.0,
+        jitter=0.0, error_rate=0.0, discontinuity_every=0, parallel_downloads=4, chunk_size=10, data_dir=None):
+    params = dict(locals())
+    root = data_dir or tempfile.mkdtemp(prefix='hlschunker-bench-')
+    origin = Process(target=run_origin, kwargs=dict(feeds=feeds, port=port, target_duration=target_duration,
+                                                     segment_size=segment_size, window=window, latency=latency,
+                                                     jitter=jitter, error_rate=error_rate,
+                                                     discontinuity_every=discontinuity_every))
+    origin.start()
+    time.sleep(1)   # let origin start listening
+    results = Queue()
+    kwargs = dict(parallel_downloads=parallel_downloads, chunk_size=chunk_size)
+    workers = [Process(target=feed_worker, args=(name, 'http://127.0.0.1:%i/%s/index.m3u8' % (port, name),
+                                                 os.path.join(root, name), duration, kwargs, results))
+               for name in feed_names(feeds)]
+    try:
+        for worker in workers:
+            worker.start()
+        per_feed = [results.get() for worker in workers]
+        for worker in workers:
+            worker.join()
+    finally:
+        origin.terminate()
+        origin.join()
+        if not data_dir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    elapsed = max(feed['elapsed'] for feed in per_feed)
+    lags = [lag for feed in per_feed for lag in feed.pop('refresh_lags')]
+    chunk_latencies = [latency for feed in per_feed for latency in feed.pop('chunk_close_latencies')]
+    return dict(benchmark='ingest', environment=environment(), params=params, per_feed=per_feed, results=dict(
+        segments_per_s=sum(feed['segments'] for feed in per_feed) / elapsed,
+        bytes_per_s=sum(feed['bytes'] for feed in per_feed) / elapsed,
+        failed_segments=sum(feed['failed'] for feed in per_feed),
+        cpu_per_feed=sum(feed['cpu'] / feed['elapsed'] for feed in per_feed) / len(per_feed),  # cores
+        max_rss_mb=max(feed['max_rss_kb'] for feed in per_feed) / 1024,
+        refresh_lag_p50=percentile(lags, 50), refresh_lag_p95=percentile(lags, 95),
+        refresh_lag_max=max(lags) if lags else None,
+        chunk_close_latency_p50=percentile(chunk_latencies, 50),
+        chunk_close_latency_p95=percentile(chunk_latencies, 95),
+        chunks=len(chunk_latencies),
+        errors=[feed['error'] for feed in per_feed if feed['error']]))
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='End-to-end HLS ingest throughput benchmark', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--feeds', '-n', type=int, default=4, help='number of live feeds')
+    parser.add_argument('--duration', type=float, default=60, help='benchmark duration in seconds')
+    parser.add_argument('--port', type=int, default=6100, help='port for synthetic origin')
+    parser.add_argument('--target-duration', type=int, default=2, help='segment duration in seconds')
+    parser.add_argument('--segment-size', type=int, default=500000, help='segment size in bytes')
+    parser.add_argument('--window', type=int, default=10, help='segments in live playlist (DVR window)')
+    parser.add_argument('--latency', type=float, default=0.0, help='origin response latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra origin latency up to seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of origin requests failing')
+    parser.add_argument('--discontinuity-every', type=int, default=0, help='EXT-X-DISCONTINUITY every that many segments')
+    parser.add_argument('--parallel-downloads', '-j', type=int, default=4, help='parallel downloads per feed')
+    parser.add_argument('--chunk-size', type=int, default=10, help='chunk size in seconds')
+    parser.add_argument('--data-dir', type=str, help='keep stored data in this directory (default: temporary)')
+    parser.add_argument('--output', '-o', type=str, default='-', help='JSON report file')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    write_report(run(args.feeds, args.duration, args.port, args.target_duration, args.segment_size, args.window,
+                     args.latency, args.jitter, args.error_rate, args.discontinuity_every, args.parallel_downloads,
+                     args.chunk_size, args.data_dir), args.output)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import os, sys, json, time, tempfile, shutil, tracemalloc, gc, contextlib
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# local
+from fixtures import media_playlist
+from report import environment, write_report
+from index import HLSIndex, HLSSegment
+from yaml_storage import YAMLWriter, YAMLReader, YAMLChunker
+from tail import tail_lines_backwards_yield
+
+# Microbenchmarks of hot functions in index.py, yaml_storage.py and tail.py on generated fixtures.
+# Each benchmark reports ops/s, peak memory allocated by a single operation and blocks still
+# allocated after it. Results can be saved as baseline and later runs compared against it:
+#   benchmarks/micro.py --save-baseline micro-baseline.json
+#   benchmarks/micro.py --compare micro-baseline.json
+
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'micro-baseline.json')
+start_datetime = datetime(2017, 1, 1)
+
+
+def playlist(size, sequence=0):
+    return media_playlist(size, 6, sequence, start_datetime + timedelta(seconds=6*sequence),
+                          url_template='http://origin/feed/segment-1-{n}.ts')
+
+def measure(op, setup=None, min_time=1.0, min_runs=3, max_wall_time=None):
+    """Run op(*setup()) repeatedly, only op is timed; returns ops/s and allocation statistics.
+    Stops after min_time of measured time or max_wall_time including setup (default 5*min_time)"""
+    elapsed = 0.0
+    runs = 0
+    deadline = time.perf_counter() + (max_wall_time or 5*min_time)
+    while runs < min_runs or (elapsed < min_time and time.perf_counter() < deadline):
+        args = setup() if setup else ()
+        gc.disable()
+        start = time.perf_counter()
+        op(*args)
+        elapsed += time.perf_counter() - start
+        gc.enable()
+        runs += 1
+    args = setup() if setup else ()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = op(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+    del result
+    return dict(ops_per_s=runs / elapsed, runs=runs, peak_alloc_bytes=peak, retained_blocks=retained)
+
+
+def benchmarks(sizes, workdir):
+    """Yield (name, op, setup) for all benchmarks"""
+    for size in sizes:
+        text = playlist(size)
+        shifted = playlist(size, 1)     # next refresh of live playlist: one segment added
+        yield 'HLSIndex.parse[%i]' % size, lambda text=text: HLSIndex.parse(text), None
+        yield ('SegmentsList.extend[%i]' % size, lambda left, right: left.extend(right),
+               lambda text=text, shifted=shifted: (HLSIndex.parse(text).segments, HLSIndex.parse(shifted).segments))
+        yield ('SegmentsList.extendleft[%i]' % size, lambda right, left: right.extendleft(left),
+               lambda text=text, shifted=shifted: (HLSIndex.parse(shifted).segments, HLSIndex.parse(text).segments))
+        yield ('SegmentsList.trimleft[%i]' % size, lambda segments, until: segments.trimleft(until),
+               lambda text=text: (lambda segments: (segments, segments[-2]))(HLSIndex.parse(text).segments))
+        yield ('SegmentsList.last_segment[%i]' % size, lambda segments: segments.last_segment,
+               lambda text=text: (HLSIndex.parse(text).segments,))
+        chunk_segments = [YAMLChunker.ChunkSegment(n, 6.0, start_datetime + timedelta(seconds=6*n),
+                                                   '2017-01-01/00/%i.ts' % n) for n in range(size)]
+        yield ('HLSIndex.segments_to_index[%i]' % size,
+               lambda segments=chunk_segments: HLSIndex.segments_to_index(segments, '', True), None)
+
+    writer = YAMLWriter('segments.yaml', root=workdir)
+    item = [1234, 5678, 6.0, start_datetime, '2017-01-01/00/1234.ts', 3735928559]
+    yield 'YAMLWriter.write', lambda: writer.write(item), None
+    writer.close()
+
+    line = '- [1234, 5678, 6.0, "2017-01-01 00:00:00", "2017-01-01/00/1234.ts", 3735928559]\n'
+    yield 'YAMLReader.parse_line', lambda: YAMLReader.parse_line(line), None
+    yield 'YAMLReader.parse_datetime', lambda: YAMLReader.parse_datetime('2017-01-01 00:00:00'), None
+    yield 'YAMLReader.parse_datetime[iso]', lambda: YAMLReader.parse_datetime('2017-01-01T00:00:00.000'), None
+
+    chunk_path = os.path.join(workdir, 'chunk.yaml')
+    with open(chunk_path, 'w') as f:
+        for n in range(60):
+            print('- [%i, 6.0, "%s", "2017-01-01/00/%i.ts"]'
+                  % (n, (start_datetime + timedelta(seconds=6*n)).strftime(YAMLWriter.datetime_format), n), file=f)
+    yield 'YAMLChunker.read_chunk_segments[60]', lambda: YAMLChunker.read_chunk_segments(chunk_path), None
+
+    list_path = os.path.join(workdir, 'long.yaml')
+    with open(list_path, 'w') as f:
+        for n in range(100000):
+            print('- %s' % line[2:].strip(), file=f)
+    def tail():
+        with open(list_path, 'rb') as f:
+            return list(tail_lines_backwards_yield(f, initial_lines=10, chunk_lines=10, max_lines=20, seek=-1))
+    yield 'tail_lines_backwards_yield[20]', tail, None
+
+
+def run(sizes=(1000, 10000, 50000), min_time=1.0, only=None):
+    workdir = tempfile.mkdtemp(prefix='hlschunker-micro-')
+    results = {}
+    try:
+        for name, op, setup in benchmarks(sizes, workdir):
+            if only and not any(pattern in name for pattern in only):
+                continue
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):    # progress prints of tested code
+                results[name] = measure(op, setup, min_time)
+            print('%-40s %12.1f ops/s %12i B peak %8i blocks retained'
+                  % (name, results[name]['ops_per_s'], results[name]['peak_alloc_bytes'],
+                     results[name]['retained_blocks']), file=sys.stderr)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return dict(benchmark='micro', environment=environment(), params=dict(sizes=list(sizes), min_time=min_time),
+                results=results)
+
+def compare(baseline, report, threshold=0.15):
+    """Print comparison of report against baseline, returns names of benchmarks slower than threshold"""
+    regressions = []
+    print('%-40s %14s %14s %8s %10s' % ('benchmark', 'baseline ops/s', 'ops/s', 'speedup', 'peak mem'))
+    for name, result in sorted(report['results'].items()):
+        base = baseline['results'].get(name)
+        if not base:
+            print('%-40s %14s %14.1f' % (name, '-', result['ops_per_s']))
+            continue
+        speedup = result['ops_per_s'] / base['ops_per_s']
+        memory = result['peak_alloc_bytes'] / base['peak_alloc_bytes'] if base['peak_alloc_bytes'] else 1.0
+        mark = ''
+        if speedup < 1 - threshold:
+            regressions.append(name)
+            mark = '  REGRESSION'
+        print('%-40s %14.1f %14.1f %7.2fx %9.2fx%s' % (name, base['ops_per_s'], result['ops_per_s'], speedup, memory, mark))
+    return regressions
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Microbenchmarks of index.py, yaml_storage.py and tail.py', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--sizes', type=str, default='1000,10000,50000', help='playlist sizes (segments)')
+    parser.add_argument('--min-time', type=float, default=1.0, help='minimum measured time per benchmark in seconds')
+    parser.add_argument('--only', type=str, action='append', help='run only benchmarks with names containing this')
+    parser.add_argument('--output', '-o', type=str, help='JSON report file')
+    parser.add_argument('--save-baseline', type=str, nargs='?', const=default_baseline, metavar='FILE',
+                        help='save results as baseline')
+    parser.add_argument('--compare', type=str, nargs='?', const=default_baseline, metavar='FILE',
+                        help='compare results with baseline, exit with error on regression')
+    parser.add_argument('--threshold', type=float, default=0.15, help='relative slowdown reported as regression')
+
+    args = parser.parse_args()
+
+    report = run([int(size) for size in args.sizes.split(',')], args.min_time, args.only)
+    if args.output:
+        write_report(report, args.output)
+    if args.save_baseline:
+        write_report(report, args.save_baseline)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, report, args.threshold):
+            sys.exit(1)
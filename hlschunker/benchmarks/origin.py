@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import os, sys, time, random, asyncio
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# must be installed
+from aiohttp import web
+
+# local
+from fixtures import synthetic_ts, media_playlist
+
+# Synthetic live HLS origin: serves N live feeds at /<feed>/index.m3u8. A new segment is
+# published every target duration; segment URLs embed the publish epoch (like BBC feeds),
+# so the ingest side can compute how late a segment was stored.
+
+
+class SyntheticFeed:
+    def __init__(self, name, target_duration=6, segment_size=500000, window=10, discontinuity_every=0,
+                 program_date_time=True, start=None):
+        self.name = name
+        self.target_duration = target_duration
+        self.segment_size = segment_size
+        self.window = window            # number of segments in live playlist (DVR window)
+        self.discontinuity_every = discontinuity_every
+        self.program_date_time = program_date_time
+        # pretend the stream has been running for a full window already
+        self.start = (start or time.time()) - window * target_duration
+    def last_sequence(self, now=None):
+        return int(((now or time.time()) - self.start) // self.target_duration) - 1
+    def epoch(self, n):
+        """Publish start time of segment n"""
+        return int(self.start + n * self.target_duration)
+    def playlist(self, now=None):
+        last = self.last_sequence(now)
+        first = max(0, last - self.window + 1)
+        start = datetime.utcfromtimestamp(self.epoch(first)) if self.program_date_time else None
+        playlist = media_playlist(last - first + 1, self.target_duration, first, start,
+                                  discontinuity_every=self.discontinuity_every,
+                                  url_template='segment-1-{n}.ts')
+        # replace sequence numbers in segment URLs by publish epoch
+        return '\n'.join(line if not line.startswith('segment-') else
+                         'segment-1-%i.ts' % self.epoch(int(line[len('segment-1-'):-3]))
+                         for line in playlist.split('\n'))
+
+
+class SyntheticOrigin:
+    def __init__(self, feeds, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.feeds = {feed.name: feed for feed in feeds}
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.bodies = {}
+        self.requests = 0
+    def body(self, size):
+        if size not in self.bodies:
+            self.bodies[size] = synthetic_ts(size)
+        return self.bodies[size]
+    async def delay(self):
+        self.requests += 1
+        delay = self.latency + random.random() * self.jitter
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            raise web.HTTPInternalServerError
+    async def playlist(self, request):
+        feed = self.feeds.get(request.match_info.get('feed'))
+        if feed is None:
+            raise web.HTTPNotFound
+        await self.delay()
+        content = feed.playlist().encode('utf8')
+        return web.Response(body=content, content_type='application/x-mpegURL')
+    async def segment(self, request):
+        feed = self.feeds.get(request.match_info.get('feed'))
+        if feed is None:
+            raise web.HTTPNotFound
+        await self.delay()
+        return web.Response(body=self.body(feed.segment_size), content_type='video/MP2T')
+    def app(self):
+        app = web.Application()
+        app.router.add_route('GET', '/{feed}/index.m3u8', self.playlist)
+        app.router.add_route('GET', '/{feed}/{segment:segment-.*\\.ts}', self.segment)
+        return app
+
+
+def feed_names(count):
+    return ['feed%03i' % i for i in range(count)]
+
+def run_origin(feeds=1, host='127.0.0.1', port=6100, target_duration=6, segment_size=500000, window=10,
+               latency=0.0, jitter=0.0, error_rate=0.0, discontinuity_every=0, program_date_time=True, start=None):
+    origin = SyntheticOrigin([SyntheticFeed(name, target_duration, segment_size, window, discontinuity_every,
+                                            program_date_time, start) for name in feed_names(feeds)],
+                             latency, jitter, error_rate)
+    web.run_app(origin.app(), host=host, port=port)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Synthetic live HLS origin', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--feeds', '-n', type=int, default=1, help='number of live feeds')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='host for HTTP server')
+    parser.add_argument('--port', type=int, default=6100, help='port for HTTP server')
+    parser.add_argument('--target-duration', type=int, default=6, help='segment duration in seconds')
+    parser.add_argument('--segment-size', type=int, default=500000, help='segment size in bytes')
+    parser.add_argument('--window', type=int, default=10, help='segments in live playlist (DVR window)')
+    parser.add_argument('--latency', type=float, default=0.0, help='response latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra latency up to seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with HTTP 500')
+    parser.add_argument('--discontinuity-every', type=int, default=0, help='EXT-X-DISCONTINUITY every that many segments')
+    parser.add_argument('--no-program-date-time', action='store_true', help='omit EXT-X-PROGRAM-DATE-TIME')
+
+    args = parser.parse_args()
+
+    print('Serving feeds: %s' % ', '.join('http://%s:%i/%s/index.m3u8' % (args.host, args.port, name)
+                                          for name in feed_names(args.feeds)))
+    run_origin(args.feeds, args.host, args.port, args.target_duration, args.segment_size, args.window,
+               args.latency, args.jitter, args.error_rate, args.discontinuity_every, not args.no_program_date_time)
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+import os, sys, json, time, platform, subprocess
+
+# Machine readable benchmark reports, so that results of different versions can be compared.
+
+
+def version():
+    """git description of the working tree, if available"""
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment():
+    return dict(version=version(), python=platform.python_version(), platform=platform.platform(),
+                cpus=os.cpu_count(), time=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values) * p / 100))]
+
+def write_report(report, path=None):
+    content = json.dumps(report, indent=2, sort_keys=True)
+    if path and path != '-':
+        with open(path, 'w') as f:
+            f.write(content + '\n')
+    else:
+        print(content)
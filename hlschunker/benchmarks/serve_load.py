@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import os, sys, time, shutil, tempfile, random, http.client, logging
+from datetime import datetime, timedelta
+from multiprocessing import Process, Queue
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# local
+from report import environment, percentile, write_report
+from yaml_storage import YAMLWriter
+from serve_chunks import serve_chunks
+
+# Chunk server load benchmark: generates stored feeds (chunk lists, chunk playlists, segments), starts
+# serve_chunks with 1..N worker processes and loads it with keep-alive HTTP clients requesting a mix
+# of chunk playlists, segments and catalog pages; reports requests/s, MB/s and latency per worker count.
+# Load generator runs on the same host: use --clients so that it is not the bottleneck.
+
+
+def generate(root, feeds, chunks, segments, segment_size, duration=2.0):
+    """Stored feeds as written by chunker; returns URL paths of playlists, segments and catalog pages"""
+    paths = dict(playlist=[], segment=[], catalog=[])
+    data = os.urandom(segment_size)
+    start = datetime(2020, 1, 1)
+    for f in range(feeds):
+        id = 'feed%i' % f
+        chunk_list = YAMLWriter('chunks.yaml', root=os.path.join(root, id))
+        sequence = 0
+        for c in range(chunks):
+            chunk_start = start + timedelta(seconds=c * segments * duration)
+            chunk_path = chunk_start.strftime('chunks/%Y-%m-%d/%H%M%S.yaml')
+            chunk = YAMLWriter(chunk_path, root=os.path.join(root, id))
+            chunk_list.write(['start', c, chunk_start, chunk_path])
+            for s in range(segments):
+                dt = chunk_start + timedelta(seconds=s * duration)
+                path = dt.strftime('%Y-%m-%d/%H/') + '%i.ts' % sequence
+                os.makedirs(os.path.join(root, id, os.path.dirname(path)), exist_ok=True)
+                with open(os.path.join(root, id, path), 'wb') as out:
+                    out.write(data)
+                chunk.write([sequence, duration, dt, path])
+                paths['segment'].append('/%s/%s' % (id, path))
+                sequence += 1
+            chunk.close()
+            chunk_list.write(['end', c, chunk_start + timedelta(seconds=segments * duration), chunk_path])
+            paths['playlist'].append('/%s/%s' % (id, chunk_path[:-len('.yaml')] + '.m3u8'))
+        chunk_list.close()
+        paths['catalog'].append('/%s/chunks?limit=50' % id)
+    return paths
+
+def client(host, port, paths, mix, duration, connections, results):
+    """Keep-alive connections in threads requesting random paths of mix (kind -> weight) for duration"""
+    kinds = [kind for kind, weight in sorted(mix.items()) for i in range(weight)]
+    per_thread = []
+    def load():
+        counts = dict(requests=0, bytes=0, errors=0)
+        latencies = []
+        per_thread.append((counts, latencies))
+        conn = http.client.HTTPConnection(host, port, timeout=30)
+        end = time.time() + duration
+        while time.time() < end:
+            path = random.choice(paths[random.choice(kinds)])
+            start = time.perf_counter()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                size = len(response.read())
+                if response.status != 200:
+                    counts['errors'] += 1
+                    continue
+            except (OSError, http.client.HTTPException):
+                counts['errors'] += 1
+                conn.close()
+                conn = http.client.HTTPConnection(host, port, timeout=30)
+                continue
+            latencies.append(time.perf_counter() - start)
+            counts['requests'] += 1
+            counts['bytes'] += size
+        conn.close()
+    threads = [Thread(target=load) for i in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(dict(requests=sum(counts['requests'] for counts, latencies in per_thread),
+                     bytes=sum(counts['bytes'] for counts, latencies in per_thread),
+                     errors=sum(counts['errors'] for counts, latencies in per_thread),
+                     latencies=[latency for counts, latencies in per_thread for latency in latencies]))
+
+def load(workers, root, paths, mix, port, clients, connections, duration):
+    server = Process(target=serve_chunks, kwargs=dict(data_dir=root, host='127.0.0.1', port=port, workers=workers,
+                                                           full_path=True))
+    server.start()
+    time.sleep(1 + 0.2 * workers)   # let workers start listening
+    try:
+        results = Queue()
+        processes = [Process(target=client, args=('127.0.0.1', port, paths, mix, duration, connections, results))
+                     for i in range(clients)]
+        for process in processes:
+            process.start()
+        per_client = [results.get() for process in processes]
+        for process in processes:
+            process.join()
+    finally:
+        server.terminate()
+        server.join()
+    latencies = [latency for result in per_client for latency in result['latencies']]
+    requests = sum(result['requests'] for result in per_client)
+    return dict(workers=workers, requests=requests, errors=sum(result['errors'] for result in per_client),
+                requests_per_s=requests / duration,
+                mb_per_s=sum(result['bytes'] for result in per_client) / duration / 1e6,
+                latency_p50=percentile(latencies, 50), latency_p99=percentile(latencies, 99))
+
+def run(max_workers=None, feeds=4, chunks=20, segments=30, segment_size=200000, clients=4, connections=8,
+        duration=10, port=6200, mix=None, data_dir=None):
+    mix = mix or dict(playlist=2, segment=7, catalog=1)
+    root = data_dir or tempfile.mkdtemp(prefix='hlschunker-serve-')
+    try:
+        paths = generate(root, feeds, chunks, segments, segment_size)
+        results = []
+        max_workers = max_workers or os.cpu_count() or 1
+        for workers in sorted({2**i for i in range(max_workers.bit_length()) if 2**i <= max_workers} | {max_workers}):
+            results.append(load(workers, root, paths, mix, port, clients, connections, duration))
+            print('%2i worker(s): %8.1f requests/s, %8.1f MB/s, p99 %.1f ms, %i errors'
+                  % (workers, results[-1]['requests_per_s'], results[-1]['mb_per_s'],
+                     (results[-1]['latency_p99'] or 0) * 1000, results[-1]['errors']), file=sys.stderr)
+    finally:
+        if not data_dir:
+            shutil.rmtree(root, ignore_errors=True)
+    return dict(benchmark='serve_load', environment=environment(),
+                params=dict(feeds=feeds, chunks=chunks, segments=segments, segment_size=segment_size,
+                            clients=clients, connections=connections, duration=duration, mix=mix),
+                results=results)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Chunk server throughput benchmark', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--max-workers', type=int, help='max serving worker processes (default: CPU count)')
+    parser.add_argument('--feeds', type=int, default=4, help='number of stored feeds')
+    parser.add_argument('--chunks', type=int, default=20, help='chunks per feed')
+    parser.add_argument('--segments', type=int, default=30, help='segments per chunk')
+    parser.add_argument('--segment-size', type=int, default=200000, help='segment size in bytes')
+    parser.add_argument('--clients', type=int, default=4, help='load generator processes')
+    parser.add_argument('--connections', type=int, default=8, help='keep-alive connections per client process')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load per worker count')
+    parser.add_argument('--port', type=int, default=6200, help='port for chunk server')
+    parser.add_argument('--data-dir', type=str, help='keep generated data in this directory (default: temporary)')
+    parser.add_argument('--output', '-o', type=str, default='-', help='JSON report file')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    write_report(run(args.max_workers, args.feeds, args.chunks, args.segments, args.segment_size, args.clients,
+                     args.connections, args.duration, args.port, data_dir=args.data_dir), args.output)
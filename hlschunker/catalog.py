@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import os, sys, json
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+# local
+from yaml_storage import YAMLReader, YAMLWriter, YAMLChunkList
+
+# Catalog of completed chunks of feed, maintained incrementally from chunks.yaml: only lines appended
+# since last update are parsed, the whole file is reloaded when it was replaced (trimmed by retention).
+# Chunk sequence numbers (of chunk list actions) are stable, so they serve as pagination cursors.
+
+Chunk = namedtuple('Chunk', 'sequence, start, end, path')
+
+
+class ChunkCatalog:
+    default_limit = 100
+    max_limit = 1000
+
+    def __init__(self, root):
+        self.path = os.path.join(root, YAMLChunkList.filename)
+        self.inode = None
+        self.position = 0
+        self.chunks = []        # completed chunks ordered by sequence
+        self.sequences = []     # sequences of chunks, for bisect
+        self.ends = []          # end datetimes of chunks, for bisect
+        self.started = None     # start action of chunk in progress
+
+    def reset(self, inode=None):
+        self.inode = inode
+        self.position = 0
+        self.chunks = []
+        self.sequences = []
+        self.ends = []
+        self.started = None
+
+    def update(self):
+        """Read chunk actions appended to chunks.yaml since last update"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.reset()
+            return
+        if stat.st_ino != self.inode or stat.st_size < self.position:
+            self.reset(stat.st_ino)
+        if stat.st_size == self.position:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self.position)
+            data = f.read(stat.st_size - self.position)
+        # incomplete last line is read on next update
+        end = data.rfind(b'\n') + 1
+        self.position += end
+        for line in data[:end].decode('utf8').splitlines():
+            item = YAMLReader.parse_line(line)
+            if type(item) is not list:
+                continue
+            action = YAMLChunkList.ChunkAction(*item)
+            if action.action == 'start':
+                self.started = action
+            elif action.action == 'end':
+                start = self.started.datetime if self.started and self.started.path == action.path else None
+                self.append(Chunk(action.sequence, YAMLReader.parse_datetime(start) if start else None,
+                                  YAMLReader.parse_datetime(action.datetime), action.path))
+                self.started = None
+
+    def append(self, chunk):
+        self.chunks.append(chunk)
+        self.sequences.append(chunk.sequence)
+        self.ends.append(chunk.end)
+
+    @staticmethod
+    def url(id, chunk):
+        return os.path.join(id, os.path.splitext(chunk.path)[0] + '.m3u8') if chunk else None
+
+    def item(self, id, i):
+        """Chunk i as dict similar to chunk notification"""
+        chunk = self.chunks[i]
+        return dict(sequence=chunk.sequence,
+                    start=chunk.start.strftime(YAMLWriter.datetime_format) if chunk.start else None,
+                    end=chunk.end.strftime(YAMLWriter.datetime_format),
+                    duration=(chunk.end - chunk.start).total_seconds() if chunk.start else None,
+                    chunk_relative_url=self.url(id, chunk),
+                    prev_chunk_relative_url=self.url(id, self.chunks[i-1]) if i > 0 else None,
+                    next_chunk_relative_url=self.url(id, self.chunks[i+1]) if i+1 < len(self.chunks) else None)
+
+    def latest(self, id):
+        self.update()
+        return self.item(id, len(self.chunks) - 1) if self.chunks else None
+
+    def query(self, id, start=None, end=None, limit=None, cursor=None):
+        """Chunks ending after start and ending not later than end (datetimes), at most limit chunks
+        from cursor (chunk sequence); returns chunks, previous and next page cursors"""
+        self.update()
+        limit = min(limit or self.default_limit, self.max_limit)
+        first = bisect_right(self.ends, start) if start else 0
+        last = bisect_right(self.ends, end) if end else len(self.chunks)
+        i = max(first, bisect_left(self.sequences, cursor)) if cursor is not None else first
+        j = min(i + limit, last)
+        chunks = [self.item(id, k) for k in range(i, j)]
+        prev_cursor = self.sequences[max(i - limit, first)] if i > first else None
+        next_cursor = self.sequences[j] if j < last else None
+        return chunks, prev_cursor, next_cursor
+
+
+if __name__ == "__main__":
+
+    # print catalog of feed directory
+    if len(sys.argv) == 1:
+        print('usage: %s [feed directory]' % sys.argv[0])
+        sys.exit(0)
+
+    catalog = ChunkCatalog(sys.argv[1])
+    chunks, prev_cursor, next_cursor = catalog.query(os.path.basename(os.path.normpath(sys.argv[1])),
+                                                     limit=ChunkCatalog.max_limit)
+    for chunk in chunks:
+        print(json.dumps(chunk, separators=(',', ':')))
@@ -1,16 +1,23 @@
 #!/usr/bin/env python3
 
-import os, sys, hashlib, logging
-from multiprocessing import Process
+import os, re, sys, time, signal, hashlib, logging
+import asyncio
+from collections import namedtuple, OrderedDict
+from multiprocessing import Process, Event
 from multiprocessing.sharedctypes import Value
 
 # must be installed
 import yaml
 
 # must be installed
-from serve_chunks import serve_chunks
-from pull import HLSPull, run_pull
-from storage import ChunkNotifier as ChunkNotifierBase
+from serve_chunks import serve_chunks, listen, make_admin_app, start_server, stop_server, feed_id_pattern
+from pull import HLSPull, run_pull, watch_stop, handover_stop
+from handover import HandoverServer, HandoverClient, wait_released, control_socket_name
+from storage import ChunkNotifier as ChunkNotifierBase, DownloadBudget, TokenBucket
+from retention import Retention
+from yaml_storage import YAMLChunker, YAMLWriter, ChunkPacker
+import metrics
+import tracing
 
 
 # config.yaml format:
@@ -28,26 +35,366 @@ from storage import ChunkNotifier as ChunkNotifierBase
 #   ...
 # - ...
 # chunk_metadata_endpoint: url
+# notify_manifest: <bool> (chunk notifications include segments with sizes, can be overridden per feed)
+# hedge_downloads: <bool or dict> (can be overridden per feed)
+# download_queue_size: <number> (can be overridden per feed)
+# variant: lowest|highest|audio or {select: bitrate, bitrate: <bits per second>} or {select: audio, language: <code>}
+#   (variant of master playlist, can be overridden per feed)
+# extract_audio: <bool> or {format: ts|adts, language: <code>, replace: <bool>, workers: <number>} (can be overridden per feed)
+# deduplicate: <bool> or {algorithm: <hashlib name>, dir: <path>} (content addressed segments, can be overridden per feed)
+# verify_existing: <bool> (existing segments kept only if MD5 ETag of origin matches, can be overridden per feed)
+# backfill: <bool> or {parallel_downloads: <number>, start: <datetime>} (complete playlists downloaded out of
+#   order with wide parallelism, resumable; can be overridden per feed)
+# pack_chunks: <bool> or {remove_segments: <bool>} (completed chunks packed to single file, can be overridden per feed)
+# retention: {max_age: <seconds>, max_bytes: <bytes>, min_free_bytes: <bytes>, interval: <seconds>,
+#   batch_size: <files>, batch_pause: <seconds>} (expired chunks deleted by feed process, can be overridden per feed)
+# reorder_buffer: {timeout: <seconds>, max_pending: <number>, overflow: cancel|wait} (can be overridden per feed)
+# download_budget:
+#   limit: <number>   (concurrent downloads of all feeds together)
+#   minimum: <number> (concurrent downloads always allowed for each feed)
+#   max_feeds: <number> (feeds running at once incl. ones added at runtime, default: active feeds + 16)
+# bandwidth_limit: <bytes per second> or {rate: <bytes per second>, burst: <bytes>} (per feed, can be overridden per feed)
+# total_bandwidth_limit: <bytes per second> or {rate: <bytes per second>, burst: <bytes>} (all feeds together)
+# warm_start: {stagger: <seconds>} (delay between initial playlist requests of feeds)
+# reload_interval: <seconds> (configuration file checked for changes, changed feeds restarted; 0: disabled)
+# control_socket: <path> (handover to new instance started with --handover, default: <data-dir>/.chunker.sock)
+# admin: <bool> or {host: <host>, port: <port>} (admin API /admin/feeds and /admin/budget on its own listener,
+#   default: 127.0.0.1, chunk server port + 1; never served on the chunk server socket)
+# serve: <bool> or {workers: <number>} (chunk server in this process or pre-forked worker processes;
+#   False: ingest only, chunks served separately by serve_chunks.py --workers <number>)
+# tracing: {sample_rate: <0..1>, format: jsonl|chrome, dir: <path>} (can be overridden per feed)
+# profiling: <bool> or {duration: <seconds>, dir: <path>} (SIGUSR1 to feed process, can be overridden per feed)
 
 logger = logging.getLogger(__name__)
 
+metrics_dirname = '.metrics'    # in data directory
+traces_dirname = '.traces'      # in data directory
+
 class ChunkNotifier(ChunkNotifierBase):
+    """manifest: notifications include segments of chunk (read from chunk list in root), so consumers
+    can fetch media without requesting chunk playlist first"""
+    def __init__(self, endpoint, metadata=None, root=None, manifest=False, **kwargs):
+        super().__init__(endpoint, metadata=metadata, **kwargs)
+        self.root = root
+        self.manifest = manifest and root is not None
+    def segments_manifest(self, path):
+        """Segments of chunk (path relative to root) with sizes, totals of duration and bytes"""
+        full_path = os.path.join(self.root, path)
+        segments = YAMLChunker.read_chunk_segments(full_path, False)
+        packed_url = os.path.join(self.metadata['id'], os.path.relpath(ChunkPacker.packed_path(full_path), self.root))
+        items = []
+        for segment in segments:
+            item = dict(sequence=segment.sequence, duration=segment.duration,
+                        datetime=segment.datetime.strftime(YAMLWriter.datetime_format))
+            if segment.offset is not None:
+                # byte range of packed chunk file
+                item.update(relative_url=packed_url, offset=segment.offset, size=segment.length)
+            else:
+                try:
+                    size = os.path.getsize(os.path.join(self.root, segment.path))
+                except FileNotFoundError:
+                    size = None
+                item.update(relative_url=os.path.join(self.metadata['id'], segment.path), size=size)
+            items.append(item)
+        return dict(segments=items, duration=sum(item['duration'] for item in items),
+                    bytes=sum(item['size'] for item in items if item['size'] is not None))
     async def notify(self, path, start=None, end=None, next_path=None, prev_path=None, **kwargs):
         chunk_relative_url = os.path.join(self.metadata['id'], os.path.splitext(path)[0]+'.m3u8')
         prev_chunk_relative_url = os.path.join(self.metadata['id'], os.path.splitext(prev_path)[0]+'.m3u8') if prev_path else None
         next_chunk_relative_url = os.path.join(self.metadata['id'], os.path.splitext(next_path)[0]+'.m3u8') if next_path else None
         data = dict(self.metadata, chunk_relative_url=chunk_relative_url,
                 prev_chunk_relative_url=prev_chunk_relative_url, next_chunk_relative_url=next_chunk_relative_url)
+        if self.manifest:
+            try:
+                data.update(self.segments_manifest(path))
+            except Exception as e:
+                # consumers fall back to chunk playlist
+                logger.error('Stream %s: no segments manifest for chunk %s: %s' % (self.metadata['id'], path, e))
         await self.send(data)
 
 
+def feed_option(feed, config, key, default=None):
+    """Feed specific option if given in feed configuration, otherwise global option from config"""
+    if type(feed) is dict and key in feed:
+        return feed[key]
+    return config.get(key, default)
+
+
 def pull_worker(source_feed, root, chunk_metadata_endpoint, metadata, kwargs, stop):
+    # forked from running event loop (admin API, configuration reload): not the loop of parent, its
+    # signal handling (wakeup fd is self pipe of parent loop) and metrics (chunk server) are not inherited
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    metrics.REGISTRY.reset()
+    kwargs.setdefault('started', time.time())   # time to first segment is measured from process start
+    trace = kwargs.pop('tracing', None)
+    profiling = kwargs.pop('profiling', None)
+    retention = kwargs.pop('retention', None)
+    manifest = kwargs.pop('notify_manifest', False)
+    handover = kwargs.pop('handover', None)
+    if trace:
+        trace = dict(trace) if type(trace) is dict else {}
+        fmt = trace.get('format', 'jsonl')
+        path = os.path.join(trace.get('dir') or os.path.join(os.path.dirname(root), traces_dirname),
+                            metadata['id'] + ('.trace.json' if fmt == 'chrome' else '.trace.jsonl'))
+        tracing.configure(path, metadata['id'], trace.get('sample_rate', 0.01), fmt)
+        logger.info('Tracing feed %s to %s' % (metadata['id'], path))
+    if profiling:
+        profiling = dict(profiling) if type(profiling) is dict else {}
+        tracing.Profiler(profiling.get('dir') or os.path.join(root, 'profiles'), profiling.get('duration', 30),
+                         loop=loop).install()
     if chunk_metadata_endpoint is not None:
-        chunk_notifier = ChunkNotifier(chunk_metadata_endpoint, metadata=metadata)
+        chunk_notifier = ChunkNotifier(chunk_metadata_endpoint, metadata=metadata, root=root, manifest=manifest)
     else:
         chunk_notifier = None
-    pull = HLSPull(source_feed, root, chunk_notifier=chunk_notifier, metadata=metadata, **kwargs)
-    run_pull(pull)
+    # handover: feed taken over from other instance, pulling starts at once, lists are loaded when released
+    pull = HLSPull(source_feed, root, chunk_notifier=chunk_notifier, metadata=metadata, released=handover, **kwargs)
+    # metrics of this feed process are collected by chunk server from snapshots
+    metrics_path = os.path.join(os.path.dirname(root), metrics_dirname, metadata['id']+'.json')
+    asyncio.ensure_future(metrics.write_snapshots(metrics_path), loop=loop)
+    if retention:
+        retention = Retention(root, content_store=pull.storage.content_store, reopen=pull.storage.list.reopen,
+                              feed=metadata['id'], **retention)
+        asyncio.ensure_future(retention.run() if handover is None else run_released(handover, retention.run()),
+                              loop=loop)
+    asyncio.ensure_future(watch_stop(pull, stop), loop=loop)
+    run_pull(pull, loop)
+
+
+async def run_released(released, coroutine):
+    """Run coroutine once feed is released by other instance (lists are not rewritten before)"""
+    await wait_released(released)
+    await coroutine
+
+
+def feed_id(feed, source_feed):
+    """Configured id of feed, MD5 of source feed URL if none"""
+    if type(feed) is not dict or not feed.get('id'):
+        h = hashlib.md5()
+        h.update(source_feed.encode('utf8'))
+        return h.hexdigest()
+    return feed.get('id')
+
+
+class FeedManager:
+    """Feed processes of chunker. Feeds are started, stopped and reconfigured individually at runtime
+    (admin API, reload of configuration file), other running feeds are not touched. Stopped feed
+    ends its chunk in progress (packed and notified) before its process exits."""
+    stop_timeout = 60       # seconds to wait for stopped feed process before it is terminated
+
+    def __init__(self, data_dir, config, config_path=None, defaults=None, budget=None, throttle=None):
+        self.data_dir = data_dir
+        self.config = config
+        self.config_path = config_path
+        self.config_mtime = os.path.getmtime(config_path) if config_path else None
+        self.defaults = defaults or {}      # parallel_downloads, chunk_size (command line)
+        self.budget = budget
+        self.free_slots = list(range(len(budget.in_use))) if budget else []  # budget slots of stopped feeds
+        self.throttle = throttle
+        self.feeds = {}     # id -> Feed
+        self.configured = set()     # ids of active feeds of last applied configuration
+        self.released = set()       # ids handed over to other instance, never started here again
+        self.lock = asyncio.Lock()
+
+    Feed = namedtuple('Feed', 'process, stop, spec, slot')
+
+    def specs(self, config):
+        """Active feeds of configuration: id -> (source_feed, metadata, feed configuration)"""
+        active_feeds = config.get('active_feeds') or []
+        specs = OrderedDict()
+        for i,feed in enumerate(config.get('feeds') or []):
+            source_feed = feed.get('source_feed') if type(feed) is dict else feed
+            if not source_feed or type(source_feed) is not str:
+                logger.warning('Skipping feed configuration #%i: no valid source feed url' % i)
+                continue
+            # TO DO: Check if source feed URL is live. Warn and skip feed if not. - UG
+            if (feed.get('id') if type(feed) is dict else feed) not in active_feeds:
+                continue
+            id = feed_id(feed, source_feed)
+            if id in specs:
+                logger.warning('Duplicated feed id for feed configuration #%i' % i)
+                continue
+            specs[id] = (source_feed, feed)
+        return specs
+
+    def feed_kwargs(self, feed, config):
+        return dict(ext='ts', parallel_downloads=self.defaults.get('parallel_downloads'),
+                    chunk_size=self.defaults.get('chunk_size'),
+                    hedge=feed_option(feed, config, 'hedge_downloads'),
+                    max_queued=feed_option(feed, config, 'download_queue_size', 100),
+                    bandwidth_limit=feed_option(feed, config, 'bandwidth_limit'),
+                    reorder=feed_option(feed, config, 'reorder_buffer'),
+                    variant=feed_option(feed, config, 'variant'),
+                    extract_audio=feed_option(feed, config, 'extract_audio'),
+                    deduplicate=feed_option(feed, config, 'deduplicate'),
+                    pack_chunks=feed_option(feed, config, 'pack_chunks'),
+                    backfill=feed_option(feed, config, 'backfill'),
+                    verify_existing=feed_option(feed, config, 'verify_existing', False),
+                    tracing=feed_option(feed, config, 'tracing'), profiling=feed_option(feed, config, 'profiling'),
+                    retention=feed_option(feed, config, 'retention'),
+                    notify_manifest=feed_option(feed, config, 'notify_manifest', False))
+
+    def spec(self, id, source_feed, feed, config):
+        """Everything feed process is started with, feed is restarted when it changes"""
+        metadata = dict(feed, id=id) if type(feed) is dict else dict(source_feed=source_feed, id=id)
+        return (source_feed, metadata, self.feed_kwargs(feed, config), config.get('chunk_metadata_endpoint'))
+
+    def start(self, id, spec, start_delay=0, handover=None):
+        source_feed, metadata, kwargs, endpoint = spec
+        specs = ','.join('%s=%s' % item for item in sorted(metadata.items(), key=lambda item: item[0]))
+        logger.info('Adding feed %s %s' % (id, specs))
+        slot = self.free_slots.pop(0) if self.free_slots else None
+        if self.budget and slot is None:
+            logger.warning('No download budget slot left for feed %s, downloads not limited by budget' % id)
+        stop = Value('B', 0)
+        kwargs = dict(kwargs, budget=self.budget.feed(slot) if slot is not None else None,
+                      throttle=self.throttle, start_delay=start_delay, handover=handover)
+        process = Process(target=pull_worker, args=(source_feed, os.path.join(self.data_dir, id), endpoint,
+                                                    metadata, kwargs, stop), name=id)
+        process.start()
+        self.feeds[id] = self.Feed(process, stop, spec, slot)
+        logger.info('Feed %s started in process %i' % (id, process.pid))
+
+    def join(self, id, feed, timeout=None):
+        """Wait for stopped feed process, terminate it after timeout (blocking, feeds are not touched)"""
+        feed.process.join(self.stop_timeout if timeout is None else timeout)
+        if feed.process.is_alive():
+            logger.warning('Feed %s did not stop in time, terminating process %i' % (id, feed.process.pid))
+            feed.process.terminate()
+            feed.process.join()
+
+    def stopped(self, id):
+        """Remove joined feed, release its budget slot"""
+        feed = self.feeds.pop(id)
+        if feed.slot is not None:
+            with self.budget.lock:
+                # terminated process may not have released its downloads
+                self.budget.in_use[feed.slot] = 0
+                self.budget.waiting[feed.slot] = 0
+            self.free_slots.append(feed.slot)
+        logger.info('Feed %s stopped (exit code %s)' % (id, feed.process.exitcode))
+
+    async def stop(self, id, timeout=None, value=1):
+        """Stop feed process, joined in executor thread (feeds and budget slots are changed in event loop only)"""
+        feed = self.feeds[id]
+        feed.stop.value = value
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.join, id, feed, timeout)
+        self.stopped(id)
+
+    async def release(self, id):
+        """Stop feed for other instance to continue it (handover), returns when its lists are closed"""
+        # configuration watcher stops once handover begins, admin API and reload skip released feeds
+        self.released.add(id)
+        async with self.lock:
+            if id not in self.feeds:
+                return False
+            await self.stop(id, value=handover_stop)
+            return True
+
+    async def take_over(self, handover, id, released):
+        """Request release of feed from other instance (HandoverClient), feed process started with
+        released Event continues when done"""
+        loop = asyncio.get_event_loop()
+        try:
+            if await loop.run_in_executor(None, handover.release, id):
+                logger.info('Feed %s taken over' % id)
+        except Exception as e:
+            logger.error('Handover of feed %s failed: %s' % (id, e))
+        finally:
+            released.set()
+
+    async def apply(self, config, handover=None):
+        """Make running feeds match active feeds of configuration: stop feeds removed from it, restart
+        changed feeds and start added ones; returns ids of stopped, started and restarted feeds.
+        handover: HandoverClient of other instance, its feeds are taken over"""
+        async with self.lock:
+            self.config = config
+            specs = OrderedDict((id, self.spec(id, source_feed, feed, config))
+                                for id, (source_feed, feed) in self.specs(config).items())
+            # feeds started by admin API are kept unless configuration file had them before
+            removed = [id for id in self.feeds if id in self.configured and id not in specs]
+            changed = [id for id in self.feeds if id in specs and specs[id] != self.feeds[id].spec]
+            added = [id for id in specs if id not in self.feeds and id not in self.released]
+            if removed or changed:
+                await asyncio.gather(*(self.stop(id) for id in removed + changed))
+            warm_start = config.get('warm_start') or {}
+            stagger = warm_start.get('stagger', 0) if type(warm_start) is dict else 0
+            remote = set(handover.feeds()) if handover else set()
+            released = {}
+            for i,id in enumerate(changed + added):
+                if id in remote:
+                    released[id] = Event()
+                self.start(id, specs[id], i * stagger, released.get(id))
+            if released:
+                await asyncio.gather(*(self.take_over(handover, id, event) for id, event in released.items()))
+            self.configured = set(specs)
+            return dict(stopped=removed, started=added, restarted=changed)
+
+    async def update(self, id, feed):
+        """Start feed with feed configuration (dict as in feeds of configuration), restart it if
+        running with other configuration; not written to configuration file"""
+        source_feed = feed.get('source_feed')
+        if not source_feed or type(source_feed) is not str:
+            raise ValueError('no valid source feed url')
+        if not re.fullmatch(feed_id_pattern, id or ''):
+            # directory of feed in data directory, must not collide with internal ones (.metrics, .blobs, ...)
+            raise ValueError('invalid feed id: %r' % id)
+        if id in self.released:
+            raise ValueError('feed %s was handed over to other instance' % id)
+        async with self.lock:
+            spec = self.spec(id, source_feed, dict(feed, id=id), self.config)
+            if id in self.feeds:
+                if self.feeds[id].spec == spec:
+                    return False
+                await self.stop(id)
+            self.start(id, spec)
+            return True
+
+    async def remove(self, id):
+        async with self.lock:
+            if id not in self.feeds:
+                raise KeyError(id)
+            await self.stop(id)
+
+    async def reload(self):
+        """Apply configuration file"""
+        self.config_mtime = os.path.getmtime(self.config_path)
+        with open(self.config_path, 'r') as f:
+            config = yaml.load(f)
+        logger.info('Reloading configuration from %s' % self.config_path)
+        result = await self.apply(config)
+        logger.info('Configuration applied: %s' % ', '.join('%s %s' % (key, ' '.join(ids) or '-')
+                                                            for key, ids in sorted(result.items())))
+        return result
+
+    async def watch(self, interval=5):
+        """Reload configuration file when it is modified, until handover to other instance begins"""
+        while True:
+            await asyncio.sleep(interval)
+            if self.released:
+                logger.info('Handover in progress, configuration %s no longer watched' % self.config_path)
+                return
+            try:
+                if os.path.getmtime(self.config_path) != self.config_mtime:
+                    await self.reload()
+            except Exception as e:
+                logger.error('Unable to reload configuration %s: %s' % (self.config_path, e))
+
+    @property
+    def status(self):
+        return [dict(id=id, pid=feed.process.pid, alive=feed.process.is_alive(), exitcode=feed.process.exitcode,
+                     source_feed=feed.spec[0], budget_slot=feed.slot) for id, feed in sorted(self.feeds.items())]
+
+    def shutdown(self):
+        """Stop all feeds (blocking)"""
+        for feed in self.feeds.values():
+            feed.stop.value = 1
+        for id, feed in list(self.feeds.items()):
+            self.join(id, feed)
+            self.stopped(id)
 
 
 if __name__ == "__main__":
@@ -81,6 +428,8 @@ if __name__ == "__main__":
                         help='chunk size in seconds')
     parser.add_argument('--parallel-downloads','-j', type=int,
                         help='number of parallel downloads')
+    parser.add_argument('--handover', action='store_true',
+                        help='take over feeds and chunk server socket from running instance (rolling upgrade)')
     args = parser.parse_args()
 
     try: # reading the config file
@@ -100,9 +449,6 @@ if __name__ == "__main__":
         if not argmnt in args:
             args[argmnt] = config.get(argmnt,dfltval)
         
-    jobs = []
-    stop = Value('B', 0)
-
     active_feeds = config.get('active_feeds') or []
     feeds = config.get('feeds') or []
     is_active_feed = lambda feed, active_feeds: (feed.get('id') if type(feed) is dict else feed) in active_feeds
@@ -113,48 +459,96 @@ if __name__ == "__main__":
         logger.warning('No chunk metadata endpoint specified! (Check file %s). '%args.config+
                        'Will not notify anyone of new chunks.')
 
+    budget = None
+    if config.get('download_budget'):
+        budget_config = config['download_budget']
+        if type(budget_config) is not dict:
+            budget_config = dict(limit=budget_config)
+        # slots of feeds added at runtime must exist before feed processes are started
+        max_feeds = budget_config.get('max_feeds') or len(feeds) + 16
+        budget = DownloadBudget(budget_config.get('limit', 16), max_feeds, budget_config.get('minimum', 1))
+        logger.info('Global download budget: %i concurrent downloads, at least %i per feed'
+                    % (budget.limit, budget.minimum))
+
+    throttle = []
+    if config.get('total_bandwidth_limit'):
+        limit = config['total_bandwidth_limit']
+        if type(limit) is not dict:
+            limit = dict(rate=limit)
+        throttle.append(TokenBucket(shared=True, name='total', **limit))
+        logger.info('Total download bandwidth limit: %i B/s' % throttle[0].rate)
+
     if not feeds:
         logger.warning('No valid active feeds (Check file %s). '%args.config+
                        'Will only serve chunks from local storage')
     else:
         logger.info('Chunk metadata submission endpoint: %s'%chunk_metadata_endpoint)
-        ids = set()
-        for i,feed in enumerate(feeds):
-            source_feed = feed.get('source_feed') if type(feed) is dict else feed
-            if not source_feed or type(source_feed) is not str:
-                logger.warning('Skipping feed configuration #%i: no valid source feed url' % i)
-                continue
-            # TO DO: Check if source feed URL is live. Warn and skip feed if not. - UG
-            if type(feed) is not dict or not feed.get('id'):
-                h = hashlib.md5()
-                h.update(source_feed.encode('utf8'))
-                id = h.hexdigest()
-            else:
-                id = feed.get('id')
-            if id in ids:
-                logger.warning('Duplicated feed id for feed configuration #%i' % i)
-                continue
-            ids.add(id)
-            metadata = dict(feed, id=id) if type(feed) is dict else dict(source_feed=source_feed, id=id)
-            specs = ','.join('%s=%s' % item for item in sorted(metadata.items(), key=lambda item: item[0]))
-            logger.info('Adding feed #%i: %s %s'%(i,id,specs))
-
-            # create job
-            root = os.path.join(args.data_dir, id)
-            kwargs = dict(ext='ts', parallel_downloads=args.parallel_downloads, chunk_size=args.chunk_size)
-            job = Process(target=pull_worker, args=(source_feed, root, chunk_metadata_endpoint,
-                                                    metadata, kwargs, stop))
-            jobs.append(job)
-            
-    for job in jobs:
-        job.start()
-
-    serve_chunks(args.data_dir, args.host, args.port, args.prefix, args.full_path)
-
-    # TODO: not implemented, add signal handler
-    stop.value = 1
-
-    for job in jobs:
-        job.join()
+
+    # feeds are started (warm start: initial playlist requests staggered) and later reconfigured
+    # by feed manager: admin API (/admin/feeds) and reload of changed configuration file
+    # serve: False (ingest only, chunks served by serve_chunks.py elsewhere) or {workers: <number>}
+    serve = config.get('serve', True)
+    serve_workers = serve.get('workers', 1) if type(serve) is dict else 1
+    # admin API is served by this process on a separate listener (localhost by default)
+    admin = config.get('admin', True)
+    admin = (dict(admin) if type(admin) is dict else {}) if admin else None
+
+    # handover: running instance passes its chunk server socket and releases feeds as ours start
+    control_path = config.get('control_socket') or os.path.join(args.data_dir, control_socket_name)
+    handover = None
+    if args.handover:
+        try:
+            handover = HandoverClient(control_path)
+            handover.feeds()
+            logger.info('Taking over from instance at %s' % control_path)
+        except OSError as e:
+            logger.warning('No running instance to take over from (%s): %s' % (control_path, e))
+            handover = None
+    sock = admin_sock = None
+    if handover:
+        try:
+            sock, admin_sock = handover.sockets()
+        except Exception as e:
+            logger.warning('Chunk server and admin sockets not taken over: %s' % e)
+    if not serve and sock is not None:
+        sock.close()
+        sock = None
+    if serve and sock is None:
+        sock = listen(args.host, args.port)
+    if admin is None and admin_sock is not None:
+        admin_sock.close()
+        admin_sock = None
+    if admin is not None and admin_sock is None:
+        admin_sock = listen(admin.get('host', '127.0.0.1'), admin.get('port', args.port + 1))
+
+    manager = FeedManager(args.data_dir, config, args.config, budget=budget, throttle=throttle,
+                          defaults=dict(parallel_downloads=args.parallel_downloads, chunk_size=args.chunk_size))
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(manager.apply(config, handover))
+    if handover:
+        # feeds of old instance not configured here are stopped by it
+        handover.shutdown()
+    control = HandoverServer(control_path, manager, sock, admin_sock)
+    loop.run_until_complete(control.start())
+    reload_interval = config.get('reload_interval', 5)
+    if reload_interval:
+        asyncio.ensure_future(manager.watch(reload_interval))
+
+    if serve:
+        # admin API is served by this process also with serving worker processes
+        serve_chunks(args.data_dir, args.host, args.port, args.prefix, args.full_path, budget=budget,
+                     metrics_dir=os.path.join(args.data_dir, metrics_dirname), feeds=manager, sock=sock,
+                     workers=serve_workers, admin_sock=admin_sock)
+    else:
+        admin_server = start_server(make_admin_app(budget, manager), admin_sock) if admin_sock else None
+        try:
+            loop.run_forever()      # until handed over or interrupted
+        except KeyboardInterrupt:
+            pass
+        if admin_server:
+            stop_server(*admin_server)
+
+    control.close()
+    manager.shutdown()
 
     logger.info('All stopped!')
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import os, sys, json, array, socket, logging
+import asyncio
+
+# Handover between chunker instances (rolling upgrade without losing segments). Running instance listens
+# on control socket (unix domain socket in data directory). New instance connects to it, receives the
+# listening sockets of chunk server and admin API (SCM_RIGHTS) and takes over feeds: the old instance
+# stops pulling the feed, drains its in-flight downloads and closes the lists, chunk in progress is left
+# open; the new feed process requests the playlist meanwhile, then loads the lists and continues from
+# the last stored segment. Finally the old instance is told to shut down (stops accepting, finishes its
+# requests). Released feeds are never started again by the old instance (configuration reload and
+# admin API).
+#
+# Protocol: one JSON line request and one JSON line reply per connection
+#   {"cmd": "feeds"}            -> {"feeds": [<id>, ...]}
+#   {"cmd": "release", "id": X} -> {"id": X, "released": <bool>} (sent when feed process exited)
+#   {"cmd": "socket"}           -> {"socket": true, "family": <address family>, "admin_family": <address
+#                                  family>} with listening sockets of chunk server and admin API as
+#                                  ancillary data (family null: instance has no such socket)
+#   {"cmd": "shutdown"}         -> {"shutdown": true}
+# Feed admin commands (as admin API, see serve_chunks.feed_admin):
+#   {"cmd": "status"}, {"cmd": "update", "id": X, "feed": {...}}, {"cmd": "remove", "id": X}, {"cmd": "reload"}
+# Failed requests are replied with {"error": <message>, "type": <exception class>}.
+
+logger = logging.getLogger(__name__)
+
+control_socket_name = '.chunker.sock'   # in data directory
+
+
+def send_fds(sock, data, fds):
+    sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+
+def recv_fds(sock, size, maxfds):
+    fds = array.array('i')
+    data, ancdata, flags, addr = sock.recvmsg(size, socket.CMSG_LEN(maxfds * fds.itemsize))
+    for level, type, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+    return data, list(fds)
+
+
+class HandoverServer:
+    """Control socket of running instance; manager: FeedManager, sock: listening socket of chunk server,
+    admin_sock: listening socket of admin API"""
+    def __init__(self, path, manager, sock=None, admin_sock=None, loop=None):
+        self.path = path
+        self.manager = manager
+        self.sock = sock
+        self.admin_sock = admin_sock
+        self.loop = loop or asyncio.get_event_loop()
+        self.server = None
+        self.handed_over = False
+
+    async def start(self):
+        if os.path.exists(self.path):
+            # left by instance that was handed over or crashed
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(self.handle, self.path, loop=self.loop)
+        logger.info('Control socket: %s' % self.path)
+
+    async def handle(self, reader, writer):
+        try:
+            request = json.loads((await reader.readline()).decode('utf8'))
+            cmd = request.get('cmd')
+            logger.info('Control request: %s' % request)
+            if cmd == 'feeds':
+                reply = dict(feeds=sorted(self.manager.feeds))
+            elif cmd == 'release':
+                reply = dict(id=request['id'], released=await self.manager.release(request['id']))
+            elif cmd == 'socket' and (self.sock is not None or self.admin_sock is not None):
+                # duplicate of connection socket: transport's socket object may not expose sendmsg
+                with socket.fromfd(writer.get_extra_info('socket').fileno(), socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+                    # family: listening socket may be IPv6 (--host ::)
+                    family = lambda sock: int(sock.family) if sock is not None else None
+                    reply = dict(socket=True, family=family(self.sock), admin_family=family(self.admin_sock))
+                    send_fds(conn, json.dumps(reply).encode('utf8') + b'\n',
+                             [sock.fileno() for sock in (self.sock, self.admin_sock) if sock is not None])
+                writer.close()
+                return
+            elif cmd == 'status':
+                reply = dict(status=self.manager.status)
+            elif cmd == 'update':
+                reply = dict(changed=await self.manager.update(request['id'], request['feed']))
+            elif cmd == 'remove':
+                await self.manager.remove(request['id'])
+                reply = dict(removed=True)
+            elif cmd == 'reload':
+                reply = await self.manager.reload()
+            elif cmd == 'shutdown':
+                # remaining feeds (not taken over) are stopped when chunk server returns
+                self.handed_over = True
+                self.loop.call_soon(self.loop.stop)
+                reply = dict(shutdown=True)
+            else:
+                reply = dict(error='unknown command: %s' % cmd)
+        except Exception as e:
+            logger.error('Control request failed: %s' % e)
+            reply = dict(error=str(e), type=type(e).__name__)
+        writer.write(json.dumps(reply).encode('utf8') + b'\n')
+        await writer.drain()
+        writer.close()
+
+    def close(self):
+        if self.server:
+            self.server.close()
+        if not self.handed_over and os.path.exists(self.path):
+            # socket file of new instance must not be removed
+            os.remove(self.path)
+
+
+class HandoverClient:
+    """Requests to control socket of running instance (blocking)"""
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        return sock
+
+    def request(self, cmd, **kwargs):
+        with self.connect() as sock:
+            sock.sendall(json.dumps(dict(kwargs, cmd=cmd)).encode('utf8') + b'\n')
+            with sock.makefile('rb') as f:
+                reply = json.loads(f.readline().decode('utf8'))
+        if 'error' in reply:
+            # admin API maps these to HTTP errors
+            exception = dict(KeyError=KeyError, ValueError=ValueError).get(reply.get('type'), Exception)
+            raise exception('%s failed: %s' % (cmd, reply['error']))
+        return reply
+
+    def feeds(self):
+        return self.request('feeds')['feeds']
+
+    def release(self, id):
+        """Blocks until feed is released by running instance"""
+        return self.request('release', id=id)['released']
+
+    def shutdown(self):
+        return self.request('shutdown')
+
+    def sockets(self):
+        """Listening sockets of chunk server and admin API (None if it has none) of running instance"""
+        with self.connect() as sock:
+            sock.sendall(b'{"cmd": "socket"}\n')
+            data, fds = recv_fds(sock, 4096, 2)
+        if not fds:
+            raise Exception('handover socket failed: %s' % data.decode('utf8').strip())
+        reply = json.loads(data.decode('utf8'))
+        sockets = []
+        for family in (reply.get('family'), reply.get('admin_family')):
+            if family is None:
+                sockets.append(None)
+                continue
+            fd = fds.pop(0)
+            sockets.append(socket.fromfd(fd, family, socket.SOCK_STREAM))
+            os.close(fd)
+        return tuple(sockets)
+
+
+async def wait_released(released, stopped=lambda: False, interval=0.05):
+    """Wait until released (multiprocessing Event) is set by instance taking over the feed; returns
+    False if stopped() meanwhile"""
+    while not released.is_set():
+        if stopped():
+            return False
+        await asyncio.sleep(interval)
+    return True
+
+
+if __name__ == "__main__":
+
+    # query running instance: handover.py <control socket> feeds|shutdown|release <id>
+    if len(sys.argv) < 3:
+        print('usage: %s <control socket> feeds|release <id>|shutdown' % sys.argv[0])
+        sys.exit(0)
+
+    client = HandoverClient(sys.argv[1])
+    print(json.dumps(client.request(sys.argv[2], **(dict(id=sys.argv[3]) if len(sys.argv) > 3 else {}))))
@@ -6,6 +6,7 @@ from datetime import datetime, timedelta
 from urllib.parse import urljoin
 from binascii import crc32
 from math import ceil
+from itertools import islice
 
 
 def item_type(item, classinfo):
@@ -36,13 +37,25 @@ def split_quoted(string, splitchars=',', quotechars='"', limit=None):
 def parse_iso8601(datetimestr):
     dt = datetime.strptime(datetimestr.replace(':',''), '%Y-%m-%dT%H%M%S.%f%z')
     if dt.utcoffset() is not None:
-        dt -= dt.utcoffset()
+        dt = (dt - dt.utcoffset()).replace(tzinfo=None)    # naive UTC like the rest of datetimes
     return dt
 
 
 HLSMedia = namedtuple('Media', 'url, params, source')
 HLSStream = namedtuple('Stream', 'url, params, source')
 
+audio_codecs = ('mp4a', 'ac-3', 'ec-3', 'mp3', 'opus')
+
+def stream_bandwidth(stream):
+    try:
+        return int(stream.params.get('BANDWIDTH', 0))
+    except ValueError:
+        return 0
+
+def stream_audio_only(stream):
+    codecs = stream.params.get('CODECS')
+    return bool(codecs) and all(codec.strip().startswith(audio_codecs) for codec in codecs.split(','))
+
 class HLSItem:
     name = ''
     duration = 0
@@ -56,6 +69,8 @@ class HLSItem:
 def guess_epoch_from_url(url):
     # this is a custom hack to guess the epoch of a .ts file from its file name
     # works for data provisioned by the BBC and for DW live streams [UG]
+    if not url:
+        return 0
     m = re.search(r'dwstream.*segment(\d+)',url)
     if m: return int(m.group(1))*10
     # code below assumes that the chunk is provisioned by the BBC
@@ -66,7 +81,7 @@ def guess_epoch_from_url(url):
     
 class HLSSegment(HLSItem):
     def __init__(self, checksum=None, url=None, duration=None, datetime=None,
-                 path=None, source_sequence=None, sequence=None):
+                 path=None, source_sequence=None, sequence=None, byterange=None):
         self.checksum = checksum
         self.url = url
         self.duration = duration
@@ -75,6 +90,7 @@ class HLSSegment(HLSItem):
         self.source_sequence = source_sequence
         self.sequence = sequence
         self.epoch = guess_epoch_from_url(url)
+        self.byterange = byterange      # (length, offset) of sub-range of url
     def __str__(self):
         return 'HLSSegment(checksum=%s, url=%s, duration=%s, datetime=%s)' \
             % (self.checksum, self.url, self.duration, self.datetime)
@@ -109,57 +125,149 @@ class HLSIndexException(Exception):
 
 
 class SegmentsList(deque):
+    """Deque of playlist items with index of segment positions by checksum, so that splicing
+    a refreshed playlist costs time proportional to the number of new items"""
     def __init__(self):
         self.last_removed_item = None       # point to last deleted item - item before the first in the list (could be the segment)
         self.last_removed_segment = None    # point to last deleted segment - segment before the first in the list
+        self.positions = {}                 # segment checksum -> absolute position, or ascending list of positions of duplicates
+        self.offset = 0                     # absolute position of the first item
+        self.first_segment_cache = None     # None: unknown, found by scan on demand
+        self.last_segment_cache = None
+    def add_position(self, checksum, position, left=False):
+        positions = self.positions.get(checksum)
+        if positions is None:
+            self.positions[checksum] = position
+        elif type(positions) is int:
+            self.positions[checksum] = [position, positions] if left else [positions, position]
+        elif left:
+            positions.insert(0, position)
+        else:
+            positions.append(position)
+    def append(self, item):
+        if type(item) is HLSSegment:
+            self.add_position(item.checksum, self.offset + len(self))
+            self.last_segment_cache = item
+        super().append(item)
+    def appendleft(self, item):
+        self.offset -= 1
+        if type(item) is HLSSegment:
+            self.add_position(item.checksum, self.offset, left=True)
+            self.first_segment_cache = item
+        super().appendleft(item)
     def popleft(self):
         if not self:
             return
         item = super().popleft()
+        self.offset += 1
         self.last_removed_item = item
         if type(item) is HLSSegment:
             self.last_removed_segment = item
+            self.forget(item, self.offset - 1)
+        return item
+    def popleft_many(self, count):
+        if count <= len(self) // 2:
+            for i in range(count):
+                self.popleft()
+            return
+        # cheaper to rebuild index of the remaining items
+        self.last_removed_item = self[count-1]
+        for i in range(count-1, -1, -1):
+            if type(self[i]) is HLSSegment:
+                self.last_removed_segment = self[i]
+                break
+        remaining = self.items_from(self, count)
+        offset = self.offset + count
+        self.clear()
+        self.offset = offset
+        for item in remaining:
+            self.append(item)
+    def pop(self):
+        item = super().pop()
+        if type(item) is HLSSegment:
+            self.forget(item, self.offset + len(self))
         return item
+    def forget(self, segment, position):
+        positions = self.positions.get(segment.checksum)
+        if positions == position:
+            del self.positions[segment.checksum]
+        elif type(positions) is list and position in positions:
+            positions.remove(position)      # first or last one (popleft, pop)
+            if len(positions) == 1:
+                self.positions[segment.checksum] = positions[0]
+        if segment is self.first_segment_cache:
+            self.first_segment_cache = None
+        if segment is self.last_segment_cache:
+            self.last_segment_cache = None
+    def clear(self):
+        super().clear()
+        self.positions.clear()
+        self.offset = 0
+        self.first_segment_cache = self.last_segment_cache = None
+    def index_of(self, item, last=False):
+        """Index of the first (last) item equal to item (same checksum) or None"""
+        positions = self.positions.get(item.checksum)
+        if positions is not None:
+            if type(positions) is list:
+                positions = positions[-1 if last else 0]
+            return positions - self.offset
+        if type(item) is not HLSSegment:
+            # tags are not indexed
+            for i, other in (reversed(list(enumerate(self))) if last else enumerate(self)):
+                if item == other:
+                    return i
+    @staticmethod
+    def find(items, item, last=False):
+        """Index of the first (last) item of items equal to item or None"""
+        if isinstance(items, SegmentsList):
+            return items.index_of(item, last)
+        found = None
+        for i, other in enumerate(items):
+            if item == other:
+                if not last:
+                    return i
+                found = i
+        return found
+    @staticmethod
+    def items_from(items, start):
+        """Items from index start to the end, iterates only over returned items"""
+        count = len(items) - start
+        if count <= 0:
+            return []
+        tail = list(islice(reversed(items), count))
+        tail.reverse()
+        return tail
     @property
     def last_item(self):
         if self:
             return self[-1]
     @property
     def first_segment(self):
-        for item in self or []:
-            if type(item) is HLSSegment:
-                return item
+        if self.first_segment_cache is None:
+            for item in self:
+                if type(item) is HLSSegment:
+                    self.first_segment_cache = item
+                    break
+        return self.first_segment_cache
     @property
     def last_segment(self):
-        for item in reversed(self or []):
-            if type(item) is HLSSegment:
-                return item
+        if self.last_segment_cache is None:
+            for item in reversed(self):
+                if type(item) is HLSSegment:
+                    self.last_segment_cache = item
+                    break
+        return self.last_segment_cache
     def extend(self, right, force=False):
         if not right:
             return self
         last = self.last_segment or self.last_removed_segment
         if not last:
             # nothing to extend, copy everything
-            super().extend(right)
+            for item in right:
+                self.append(item)
             return self
-        next_dt = last.datetime + timedelta(seconds=last.duration) if last.datetime else None
-        items = iter(right)
-        extended = False
-        for item in items:
-            if last == item:
-                extended = True
-                for item in items:
-                    item.datetime = next_dt
-                    self.append(item)
-                    if next_dt:
-                        next_dt += timedelta(seconds=item.duration)
-                # break   # just for clarity, can be avoided as the inner for-loop will consume the iterator
-        # set last
-        # for item in reversed(self):
-        #     if type(item) is HLSSegment:
-        #         self.last_segment = item
-        #         break
-        if not extended:
+        position = self.find(right, last)
+        if position is None:
             if not force:
                 return
             # check last item, must be either HLSEnd or HLSDiscontinuity
@@ -167,7 +275,15 @@ class SegmentsList(deque):
             if last and not isinstance(last, (HLSEnd, HLSDiscontinuity)) and \
                     not (type(last) is type and issubclass(last, (HLSEnd, HLSDiscontinuity))):
                 self.append(HLSSourceDiscontinuity)
-            super().extend(right)
+            for item in right:
+                self.append(item)
+            return self
+        next_dt = last.datetime + timedelta(seconds=last.duration) if last.datetime else None
+        for item in self.items_from(right, position + 1):
+            item.datetime = next_dt
+            self.append(item)
+            if next_dt:
+                next_dt += timedelta(seconds=item.duration)
         return self
     def extendleft(self, left):
         if not left:
@@ -177,43 +293,34 @@ class SegmentsList(deque):
         # find first segment
         first = self.first_segment
         if not first:
-            self.extendleft(reversed(left))
+            for item in reversed(left):
+                self.appendleft(item)
+            return self
+        position = self.find(left, first, last=True)
+        if position is None:
             return self
         next_dt = first.datetime
-        items = reversed(left)
-        for item in items:
-            if first == item:
-                for item in items:
-                    if next_dt:
-                        next_dt = item.datetime = next_dt - timedelta(seconds=item.duration)
-                    self.appendleft(item)
-                    # if type(item) is HLSSegment:
-                    #     self.first_segment = segment
-                # break   # just for clarity, can be avoided as the inner for-loop will consume the iterator
+        for item in reversed(list(islice(left, position))):
+            if next_dt:
+                next_dt = item.datetime = next_dt - timedelta(seconds=item.duration)
+            self.appendleft(item)
         return self
     def trimleft(self, until_item, update_datetime=True):
         # pop segments and update datetime
-        pop_count = 0
-        next_dt = None
-        for i,item in enumerate(self):
-            if next_dt:
+        position = self.index_of(until_item)
+        if position is None:
+            return 0
+        pop_count = position + 1
+        item = self[position]
+        if update_datetime and not item.datetime and until_item.datetime:
+            item.datetime = until_item.datetime
+            next_dt = item.datetime + timedelta(seconds=until_item.duration)
+            for item in self.items_from(self, pop_count):
                 item.datetime = next_dt
                 next_dt += timedelta(seconds=item.duration)
-            elif item == until_item:
-                pop_count = i + 1
-                if not update_datetime or item.datetime: # no need to continue
-                    break
-                if not item.datetime and until_item.datetime:
-                    item.datetime = until_item.datetime
-                    next_dt = item.datetime + timedelta(seconds=until_item.duration)
-                if not next_dt: # no datetime to extend
-                    break
-        if pop_count:
-            # remove all segments at the left up till matched
-            print ('Removing', pop_count, 'segment(s) from initial index (resuming),', len(self)-pop_count, 'segment(s) remain', file=sys.stderr)
-            for i in range(pop_count-1):
-                super().popleft()
-            self.popleft()
+        # remove all segments at the left up till matched
+        print ('Removing', pop_count, 'segment(s) from initial index (resuming),', len(self)-pop_count, 'segment(s) remain', file=sys.stderr)
+        self.popleft_many(pop_count)
         return pop_count
     def apply_end_datetime(self, end_datetime):
         for segment in reversed(self):
@@ -255,6 +362,9 @@ class HLSIndex:
         streams = index.streams
         unprocessed = index.unprocessed
         dt = None
+        duration = None         # of the next segment (EXTINF)
+        byterange = None        # of the next segment (EXT-X-BYTERANGE)
+        byterange_ends = {}     # url -> end of last sub-range
 
         # only non-empty lines
         lines = (line for line in (line.strip() for line in lines) if line)
@@ -269,8 +379,29 @@ class HLSIndex:
                 raise HLSIndexException('unknown index format, EXTM3U signature not found')
             for line in lines:
                 if line[0] != '#':
-                    print('warning: unexpected line:', line, file=sys.stderr)
-                    unprocessed.append(line)
+                    if duration is None:
+                        print('warning: unexpected line:', line, file=sys.stderr)
+                        unprocessed.append(line)
+                        continue
+                    # segment url
+                    url = line
+                    if byterange:
+                        length, offset = byterange
+                        if offset is None:
+                            offset = byterange_ends.get(url, 0)    # continues previous sub-range
+                        byterange = (length, offset)
+                        byterange_ends[url] = offset + length
+                        checksum = crc32(('%s@%i' % (url, offset)).encode('utf8'))
+                    else:
+                        checksum = crc32(url.encode('utf8'))          # id is hash of source url "as-is"
+                    url = get_url(url)
+                    segments.append(HLSSegment(checksum=checksum, url=url, duration=duration, datetime=dt,
+                                               source_sequence=sequence, byterange=byterange))
+                    if sequence is not None:
+                        sequence += 1
+                    if dt is not None:
+                        dt += timedelta(seconds=duration)
+                    duration = byterange = None
                     continue
 
                 directive = line.lstrip('# ')    # remove "#" and space simbols from left
@@ -279,16 +410,7 @@ class HLSIndex:
                 #print(key,value)
                 if key == 'EXTINF':
                     duration, *other = value.split(',', 1)
-                    # expects segment url next
-                    url = next(lines)
-                    checksum = crc32(url.encode('utf8'))          # id is hash of source url "as-is"
-                    url = get_url(url)
-                    # self.segments.append(HLSSegment(checksum=checksum, url=url, duration=float(duration), sequence=sequence, datetime=dt))
-                    segments.append(HLSSegment(checksum=checksum, url=url, duration=float(duration), datetime=dt, source_sequence=sequence))
-                    if sequence is not None:
-                        sequence += 1
-                    if dt is not None:
-                        dt += timedelta(seconds=float(duration))
+                    duration = float(duration)  # expects segment url next
                 elif key == 'EXT-X-STREAM-INF':
                     params = { k:v.strip('"') for k,v in (param.split('=', 1) for param in split_quoted(value)) }
                     # expects stream url next
@@ -300,7 +422,8 @@ class HLSIndex:
                     index.sequence = sequence = int(value)
                 elif key == 'EXT-X-MEDIA':
                     params = { k:v.strip('"') for k,v in (param.split('=', 1) for param in split_quoted(value)) }
-                    media.append(HLSMedia(params['URI'], params, source=line))
+                    # URI is optional (rendition included in variant stream)
+                    media.append(HLSMedia(get_url(params['URI']) if params.get('URI') else None, params, source=line))
                 elif key == 'EXT-X-PLAYLIST-TYPE':
                     index.type = value
                 elif key == 'EXT-X-TARGETDURATION':
@@ -311,7 +434,7 @@ class HLSIndex:
                     # segments.append(HLSEnd)
                     index.complete = True
                 elif key == 'EXT-X-PROGRAM-DATE-TIME':
-                    self.datetime = dt = parse_iso8601(value)
+                    index.datetime = dt = parse_iso8601(value)
                     # metadata[key] = value
                 elif key == 'EXT-X-DISCONTINUITY':
                     # http://blog.zencoder.com/2013/01/18/concatenation-hls-to-the-rescue/
@@ -330,12 +453,15 @@ class HLSIndex:
                         length, offset = (int(x) for x in br)
                     elif len(br) == 1:
                         length, offset = int(br[0]), None
-                    raise HLSIndexException('byte-range not yet supported')
+                    byterange = (length, offset)
                 elif key == 'EXT-X-ALLOW-CACHE':
                     pass
                 else:
                     print('warning: unexpected tag:', line, file=sys.stderr)
                     unprocessed.append(line)
+            if duration is not None:
+                # segment url missing
+                raise HLSIndexException('unexpected end of file, last line was: %s' % line)
         except StopIteration:
             if line is None:
                 raise HLSIndexException('empty file')
@@ -346,16 +472,46 @@ class HLSIndex:
 
         return index
 
+    def select_variant(self, select='lowest', bitrate=None, language=None):
+        """Select variant of master playlist: 'lowest' or 'highest' bandwidth stream, 'bitrate' - highest
+        bandwidth not exceeding bitrate (bits per second), 'audio' - audio rendition (of language if given)
+        or audio-only stream; returns HLSStream/HLSMedia or None"""
+        streams = self.streams
+        if select == 'audio':
+            renditions = [media for media in self.media if media.params.get('TYPE') == 'AUDIO' and media.url]
+            if language:
+                renditions = [media for media in renditions
+                              if media.params.get('LANGUAGE', '').lower().startswith(language.lower())] or renditions
+            if renditions:
+                default = [media for media in renditions if media.params.get('DEFAULT') == 'YES']
+                return (default or renditions)[0]
+            streams = [stream for stream in streams if stream_audio_only(stream)] or streams
+            select = 'lowest'
+        if not streams:
+            return None
+        if select == 'highest':
+            return max(streams, key=stream_bandwidth)
+        if select == 'bitrate' and bitrate:
+            below = [stream for stream in streams if stream_bandwidth(stream) <= bitrate]
+            if below:
+                return max(below, key=stream_bandwidth)
+        elif select not in ('lowest', 'bitrate'):
+            raise ValueError('unknown variant selection: %s' % select)
+        return min(streams, key=stream_bandwidth)
+
     @staticmethod
     def segments_to_index(segments, baseurl='', complete=False):
+        byteranges = any(getattr(segment, 'offset', None) is not None for segment in segments)
         output = [
             '#EXTM3U',
-            '#EXT-X-VERSION:3',
+            '#EXT-X-VERSION:%i' % (4 if byteranges else 3),     # EXT-X-BYTERANGE requires version 4
             '#EXT-X-TARGETDURATION:%i' % ceil(max(segments, key=lambda segment: segment.duration).duration),
             '#EXT-X-MEDIA-SEQUENCE:%i' % segments[0].sequence,
         ]
         for segment in segments:
             output.append('#EXTINF:%g,' % segment.duration)
+            if byteranges and segment.offset is not None:
+                output.append('#EXT-X-BYTERANGE:%i@%i' % (segment.length, segment.offset))
             url = urljoin(baseurl, segment.path) if hasattr(segment, 'path') else urljoin(baseurl, segment.url)
             output.append(url)
         if complete:
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import sys, random, unittest
+from collections import deque
+from datetime import datetime, timedelta
+
+# local
+from index import SegmentsList, HLSSegment, HLSDiscontinuity, HLSEnd, HLSSourceDiscontinuity
+
+# Differential test of SegmentsList (indexed segment positions) against the scanning implementation it
+# replaced: random splices of playlists with duplicated segments must give the same items, datetimes and
+# pop counts.
+#   python3 index_test.py
+
+
+class ScanningSegmentsList(deque):
+    """SegmentsList before segment positions were indexed (reference)"""
+    def __init__(self):
+        self.last_removed_item = None
+        self.last_removed_segment = None
+    def popleft(self):
+        if not self:
+            return
+        item = super().popleft()
+        self.last_removed_item = item
+        if type(item) is HLSSegment:
+            self.last_removed_segment = item
+        return item
+    @property
+    def first_segment(self):
+        for item in self or []:
+            if type(item) is HLSSegment:
+                return item
+    @property
+    def last_segment(self):
+        for item in reversed(self or []):
+            if type(item) is HLSSegment:
+                return item
+    def extend(self, right, force=False):
+        if not right:
+            return self
+        last = self.last_segment or self.last_removed_segment
+        if not last:
+            super().extend(right)
+            return self
+        next_dt = last.datetime + timedelta(seconds=last.duration) if last.datetime else None
+        items = iter(right)
+        extended = False
+        for item in items:
+            if last == item:
+                extended = True
+                for item in items:
+                    item.datetime = next_dt
+                    self.append(item)
+                    if next_dt:
+                        next_dt += timedelta(seconds=item.duration)
+        if not extended:
+            if not force:
+                return
+            last = len(self) > 0 and self[-1] or self.last_removed_item
+            if last and not isinstance(last, (HLSEnd, HLSDiscontinuity)) and \
+                    not (type(last) is type and issubclass(last, (HLSEnd, HLSDiscontinuity))):
+                self.append(HLSSourceDiscontinuity)
+            super().extend(right)
+        return self
+    def extendleft(self, left):
+        if not left:
+            return self
+        if self.last_removed_segment:
+            return self
+        first = self.first_segment
+        next_dt = first.datetime
+        items = reversed(left)
+        for item in items:
+            if first == item:
+                for item in items:
+                    if next_dt:
+                        next_dt = item.datetime = next_dt - timedelta(seconds=item.duration)
+                    self.appendleft(item)
+        return self
+    def trimleft(self, until_item, update_datetime=True):
+        pop_count = 0
+        next_dt = None
+        for i,item in enumerate(self):
+            if next_dt:
+                item.datetime = next_dt
+                next_dt += timedelta(seconds=item.duration)
+            elif item == until_item:
+                pop_count = i + 1
+                if not update_datetime or item.datetime:
+                    break
+                if not item.datetime and until_item.datetime:
+                    item.datetime = until_item.datetime
+                    next_dt = item.datetime + timedelta(seconds=until_item.duration)
+                if not next_dt:
+                    break
+        if pop_count:
+            for i in range(pop_count-1):
+                super().popleft()
+            self.popleft()
+        return pop_count
+
+
+start = datetime(2020, 1, 1)
+
+def segments(cls, numbers, dated=True):
+    items = cls()
+    for n in numbers:
+        items.append(n if type(n) is type else
+                     HLSSegment(n, 'http://origin/%i.ts' % n, 6.0, start + timedelta(seconds=6 * n) if dated else None))
+    return items
+
+def state(items):
+    return [(item.checksum, item.datetime) if type(item) is HLSSegment else item for item in items], \
+           items.last_removed_segment.checksum if items.last_removed_segment else None
+
+def playlist(rnd):
+    """Random window of segment numbers, sometimes with repeated (looping origin) segments or a tag"""
+    first = rnd.randint(0, 30)
+    numbers = list(range(first, first + rnd.randint(1, 12)))
+    for i in range(rnd.randint(0, 3)):
+        position = rnd.randint(0, len(numbers))
+        numbers.insert(position, rnd.choice(numbers))
+    if rnd.random() < 0.2:
+        numbers.insert(rnd.randint(0, len(numbers)), HLSSourceDiscontinuity)
+    return numbers
+
+def run_ops(cls, rnd, steps=12):
+    """Apply the same random operations (same random state) to list of cls, returns states after each"""
+    items = segments(cls, playlist(rnd), rnd.random() < 0.5)
+    states = []
+    for step in range(steps):
+        op = rnd.choice(('extend', 'extend_force', 'extendleft', 'trimleft', 'trimleft_segment'))
+        dated = rnd.random() < 0.5
+        other = segments(list, playlist(rnd), dated)
+        if op in ('extend', 'extend_force'):
+            result = items.extend(other, op == 'extend_force')
+            states.append((op, result is None, state(items)))
+        elif op == 'extendleft':
+            if items.first_segment is None:
+                continue    # reference recursed forever in this case
+            items.extendleft(other)
+            states.append((op, state(items)))
+        else:
+            pool = [item for item in (items if op == 'trimleft' else other) if type(item) is HLSSegment]
+            if not pool:
+                continue
+            until = rnd.choice(pool)
+            until = HLSSegment(until.checksum, until.url, until.duration, until.datetime)
+            states.append((op, items.trimleft(until), state(items)))
+    return states
+
+
+class SegmentsListTest(unittest.TestCase):
+
+    def test_duplicate_after_first_copy_popped(self):
+        for cls in (ScanningSegmentsList, SegmentsList):
+            items = segments(cls, range(20, 28))
+            items.extend(segments(list, range(19, 27)), force=True)
+            items.trimleft(HLSSegment(26))
+            items.extend(segments(list, range(18, 26)), force=True)
+            self.assertEqual(items.trimleft(HLSSegment(21)), 5, cls.__name__)
+
+    def test_extendleft_matches_last_occurrence(self):
+        for cls in (ScanningSegmentsList, SegmentsList):
+            items = segments(cls, [5, 6, 7])
+            items.extendleft(segments(cls, [3, 5, 4, 5]))
+            self.assertEqual([item.checksum for item in items], [3, 5, 4, 5, 6, 7], cls.__name__)
+
+    def test_random_splices(self):
+        for seed in range(2000):
+            expected = run_ops(ScanningSegmentsList, random.Random(seed))
+            actual = run_ops(SegmentsList, random.Random(seed))
+            self.assertEqual(actual, expected, 'seed %i' % seed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+import os, json, time, logging
+import asyncio
+
+# Minimal Prometheus style metrics: counters, gauges and histograms with labels, rendered in
+# Prometheus text exposition format. Feed processes periodically write snapshots of their metrics
+# to a directory, the chunk server merges all snapshots when /metrics is requested.
+
+logger = logging.getLogger(__name__)
+
+latency_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+throughput_buckets = (1e4, 1e5, 5e5, 1e6, 2e6, 5e6, 1e7, 2e7, 5e7, 1e8)
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in labels)
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if type(value) is float and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class MetricChild:
+    """Metric bound to label values"""
+    def __init__(self, metric, key):
+        self.metric = metric
+        self.key = key
+    def inc(self, amount=1):
+        self.metric.inc(self.key, amount)
+    def dec(self, amount=1):
+        self.metric.inc(self.key, -amount)
+    def set(self, value):
+        self.metric.set(self.key, value)
+    def observe(self, value):
+        self.metric.observe(self.key, value)
+
+
+class Metric:
+    type = None
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}    # label values tuple -> value
+        if registry is None:
+            registry = REGISTRY
+        if registry is not False:
+            registry.register(self)
+    def labels(self, **labels):
+        return MetricChild(self, tuple(str(labels[name]) for name in self.labelnames))
+    def inc(self, key=(), amount=1):
+        self.values[key] = self.values.get(key, 0) + amount
+    def set(self, key=(), value=0):
+        self.values[key] = value
+    def remove(self, **labels):
+        self.values.pop(tuple(str(labels[name]) for name in self.labelnames), None)
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, tuple(zip(self.labelnames, key)), value
+    def dump(self):
+        return dict(name=self.name, type=self.type, help=self.documentation, labelnames=self.labelnames,
+                    values=[[list(key), value] for key, value in self.values.items()])
+    def merge(self, values):
+        for key, value in values:
+            self.inc(tuple(key), value)
+
+
+class Counter(Metric):
+    """Monotonic counter; set() is meant for mirroring totals counted elsewhere"""
+    type = 'counter'
+
+
+class Gauge(Metric):
+    type = 'gauge'
+    def merge(self, values):
+        for key, value in values:
+            self.set(tuple(key), value)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    def __init__(self, name, documentation, labelnames=(), buckets=latency_buckets, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+    def observe(self, key=(), value=0):
+        data = self.values.get(key)
+        if data is None:
+            data = self.values[key] = [[0]*len(self.buckets), 0.0, 0]     # bucket counts, sum, count
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[0][i] += 1
+                break
+        data[1] += value
+        data[2] += 1
+    def samples(self):
+        for key, (counts, total, count) in sorted(self.values.items()):
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield self.name+'_bucket', labels+(('le', format_value(float(bound))),), cumulative
+            yield self.name+'_bucket', labels+(('le', '+Inf'),), count
+            yield self.name+'_sum', labels, total
+            yield self.name+'_count', labels, count
+    def dump(self):
+        return dict(super().dump(), buckets=self.buckets)
+    def merge(self, values):
+        for key, (counts, total, count) in values:
+            data = self.values.setdefault(tuple(key), [[0]*len(self.buckets), 0.0, 0])
+            data[0] = [a+b for a, b in zip(data[0], counts)]
+            data[1] += total
+            data[2] += count
+
+
+class Registry:
+    types = dict(counter=Counter, gauge=Gauge, histogram=Histogram)
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+    def add_collector(self, collector):
+        """Add function called before metrics are rendered or dumped (e.g. to update gauges)"""
+        self.collectors.append(collector)
+    def reset(self):
+        """Forget values and collectors (forked process: metrics of parent are reported by parent)"""
+        for metric in self.metrics.values():
+            metric.values.clear()
+        self.collectors = []
+    def collect(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.warning('Metrics collector failed: %s' % e)
+    def dump(self):
+        self.collect()
+        return [metric.dump() for metric in self.metrics.values()]
+    def merge(self, dump):
+        """Merge metrics dumped by another registry: counters and histograms are summed, gauges replaced"""
+        for data in dump:
+            metric = self.metrics.get(data['name'])
+            if metric is None:
+                kwargs = dict(buckets=data['buckets']) if data['type'] == 'histogram' else {}
+                metric = self.types[data['type']](data['name'], data['help'], data['labelnames'], registry=self, **kwargs)
+            metric.merge(data['values'])
+    def render(self, collect=True):
+        if collect:
+            self.collect()
+        output = []
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            output.append('# HELP %s %s' % (name, metric.documentation.replace('\\', r'\\').replace('\n', r'\n')))
+            output.append('# TYPE %s %s' % (name, metric.type))
+            for sample, labels, value in metric.samples():
+                output.append('%s%s %s' % (sample, format_labels(labels), format_value(value)))
+        return '\n'.join(output) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def write_snapshot(path, registry=REGISTRY):
+    """Write metrics snapshot atomically"""
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(dict(time=time.time(), pid=os.getpid(), metrics=registry.dump()), f)
+    os.replace(path + '.tmp', path)
+
+async def write_snapshots(path, interval=5, registry=REGISTRY):
+    """Periodically write metrics snapshot of this process (run as task in feed process)"""
+    while True:
+        try:
+            write_snapshot(path, registry)
+        except Exception as e:
+            logger.warning('Unable to write metrics snapshot %s: %s' % (path, e))
+        await asyncio.sleep(interval)
+
+def read_snapshots(dirname, max_age=60):
+    """Read all snapshots from directory, skip snapshots not updated in max_age seconds (stopped processes)"""
+    snapshots = []
+    now = time.time()
+    try:
+        filenames = os.listdir(dirname)
+    except FileNotFoundError:
+        return snapshots
+    for filename in filenames:
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(dirname, filename)) as f:
+                snapshot = json.load(f)
+            if now - snapshot['time'] <= max_age:
+                snapshots.append(snapshot)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning('Unable to read metrics snapshot %s: %s' % (filename, e))
+    return snapshots
+
+def render_all(dirname, registry=REGISTRY, max_age=60):
+    """Render metrics of this process merged with snapshots of other processes"""
+    merged = Registry()
+    merged.merge(registry.dump())
+    for snapshot in read_snapshots(dirname, max_age):
+        if snapshot.get('pid') != os.getpid():     # own snapshot (serving worker) is older than registry
+            merged.merge(snapshot['metrics'])
+    return merged.render(collect=False)
+
+
+if __name__ == "__main__":
+
+    import sys
+
+    if len(sys.argv) == 1:
+        print('usage: %s [metrics snapshot directory]' % sys.argv[0])
+        sys.exit(0)
+
+    print(render_all(sys.argv[1]), end='')
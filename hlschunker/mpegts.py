@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+import os, sys
+
+# Pure Python MPEG-TS demuxing for audio extraction: keeps PAT, PMT and packets of one audio
+# elementary stream. Output is either transport stream with PMT rewritten to the audio stream only,
+# or raw ADTS (AAC audio). Input is processed in chunks, so segments can be extracted while streaming.
+
+TS_PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+PAT_PID = 0x0000
+NULL_PID = 0x1fff
+
+audio_stream_types = {0x03: 'mp3', 0x04: 'mp3', 0x0f: 'aac', 0x11: 'aac_latm', 0x81: 'ac3', 0x87: 'eac3'}
+# private data streams (stream type 0x06) with these descriptors are audio: DVB AC-3, enhanced AC-3, AAC
+audio_descriptors = {0x6a: 'ac3', 0x7a: 'eac3', 0x7c: 'aac'}
+language_descriptor = 0x0a
+extensions = dict(ts='.audio.ts', adts='.aac')
+
+
+class MPEGTSException(Exception):
+    pass
+
+
+def make_crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for j in range(8):
+            crc = ((crc << 1) ^ 0x04c11db7 if crc & 0x80000000 else crc << 1) & 0xffffffff
+        table.append(crc)
+    return table
+
+crc_table = make_crc_table()
+
+def crc32_mpeg2(data, crc=0xffffffff):
+    """CRC of PSI sections (CRC-32/MPEG-2)"""
+    for byte in data:
+        crc = ((crc << 8) & 0xffffffff) ^ crc_table[(crc >> 24) ^ byte]
+    return crc
+
+def audio_path(path, format='ts'):
+    """Path of audio extracted from segment path"""
+    return os.path.splitext(path)[0] + extensions[format]
+
+
+class AudioExtractor:
+    """Streaming audio extractor: feed() transport stream data, returns extracted data so far"""
+    def __init__(self, format='ts', language=None):
+        if format not in extensions:
+            raise ValueError('unknown audio format: %s' % format)
+        self.format = format
+        self.language = language        # preferred audio language (ISO 639 code), first audio stream otherwise
+        self.pmt_pids = set()
+        self.audio_pid = None
+        self.codec = None
+        self.sections = {}              # PID -> incomplete PSI section
+        self.pmt_packet = None          # rewritten PMT packet (without continuity counter)
+        self.pmt_continuity = 0
+        self.remainder = b''            # incomplete packet of previous data
+        self.packets = 0
+        self.kept = 0
+
+    def feed(self, data):
+        if self.remainder:
+            data = self.remainder + data
+        end = len(data) - len(data) % TS_PACKET_SIZE
+        self.remainder = data[end:]
+        view = memoryview(data)
+        output = []
+        audio_pid = self.audio_pid
+        ts = self.format == 'ts'
+        for offset in range(0, end, TS_PACKET_SIZE):
+            if data[offset] != SYNC_BYTE:
+                raise MPEGTSException('sync byte not found at offset %i' % (self.packets * TS_PACKET_SIZE))
+            self.packets += 1
+            pid = ((data[offset+1] & 0x1f) << 8) | data[offset+2]
+            if pid == audio_pid:
+                self.kept += 1
+                if ts:
+                    output.append(view[offset:offset+TS_PACKET_SIZE])
+                else:
+                    output.append(self.elementary_payload(data, view, offset))
+            elif pid == PAT_PID:
+                section = self.section(data, offset, pid)
+                if section:
+                    self.parse_pat(section)
+                if ts:
+                    self.kept += 1
+                    output.append(view[offset:offset+TS_PACKET_SIZE])
+            elif pid in self.pmt_pids:
+                section = self.section(data, offset, pid)
+                if section:
+                    self.parse_pmt(section, data[offset+1:offset+3])
+                    audio_pid = self.audio_pid
+                    if ts and self.pmt_packet:
+                        self.kept += 1
+                        output.append(self.pmt_packet[:3] + bytes([0x10 | self.pmt_continuity]) + self.pmt_packet[4:])
+                        self.pmt_continuity = (self.pmt_continuity + 1) & 0x0f
+        return b''.join(output)
+
+    def close(self):
+        """Finish extraction, returns remaining data"""
+        if self.audio_pid is None:
+            raise MPEGTSException('no audio stream found')
+        self.remainder = b''
+        return b''
+
+    @staticmethod
+    def payload_start(data, offset):
+        control = data[offset+3] & 0x30
+        start = offset + 4
+        if control & 0x20:      # adaptation field
+            start += 1 + data[offset+4]
+        if not control & 0x10:  # no payload
+            return offset + TS_PACKET_SIZE
+        return start
+
+    def elementary_payload(self, data, view, offset):
+        start = self.payload_start(data, offset)
+        if data[offset+1] & 0x40 and start + 9 <= offset + TS_PACKET_SIZE:
+            # payload unit start: skip PES header
+            start += 9 + data[start+8]
+        return view[min(start, offset+TS_PACKET_SIZE):offset+TS_PACKET_SIZE]
+
+    def section(self, data, offset, pid):
+        """Collect PSI section from packets, returns complete section or None"""
+        start = self.payload_start(data, offset)
+        end = offset + TS_PACKET_SIZE
+        if data[offset+1] & 0x40:
+            # payload unit start: pointer field to section start
+            buffer = self.sections[pid] = bytearray(data[start+1+data[start]:end])
+        elif pid in self.sections:
+            buffer = self.sections[pid]
+            buffer += data[start:end]
+        else:
+            return None
+        if len(buffer) < 3:
+            return None
+        length = 3 + (((buffer[1] & 0x0f) << 8) | buffer[2])
+        if len(buffer) < length:
+            return None
+        del self.sections[pid]
+        section = bytes(buffer[:length])
+        if crc32_mpeg2(section) != 0:
+            raise MPEGTSException('PSI section CRC mismatch (PID %i)' % pid)
+        return section
+
+    def parse_pat(self, section):
+        for i in range(8, len(section) - 4, 4):
+            program = (section[i] << 8) | section[i+1]
+            if program:
+                self.pmt_pids.add(((section[i+2] & 0x1f) << 8) | section[i+3])
+
+    def parse_pmt(self, section, pid_bytes):
+        pcr_pid = ((section[8] & 0x1f) << 8) | section[9]
+        info_length = ((section[10] & 0x0f) << 8) | section[11]
+        i = 12 + info_length
+        audio = []
+        while i < len(section) - 4:
+            stream_type = section[i]
+            pid = ((section[i+1] & 0x1f) << 8) | section[i+2]
+            es_info_length = ((section[i+3] & 0x0f) << 8) | section[i+4]
+            descriptors = section[i+5:i+5+es_info_length]
+            codec = audio_stream_types.get(stream_type)
+            language = None
+            j = 0
+            while j + 2 <= len(descriptors):
+                tag, length = descriptors[j], descriptors[j+1]
+                if tag == language_descriptor and length >= 3:
+                    language = descriptors[j+2:j+5].decode('latin-1')
+                elif stream_type == 0x06 and tag in audio_descriptors:
+                    codec = audio_descriptors[tag]
+                j += 2 + length
+            if codec:
+                audio.append((pid, codec, language, section[i:i+5+es_info_length]))
+            i += 5 + es_info_length
+        if not audio:
+            raise MPEGTSException('no audio stream in program map table')
+        selected = audio[0]
+        if self.language:
+            selected = next((stream for stream in audio if stream[2] and stream[2].lower() == self.language.lower()), selected)
+        pid, codec, language, entry = selected
+        if self.format == 'adts' and codec != 'aac':
+            raise MPEGTSException('audio stream codec is %s, ADTS output requires AAC' % codec)
+        self.audio_pid, self.codec = pid, codec
+        if self.format == 'ts':
+            # program map with the audio stream only; PCR of dropped (video) stream is not available
+            body = section[3:8] + bytes([0xe0 | (NULL_PID if pcr_pid != pid else pid) >> 8,
+                                         (NULL_PID if pcr_pid != pid else pid) & 0xff]) \
+                   + section[10:12+info_length] + entry
+            length = len(body) + 4
+            new = bytes([section[0], 0xb0 | (length >> 8), length & 0xff]) + body
+            new += crc32_mpeg2(new).to_bytes(4, 'big')
+            if len(new) > TS_PACKET_SIZE - 5:
+                raise MPEGTSException('rewritten program map table does not fit into packet')
+            header = bytes([SYNC_BYTE, 0x40 | (pid_bytes[0] & 0x1f), pid_bytes[1], 0x10])
+            self.pmt_packet = header + b'\x00' + new + b'\xff' * (TS_PACKET_SIZE - 5 - len(new))
+
+
+def extract_audio(data, format='ts', language=None):
+    extractor = AudioExtractor(format, language)
+    return extractor.feed(data) + extractor.close()
+
+def extract_audio_file(source, target, format='ts', language=None, chunk_size=1024*TS_PACKET_SIZE):
+    """Extract audio from source file to target file (written atomically, may be the same as source);
+    returns sizes of source and target. Meant to run in worker process."""
+    extractor = AudioExtractor(format, language)
+    size = written = 0
+    try:
+        with open(source, 'rb') as src, open(target + '.tmp', 'wb') as dst:
+            while True:
+                data = src.read(chunk_size)
+                if not data:
+                    break
+                size += len(data)
+                output = extractor.feed(data)
+                written += len(output)
+                dst.write(output)
+            output = extractor.close()
+            written += len(output)
+            dst.write(output)
+        os.replace(target + '.tmp', target)
+    except:
+        if os.path.exists(target + '.tmp'):
+            os.remove(target + '.tmp')
+        raise
+    return size, written
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Extract audio from MPEG-TS file', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('source', type=str, help='MPEG-TS file')
+    parser.add_argument('target', type=str, nargs='?', help='output file (default: source with .audio.ts or .aac extension)')
+    parser.add_argument('--format', type=str, default='ts', choices=sorted(extensions), help='output format')
+    parser.add_argument('--language', type=str, help='audio stream language (ISO 639 code)')
+
+    args = parser.parse_args()
+
+    size, written = extract_audio_file(args.source, args.target or audio_path(args.source, args.format),
+                                       args.format, args.language)
+    print('%i -> %i bytes (%.1f%%)' % (size, written, written * 100 / size if size else 0), file=sys.stderr)
@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 
-import sys, os, json
+import sys, os, json, time
 from collections import namedtuple
 from datetime import datetime, timedelta
 import asyncio
 import logging
 import concurrent.futures
+from urllib.parse import urlparse
 
 # for debugging
 from inspect import currentframe, getframeinfo
@@ -17,29 +18,107 @@ from aiohttp.errors import *
 # local
 from index import *
 from yaml_storage import *
-from storage import request as download
+from storage import request as download, OriginClock, parse_http_datetime, preconnect, close_client_session
+from backfill import Backfill
+from handover import wait_released
+import metrics
+import tracing
 
 logger = logging.getLogger(__name__)
 
+playlist_refresh_seconds = metrics.Histogram('hlschunker_playlist_refresh_seconds',
+                                             'Playlist download and parse time', ['feed'])
+playlist_last_refresh = metrics.Gauge('hlschunker_playlist_last_refresh_timestamp_seconds',
+                                      'Time of last successful playlist refresh', ['feed'])
+playlist_age = metrics.Gauge('hlschunker_playlist_age_seconds',
+                             'Seconds since last successful playlist refresh', ['feed'])
+
+time_to_first_segment = metrics.Gauge('hlschunker_time_to_first_segment_seconds',
+                                      'Time from feed process start to first stored segment', ['feed'])
+
+clocks_dirname = '.clocks'     # in data directory
+
+
+class StartupTimer:
+    """Time to first stored segment of feed, by startup phase"""
+    def __init__(self, feed, started=None):
+        self.feed = feed
+        self.started = started or time.time()
+        self.last = self.started
+        self.phases = []
+        self.done = False
+    def phase(self, name):
+        now = time.time()
+        self.phases.append((name, now - self.last))
+        self.last = now
+    def first_segment(self):
+        if self.done:
+            return
+        self.done = True
+        self.phase('first_segment')
+        total = self.last - self.started
+        time_to_first_segment.labels(feed=self.feed).set(total)
+        logger.info('Stream %s: first segment stored %.2fs after start (%s)'
+                    % (self.feed, total, ', '.join('%s %.2fs' % phase for phase in self.phases)))
+
 class HLSPull:
 
     def __init__(self, url, root, chunk_notifier=None, chunk_size=5*60, ext='ts',
-                 parallel_downloads=4, loop=None, metadata=None):
+                 parallel_downloads=4, loop=None, metadata=None, hedge=None,
+                 max_queued=100, budget=None,
+                 bandwidth_limit=None, throttle=None, reorder=None, variant=None, extract_audio=None,
+                 deduplicate=None, pack_chunks=None, backfill=None, verify_existing=False, clock_dir=None,
+                 start_delay=0, started=None, released=None):
         self.url = url
+        self.master_url = url   # as configured: master or media playlist URL
+        # variant: selection policy for master playlist, 'lowest', 'highest', 'bitrate', 'audio'
+        # or dict(select=..., bitrate=<bits per second>, language=<code>)
+        self.variant = dict(select=variant) if type(variant) is str else dict(variant or {})
         self.root = root
         self.loop = loop
         self.metadata = metadata
+        # origin clock offsets, shared by feeds in data directory
+        self.clock_dir = clock_dir or os.path.join(os.path.dirname(os.path.abspath(root)), clocks_dirname)
+        self.clocks = {}
+        # warm start: origin is resolved and connected during start_delay (staggered start of many feeds),
+        # started: time of feed process start
+        self.start_delay = start_delay
+        # released: multiprocessing Event of feed taken over from other instance (handover), set when
+        # that one closed the lists; playlist is requested meanwhile, lists are loaded once it is set
+        self.released = released
+        stream_id = metadata.get('id') if metadata and isinstance(metadata, dict) else metadata
+        self.startup = StartupTimer(stream_id, started)
         
         # formatter = YAMLPathFormatter('%Y-%m-%d/%H/{seq}.{ext}', '', '%Y-%m-%d/%H', ext=ext)
         # segments_list = SegmentsListYAMLStorage(root, formatter)
         self.storage = YAMLSegmentsStorage(
             root, chunk_notifier=chunk_notifier, chunk_size=chunk_size, ext=ext,
-            parallel_downloads=parallel_downloads, loop=loop, metadata=metadata)
+            parallel_downloads=parallel_downloads, loop=loop, metadata=metadata, hedge=hedge,
+            max_queued=max_queued, budget=budget,
+            bandwidth_limit=bandwidth_limit, throttle=throttle, reorder=reorder, extract_audio=extract_audio,
+            deduplicate=deduplicate, pack_chunks=pack_chunks, verify_existing=verify_existing)
+        # backfill: True or dict(parallel_downloads=<number>, start=<datetime>), complete playlists
+        # are stored by Backfill instead of live path
+        if backfill:
+            backfill = dict(backfill) if type(backfill) is dict else {}
+            stream_id = metadata.get('id') if metadata and isinstance(metadata, dict) else metadata
+            self.backfill = Backfill(self.storage, loop=loop, feed=stream_id, **backfill)
+        else:
+            self.backfill = None
+        self.storage.on_first_segment = self.startup.first_segment
+        self.startup.phase('init')     # resume state of lists loaded
         
         self.default_sleep = 5
         self.sleeping = set()
+        self.live_edge = 3          # segments within that many target durations from live edge go first
+
+        stream_id = metadata.get('id') if metadata and isinstance(metadata, dict) else metadata
+        self.refresh_seconds = playlist_refresh_seconds.labels(feed=stream_id)
+        self.last_refresh = None
+        metrics.REGISTRY.add_collector(self.collect_metrics)
 
         self._stop = False
+        self.handover = False       # stopped for other instance to continue the feed
 
     @property
     def stop(self):
@@ -58,7 +137,12 @@ class HLSPull:
             duration = self.default_sleep
         sleep_future = asyncio.ensure_future(asyncio.sleep(duration, loop=loop), loop=loop)
         self.sleeping.add(sleep_future)
-        await sleep_future
+        try:
+            await sleep_future
+        except asyncio.CancelledError:
+            # cancelled by stop: caller checks stop and finishes (waits for downloads)
+            if not self.stop:
+                raise
         if sleep_future in self.sleeping:
             self.sleeping.remove(sleep_future)
 
@@ -68,7 +152,8 @@ class HLSPull:
         # for i in range(4):
         while not self.stop:
             try:
-                return await download(url)
+                response, sent, received = await self.timed_request(url)
+                return response
             except (ClientOSError, ClientResponseError, ServerDisconnectedError,
                     concurrent.futures.TimeoutError) as e:
                 if self.stop:
@@ -81,23 +166,115 @@ class HLSPull:
             #     print('downloader keyboard interrupt')
             #     raise
 
+    def collect_metrics(self):
+        if self.last_refresh:
+            stream_id = self.metadata.get('id') if self.metadata and isinstance(self.metadata, dict) else self.metadata
+            playlist_last_refresh.labels(feed=stream_id).set(self.last_refresh)
+            playlist_age.labels(feed=stream_id).set(time.time() - self.last_refresh)
+
+    async def store(self, segments, index):
+        """Pass all items to storage; segments close to the live edge are downloaded first, and each
+        segment's download deadline is the time it is expected to drop out of the source live window"""
+        live = not index.complete
+        target_duration = getattr(index, 'duration', None) or 10
+        window = sum(item.duration for item in index.segments if type(item) is HLSSegment)
+        now = time.time()
+        schedule = []
+        after = 0       # duration of segments following the item (distance from live edge)
+        for item in reversed(segments):
+            if type(item) is HLSSegment:
+                if live:
+                    priority = 0 if after < self.live_edge * target_duration else 1
+                    deadline = now + max(window - after, item.duration) + target_duration
+                else:
+                    priority, deadline = 0, None
+                after += item.duration
+                schedule.append((priority, deadline))
+            else:
+                schedule.append((0, None))
+        schedule.reverse()
+        for priority, deadline in schedule:
+            await self.storage.ready()
+            if self.stop:
+                # released by stop: remaining segments are left for next poll (or next instance)
+                break
+            self.storage.store(segments.popleft(), priority, deadline)
+        stats = self.storage.scheduler.stats
+        if stats['queued']:
+            logger.debug('Download queue for %s: %i running, %i queued, %i expired, wait time avg %.2fs max %.2fs'
+                         % (self.url, stats['running'], stats['queued'], stats['expired'],
+                            stats['avg_wait_time'], stats['max_wait_time']))
+
     async def wait(self):
         if self.storage.scheduler:
             logger.info('Waiting for downloaders to complete.')
             await self.storage.scheduler.wait()
+        await self.storage.list.drain(end_chunk=not self.handover)
         self.storage.list.close()
+        await close_client_session()
+
+    async def warm_up(self):
+        """Resolve origin host and open connection to it while waiting for start delay"""
+        delay = asyncio.ensure_future(self.sleep(self.start_delay)) if self.start_delay else None
+        try:
+            await preconnect(self.master_url)
+        except Exception as e:
+            logger.info('Unable to preconnect to %s: %s' % (self.master_url, e))
+        self.startup.phase('preconnect')
+        if delay:
+            try:
+                await delay
+            except asyncio.CancelledError:
+                pass
+            self.startup.phase('delay')
+
+    async def resolve(self):
+        """Download configured playlist; for master playlist select variant and download its media playlist.
+        Returns media playlist response"""
+        response = await self.download(self.master_url)
+        if not response or response.status != 200:
+            return response
+        index = HLSIndex.parse(response.content, self.master_url.rsplit('/',1)[0]+'/')
+        if not index.streams:
+            self.url = self.master_url
+            return response
+        variant = index.select_variant(**self.variant)
+        if variant is None:
+            raise HLSIndexException('no variant to select in master playlist %s' % self.master_url)
+        if variant.url != self.url:
+            logger.info('Using variant %s of %s: %s' % (variant.url, self.master_url, variant.source))
+        self.url = variant.url
+        return await self.download(self.url)
 
     async def __call__(self, run_forever=False):
-        base = self.url.rsplit('/',1)[0]+'/'
-        response = await download(self.url)
-        if response.status != 200:
+        await self.warm_up()
+        if self.stop:
+            if self.released is None:
+                await self.wait()   # lists of feed taken over are left to other instance
+            return
+        response = await self.resolve()
+        self.startup.phase('playlist')
+        if not response or response.status != 200:
             # raise Exception('HTTP Error: %s' % response.status)
-            logger.warning("HTTP Error %s for URL %s"%(response.status, self.url))
+            logger.warning("HTTP Error %s for URL %s"%(response.status if response else None, self.url))
             return
+        base = self.url.rsplit('/',1)[0]+'/'
         index = HLSIndex.parse(response.content, base)
         if not index.segments or not index.segments.first_segment:
             return
 
+        if self.released is not None:
+            # timeline continues from the segments stored by other instance: no change detection needed
+            # unless its last segment is not in the playlist
+            if not await wait_released(self.released, lambda: self.stop):
+                return
+            self.storage.reload()
+            self.startup.phase('released')
+            # other instance may have stored segments of newer playlist while draining
+            response = await self.download(self.url)
+            if response and response.status == 200:
+                index.segments.extend(HLSIndex.parse(response.content, base).segments)
+
         if self.storage.list.last_segment:
             popped = index.segments.trimleft(self.storage.list.last_segment)
             # if popped == 0 and type(index.segments[0]) is not HLSSourceDiscontinuity:
@@ -113,12 +290,14 @@ class HLSPull:
             latest_index = HLSIndex.parse(response.content, base)
             latest_index.segments.extendleft(index.segments).apply_end_datetime(end_datetime)
             index = latest_index
+            self.startup.phase('detect_change')
 
         segments = index.segments
 
-        while segments:
-            item = segments.popleft()
-            self.storage.store(item)
+        if index.complete and self.backfill:
+            await self.backfill(self.url, segments)
+        else:
+            await self.store(segments, index)
 
         # calculate sleep duration between updates
         self.default_sleep = index.duration/2 or (index.last.duration/2 if index.last else 5)
@@ -139,11 +318,24 @@ class HLSPull:
                 break
             try:
                 # print('>>> Refresh index...')
+                refresh_start = time.time()
                 response = await self.download(self.url)
+                if response and response.status in (403, 404, 410) and self.url != self.master_url:
+                    # origin rotated variant URLs, select variant again
+                    logger.info('HTTP Error %s for variant %s, resolving %s' % (response.status, self.url, self.master_url))
+                    response = await self.resolve()
+                    base = self.url.rsplit('/',1)[0]+'/'
                 if not response or response.status != 200:
                     raise Exception("HTTP Error %s for URL %s" % (response.status, self.url))
-                index = HLSIndex.parse(response.content, base)
-                if index.sequence < prev_index.sequence or segments.extend(index.segments) is None:
+                with tracing.span('parse', url=self.url):
+                    index = HLSIndex.parse(response.content, base)
+                self.last_refresh = time.time()
+                self.refresh_seconds.observe(self.last_refresh - refresh_start)
+                discontinuity = index.sequence < prev_index.sequence
+                if not discontinuity:
+                    with tracing.span('extend', items=len(index.segments)):
+                        discontinuity = segments.extend(index.segments) is None
+                if discontinuity:
                     logger.info("Discontinuity for URL %s"%self.url)
                     if not item_type(segments.last_item or segments.last_removed_item,
                                      (HLSSourceEnd, HLSDiscontinuity)):
@@ -154,9 +346,7 @@ class HLSPull:
                     prev_index = index
                     index = latest_index
                     segments.extend(index.segments, True)
-                while segments:
-                    item = segments.popleft()
-                    self.storage.store(item)
+                await self.store(segments, index)
                 if not run_forever:
                     live_updates = not index.complete
             except Exception as e:
@@ -171,50 +361,95 @@ class HLSPull:
         # wait for downloads to complete
         await self.wait()
 
-    @staticmethod
-    async def detect_change(url, target_duration=None, sleep=0.3, count=None):
-
-        def parse_datetime(datetime_string, default=None):
-            if datetime_string:
-                for fmt in ['%a, %d %b %Y %H:%M:%S %Z']:
-                    try:
-                        return datetime.strptime(datetime_string, fmt)
-                    except ValueError:
-                        pass
-            return default
+    def origin_clock(self, url):
+        """Clock offset of origin host of url (shared by feeds of the same host)"""
+        host = urlparse(url).netloc
+        if host not in self.clocks:
+            self.clocks[host] = OriginClock(os.path.join(self.clock_dir, host + '.json') if self.clock_dir else None)
+        return self.clocks[host]
+
+    async def timed_request(self, url, headers=None):
+        """Request url, response Date header is sampled to origin clock; returns response and local UTC
+        times when request was sent and response received"""
+        sent = datetime.utcnow()
+        response = await download(url, headers=headers)
+        received = datetime.utcnow()
+        self.origin_clock(url).sample(parse_http_datetime(response.headers.get('DATE')), sent, received)
+        return response, sent, received
+
+    async def detect_change(self, url, target_duration=None, sleep=0.3, count=None):
+        """Estimate origin date-time of end of live playlist without EXT-X-PROGRAM-DATE-TIME, returns
+        latest response and the estimate. Last-Modified of playlist is used if plausible, otherwise playlist
+        is polled (conditional requests if origin supports them) until it changes. Time of change is
+        taken from origin clock if its offset is known accurately, from Date headers otherwise."""
+        target_duration = target_duration or 10
+        clock = self.origin_clock(url)
 
         print('Guessing live stream date-time from server time ...')
-        first = await download(url)
+        first, sent, received = await self.timed_request(url)
         if first.status != 200:
-            raise Exception("HTTP Error %s for URL %s" % (first.status, self.url))
+            raise Exception("HTTP Error %s for URL %s" % (first.status, url))
+        first_dt = parse_http_datetime(first.headers.get('DATE'))
+        modified = parse_http_datetime(first.headers.get('LAST-MODIFIED'))
+        if modified and first_dt and timedelta(0) <= first_dt - modified <= timedelta(seconds=target_duration):
+            # playlist was modified when its last segment was added
+            logger.info('Using playlist Last-Modified for live stream date-time annotation '+
+                        'with accuracy +/- 0.5 seconds')
+            return first, modified + timedelta(seconds=0.5)
+        headers = {}
+        if first.headers.get('ETAG'):
+            headers['If-None-Match'] = first.headers.get('ETAG')
+        if first.headers.get('LAST-MODIFIED'):
+            headers['If-Modified-Since'] = first.headers.get('LAST-MODIFIED')
         if count is None:
-            count = (target_duration or 10) * 3 / sleep  # wait for max 3 segment durations to detect change in live stream index
+            count = target_duration * 3 / sleep  # wait for max 3 segment durations to detect change in live stream index
         second = first
         while count > 0:
             await asyncio.sleep(sleep)
-            second = await download(url)
-            if second.status != 200:
-                raise Exception("HTTP Error %s for URL %s" % (second.status, self.url))
-            if first.content != second.content:
+            previous_sent = sent
+            response, sent, received = await self.timed_request(url, headers)
+            if response.status not in (200, 304):
+                raise Exception("HTTP Error %s for URL %s" % (response.status, url))
+            if response.status == 200 and response.content != first.content:
+                second = response
                 break
-            first = second
+            first_dt = parse_http_datetime(response.headers.get('DATE'), first_dt)
             count -= 1
-        if first.content == second.content:
+        if second is first:
             # no content change detected
             raise ValueError('unable to detect change')
-        first_dt = parse_datetime(first.headers.get('DATE'), datetime.utcnow())
-        second_dt = parse_datetime(second.headers.get('DATE'), datetime.utcnow())
-        end_datetime = second_dt - timedelta(seconds=(second_dt-first_dt).seconds/2)    # half between
+        if clock.offset is not None and clock.accuracy < sleep:
+            # change happened after previous request was sent, before response was received
+            end_datetime = clock.now(previous_sent + (received - previous_sent) / 2)
+            accuracy = (received - previous_sent).total_seconds() / 2 + clock.accuracy
+        else:
+            first_dt = first_dt or datetime.utcnow()
+            second_dt = parse_http_datetime(second.headers.get('DATE'), datetime.utcnow())
+            end_datetime = second_dt - timedelta(seconds=(second_dt-first_dt).total_seconds()/2)    # half between
+            accuracy = sleep
         logger.info('Using server time for live stream date-time annotation '+
-                    'with accuracy +/- %d seconds'%sleep)
+                    'with accuracy +/- %.2f seconds' % accuracy)
         return second, end_datetime
 
 
+handover_stop = 2   # value of stop flag: feed is handed over, chunk in progress is left open
+
+
+async def watch_stop(pull, stop, interval=1):
+    """Stop pull when shared flag stop (multiprocessing Value) is set by other process"""
+    while not stop.value and not pull.stop:
+        await asyncio.sleep(interval)
+    pull.handover = stop.value == handover_stop
+    pull.stop = True
+
+
 def run_pull(pull, loop=None, run_forever=True):
     if loop is None:
         loop = asyncio.get_event_loop()
     try:
-        loop.run_until_complete(pull(run_forever))
+        loop.run_until_complete(pull(run_forever))   # stopped by feed manager: downloads drained (see watch_stop)
+        if pull.stop:
+            logger.info('Stopped pulling feed %s' % pull.url)
     except KeyboardInterrupt:
         # how to correctly handle loop interruption
         # http://stackoverflow.com/a/30766124
@@ -235,16 +470,33 @@ if __name__ == "__main__":
     
     parser = ArgumentParser(description='HLS Stream Pull',
                             formatter_class=ArgumentDefaultsHelpFormatter)
-    # parser.add_argument('--audio-only', action='store_true', help='use audio only stream')
+    parser.add_argument('--audio-only', action='store_true', help='use audio only stream (of master playlist)')
+    parser.add_argument('--language', type=str, help='audio rendition language (with --audio-only)')
+    parser.add_argument('--extract-audio', type=str, choices=['ts', 'adts'],
+                        help='extract audio of segments as audio-only transport stream (.audio.ts) or ADTS (.aac)')
+    parser.add_argument('--bitrate', type=int, help='select highest variant not exceeding bitrate (bits per second)')
     parser.add_argument('path', type=str,
                         help='target directory where downloaded stream will be stored')
     parser.add_argument('url', type=str,
                         help='source HLS stream M3U8 index URL')
     parser.add_argument('--parallel-downloads', '-j', type=int, default=1, metavar="<number>",
                         help='number of parallel downloads')
+    parser.add_argument('--hedge', type=float, metavar='PERCENTILE',
+                        help='issue hedge request for downloads slower than this latency percentile')
+    parser.add_argument('--backfill', type=int, metavar='<number>',
+                        help='store complete playlist with that many parallel downloads (resumable)')
 
     args = parser.parse_args()
 
-    pull = HLSPull(args.url, args.path)
+    if args.audio_only:
+        variant = dict(select='audio', language=args.language)
+    elif args.bitrate:
+        variant = dict(select='bitrate', bitrate=args.bitrate)
+    else:
+        variant = None
+    pull = HLSPull(args.url, args.path, parallel_downloads=args.parallel_downloads,
+                   hedge=dict(percentile=args.hedge) if args.hedge else None, variant=variant,
+                   extract_audio=dict(format=args.extract_audio) if args.extract_audio else None,
+                   backfill=dict(parallel_downloads=args.backfill) if args.backfill else None)
 
     run_pull(pull)
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+
+import os, sys, json, time, shutil, logging
+import asyncio
+from datetime import datetime, timedelta
+from collections import namedtuple
+
+# local
+from yaml_storage import YAMLReader, YAMLWriter, YAMLChunkList, YAMLChunker, YAMLIndexedItemListWriter, ChunkPacker
+import metrics
+import mpegts
+
+# Retention of feed data: chunks older than max_age, oldest chunks exceeding max_bytes quota or
+# minimum free disk space are deleted. Expired chunks are found in chunks.yaml, their segments in
+# segments lists (master list and its sublists), so data directories are never walked. Lists are
+# trimmed first (nothing listed is missing), files are deleted afterwards in throttled batches.
+
+logger = logging.getLogger(__name__)
+
+retention_deleted_files = metrics.Counter('hlschunker_retention_deleted_files_total', 'Files deleted by retention', ['feed'])
+retention_reclaimed_bytes = metrics.Counter('hlschunker_retention_reclaimed_bytes_total',
+                                            'Disk space reclaimed by retention', ['feed'])
+retention_deleted_chunks = metrics.Counter('hlschunker_retention_deleted_chunks_total', 'Chunks deleted by retention',
+                                           ['feed', 'reason'])
+
+Chunk = namedtuple('Chunk', 'start, end, path, position')   # position: end of chunk actions in chunks.yaml
+
+
+def read_chunks(root):
+    """Completed chunks in chunks.yaml, oldest first"""
+    chunks = []
+    start = None
+    position = 0
+    try:
+        with open(os.path.join(root, YAMLChunkList.filename), 'rb') as f:
+            for line in f:
+                position += len(line)
+                item = YAMLReader.parse_line(line.decode('utf8'))
+                if type(item) is not list:
+                    continue
+                action = YAMLChunkList.ChunkAction(*item)
+                if action.action == 'start':
+                    start = action
+                elif action.action == 'end':
+                    chunks.append(Chunk(start.datetime if start and start.path == action.path else None,
+                                        YAMLReader.parse_datetime(action.datetime), action.path, position))
+                    start = None
+    except FileNotFoundError:
+        pass
+    return chunks
+
+def scan_list(dirname, cutoff):
+    """Segments of list in dirname older than cutoff: returns position where kept part of list starts,
+    paths (relative to dirname) of expired segments and whether all segments of list expired"""
+    cut = position = 0
+    paths = []
+    complete = True
+    try:
+        with open(os.path.join(dirname, YAMLIndexedItemListWriter.list_filename), 'rb') as f:
+            for line in f:
+                position += len(line)
+                item = YAMLReader.parse_line(line.decode('utf8'))
+                if type(item) is not list:
+                    continue    # tags stay with following segments
+                if YAMLReader.parse_datetime(item[3]) >= cutoff:
+                    complete = False
+                    break
+                paths.append(item[4])
+                cut = position
+    except FileNotFoundError:
+        pass
+    return cut, paths, complete
+
+def trim_file(path, cut):
+    """Remove first cut bytes of file (atomically replaced); returns size left"""
+    with open(path, 'rb') as src, open(path + '.tmp', 'wb') as dst:
+        src.seek(cut)
+        shutil.copyfileobj(src, dst)
+        size = dst.tell()
+    os.replace(path + '.tmp', path)
+    return size
+
+def trim_list(dirname, cut):
+    """Remove first cut bytes of segments list in dirname, index positions are shifted accordingly;
+    returns size of list left. Must not run concurrently with list writers (feed event loop)."""
+    list_path = os.path.join(dirname, YAMLIndexedItemListWriter.list_filename)
+    index_path = os.path.join(dirname, YAMLIndexedItemListWriter.index_filename)
+    if os.path.exists(index_path):
+        entries = []
+        with open(index_path, 'r') as f:
+            for line in f:
+                item = YAMLReader.parse_line(line)
+                if type(item) is list:
+                    entries.append(YAMLIndexedItemListWriter.IndexEntry(*item))
+        kept = [entry._replace(position=entry.position - cut) for entry in entries if entry.position >= cut]
+        covering = [entry for entry in entries if entry.position < cut]
+        if covering and (not kept or kept[0].position > 0):
+            # key of first kept items started in trimmed part
+            kept.insert(0, covering[-1]._replace(position=0))
+        with open(index_path + '.tmp', 'w') as f:
+            for entry in kept:
+                print('- %s' % json.dumps(list(entry), default=YAMLWriter.json_serialize), file=f)
+        os.replace(index_path + '.tmp', index_path)
+    return trim_file(list_path, cut)
+
+def remove_list(dirname):
+    for filename in (YAMLIndexedItemListWriter.list_filename, YAMLIndexedItemListWriter.index_filename):
+        try:
+            os.remove(os.path.join(dirname, filename))
+        except FileNotFoundError:
+            pass
+
+def segment_files(path):
+    """Segment file and files derived from it (extracted audio)"""
+    return [path] + [mpegts.audio_path(path, format) for format in sorted(mpegts.extensions)]
+
+def chunk_files(path):
+    return [path, ChunkPacker.packed_path(path)]
+
+def file_size(path):
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return 0
+
+def delete_files(paths):
+    """Delete files, returns number of deleted files and reclaimed bytes (hard linked files are not
+    reclaimed until the last link is deleted)"""
+    deleted = reclaimed = 0
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        deleted += 1
+        if stat.st_nlink == 1:
+            reclaimed += stat.st_size
+    return deleted, reclaimed
+
+def remove_empty_dirs(root, dirnames):
+    """Remove empty directories (deepest first) below root"""
+    for dirname in sorted(dirnames, key=len, reverse=True):
+        while dirname and dirname != root and os.path.commonpath([root, dirname]) == root:
+            try:
+                os.rmdir(dirname)
+            except OSError:
+                break
+            dirname = os.path.dirname(dirname)
+
+
+class Retention:
+    """Deletes expired data of feed in root directory. Runs in feed process (reopen: callback closing
+    list writers of feed after lists were trimmed) or standalone for stopped feed."""
+    def __init__(self, root, max_age=None, max_bytes=None, min_free_bytes=None, interval=600,
+                 batch_size=100, batch_pause=0.5, content_store=None, reopen=None, dry_run=False,
+                 loop=None, feed=None):
+        self.root = root
+        self.max_age = max_age                  # seconds
+        self.max_bytes = max_bytes              # quota of feed chunks (segments, extracted audio, packed chunks)
+        self.min_free_bytes = min_free_bytes    # free space on data file system
+        self.interval = interval                # seconds between runs
+        self.batch_size = batch_size            # files deleted at once
+        self.batch_pause = batch_pause          # seconds between batches, limits I/O load of deletion
+        self.content_store = content_store      # ContentStore of deduplicated segments, unlinked blobs are removed
+        self.reopen = reopen
+        self.dry_run = dry_run
+        self.loop = loop
+        self.feed = feed
+        self.chunk_sizes = {}                   # chunk path -> bytes (chunks are complete, so computed once)
+        self.deleted = 0
+        self.reclaimed = 0
+
+    def chunk_size(self, chunk):
+        if chunk.path not in self.chunk_sizes:
+            path = os.path.join(self.root, chunk.path)
+            size = sum(file_size(path) for path in chunk_files(path))
+            for segment in YAMLChunker.read_chunk_segments(path) or []:
+                if segment.offset is None:
+                    size += sum(file_size(os.path.join(self.root, path)) for path in segment_files(segment.path))
+            self.chunk_sizes[chunk.path] = size
+        return self.chunk_sizes[chunk.path]
+
+    def expired(self, chunks, now=None):
+        """Number of oldest chunks to delete and reason"""
+        now = now or datetime.utcnow()
+        count, reason = 0, None
+        if self.max_age:
+            cutoff = now - timedelta(seconds=self.max_age)
+            while count < len(chunks) and chunks[count].end <= cutoff:
+                count += 1
+            reason = 'age' if count else None
+        if self.max_bytes:
+            sizes = [self.chunk_size(chunk) for chunk in chunks]
+            total = sum(sizes[count:])
+            while count < len(chunks) and total > self.max_bytes:
+                total -= sizes[count]
+                count += 1
+                reason = 'quota'
+        if self.min_free_bytes:
+            needed = self.min_free_bytes - shutil.disk_usage(self.root).free
+            freed = sum(self.chunk_size(chunk) for chunk in chunks[:count])
+            while count < len(chunks) and freed < needed:
+                freed += self.chunk_size(chunks[count])
+                count += 1
+                reason = 'disk'
+        return count, reason
+
+    def plan(self, now=None):
+        """Expired chunks and segments (blocking reads): returns chunks, reason, cutoff datetime and
+        dict of segments list directory -> scan_list result"""
+        chunks = read_chunks(self.root)
+        # never delete last completed chunk: it is next to chunk being written
+        count, reason = self.expired(chunks[:-1], now)
+        if not count:
+            return [], None, None, {}
+        chunks = chunks[:count]
+        cutoff = chunks[-1].end
+        lists = {}
+        lists[self.root] = scan_list(self.root, cutoff)
+        # sublists: in every directory of expired segments
+        for dirname in sorted({os.path.dirname(path) for path in lists[self.root][1]}):
+            parts = dirname.split(os.sep)
+            for depth in range(1, len(parts) + 1):
+                sublist = os.path.join(self.root, *parts[:depth])
+                if sublist not in lists:
+                    lists[sublist] = scan_list(sublist, cutoff)
+        return chunks, reason, cutoff, lists
+
+    def trim(self, chunks, lists):
+        """Trim chunks.yaml and segments lists (event loop of list writers), returns files to delete"""
+        files = []
+        dirnames = set()
+        for chunk in chunks:
+            files.extend(chunk_files(os.path.join(self.root, chunk.path)))
+            dirnames.add(os.path.dirname(os.path.join(self.root, chunk.path)))
+        for path in lists[self.root][1]:
+            files.extend(segment_files(os.path.join(self.root, path)))
+            dirnames.add(os.path.dirname(os.path.join(self.root, path)))
+        if self.dry_run:
+            return files, dirnames
+        trim_file(os.path.join(self.root, YAMLChunkList.filename), chunks[-1].position)
+        for dirname, (cut, paths, complete) in lists.items():
+            if complete and dirname != self.root:
+                # all segments of sublist expired (writers moved to later directory)
+                remove_list(dirname)
+            elif cut:
+                trim_list(dirname, cut)
+        if self.reopen:
+            self.reopen()
+        return files, dirnames
+
+    def delete(self, files):
+        """Delete files in batches (blocking), returns numbers of deleted files and reclaimed bytes"""
+        deleted = reclaimed = 0
+        for i in range(0, len(files), self.batch_size):
+            if i and self.batch_pause:
+                time.sleep(self.batch_pause)
+            result = delete_files(files[i:i+self.batch_size])
+            deleted += result[0]
+            reclaimed += result[1]
+        return deleted, reclaimed
+
+    async def adelete(self, files, loop):
+        deleted = reclaimed = 0
+        for i in range(0, len(files), self.batch_size):
+            if i and self.batch_pause:
+                await asyncio.sleep(self.batch_pause)
+            result = await loop.run_in_executor(None, delete_files, files[i:i+self.batch_size])
+            deleted += result[0]
+            reclaimed += result[1]
+        return deleted, reclaimed
+
+    def collect(self):
+        """Remove content store blobs no longer linked by segments (blocking), returns reclaimed bytes"""
+        if self.dry_run or not self.content_store:
+            return 0
+        before = self.content_store.bytes_collected
+        self.content_store.collect()
+        return self.content_store.bytes_collected - before
+
+    def report(self, chunks, reason, cutoff, deleted, reclaimed, start):
+        print('Stream %s: retention (%s) deleted %i chunks before %s, %i files, %.1f MB reclaimed in %.1fs%s'
+              % (self.feed, reason, len(chunks), cutoff, deleted, reclaimed / 1e6, time.time() - start,
+                 ' (dry run)' if self.dry_run else ''))
+        logger.info('Retention of %s: %i chunks, %i files, %i bytes reclaimed' % (self.feed, len(chunks), deleted, reclaimed))
+
+    def run_once(self, now=None):
+        """Single retention pass, blocking; only when feed is not running (lists are trimmed)"""
+        start = time.time()
+        chunks, reason, cutoff, lists = self.plan(now)
+        if not chunks:
+            return 0, 0
+        files, dirnames = self.trim(chunks, lists)
+        deleted, reclaimed = self.delete(files) if not self.dry_run else (0, sum(map(file_size, files)))
+        reclaimed += self.collect()
+        if not self.dry_run:
+            remove_empty_dirs(self.root, dirnames)
+        self.account(chunks, reason, deleted, reclaimed)
+        self.report(chunks, reason, cutoff, deleted, reclaimed, start)
+        return deleted, reclaimed
+
+    async def run(self):
+        """Retention pass every interval (run as task in feed process)"""
+        loop = self.loop or asyncio.get_event_loop()
+        while True:
+            try:
+                start = time.time()
+                chunks, reason, cutoff, lists = await loop.run_in_executor(None, self.plan)
+                if chunks:
+                    # trimmed in event loop: list writers of feed do not write meanwhile
+                    files, dirnames = self.trim(chunks, lists)
+                    if self.dry_run:
+                        deleted, reclaimed = 0, sum(map(file_size, files))
+                    else:
+                        deleted, reclaimed = await self.adelete(files, loop)
+                        reclaimed += await loop.run_in_executor(None, self.collect)
+                        await loop.run_in_executor(None, remove_empty_dirs, self.root, dirnames)
+                    self.account(chunks, reason, deleted, reclaimed)
+                    self.report(chunks, reason, cutoff, deleted, reclaimed, start)
+            except Exception as e:
+                logger.error('Retention of %s failed: %s' % (self.feed, e))
+            await asyncio.sleep(self.interval)
+
+    def account(self, chunks, reason, deleted, reclaimed):
+        self.deleted += deleted
+        self.reclaimed += reclaimed
+        self.chunk_sizes = {path: size for path, size in self.chunk_sizes.items()
+                            if path not in {chunk.path for chunk in chunks}}
+        if not self.dry_run:
+            retention_deleted_files.labels(feed=self.feed).inc(deleted)
+            retention_reclaimed_bytes.labels(feed=self.feed).inc(reclaimed)
+            retention_deleted_chunks.labels(feed=self.feed, reason=reason).inc(len(chunks))
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    # standalone retention pass of stopped feed (lists are rewritten)
+    parser = argparse.ArgumentParser(description='Delete expired data of stopped feed', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('root', type=str, help='feed data directory')
+    parser.add_argument('--max-age', type=float, help='max age of chunks in seconds')
+    parser.add_argument('--max-bytes', type=int, help='size quota of feed in bytes')
+    parser.add_argument('--min-free-bytes', type=int, help='minimum free space of file system in bytes')
+    parser.add_argument('--batch-size', type=int, default=100, help='files deleted at once')
+    parser.add_argument('--batch-pause', type=float, default=0.5, help='seconds between batches')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be deleted')
+
+    args = parser.parse_args()
+
+    Retention(args.root, args.max_age, args.max_bytes, args.min_free_bytes, batch_size=args.batch_size,
+              batch_pause=args.batch_pause, dry_run=args.dry_run, feed=os.path.basename(os.path.normpath(args.root))).run_once()
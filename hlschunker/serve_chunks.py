@@ -1,53 +1,264 @@
 #!/usr/bin/env python3
 
-import os, sys
-from urllib.parse import urljoin
+import os, sys, json, time, socket, signal
+import asyncio
+from collections import OrderedDict
+from multiprocessing import Process
+from urllib.parse import urljoin, urlencode
 
 # must be installed
 from aiohttp import web
 
-# monkey patch: https://github.com/KeepSafe/aiohttp/issues/860
+# monkey patch: https://github.com/KeepSafe/aiohttp/issues/860 (socket option of closed connection fails);
+# errors are ignored only: set_tcp_nodelay(True) uncorks response, without it every response waits for
+# TCP_CORK timeout (200ms)
 from aiohttp.web_reqrep import StreamResponse
-StreamResponse.set_tcp_nodelay = lambda self, value: None
+def set_tcp_nodelay(self, value, set_tcp_nodelay=StreamResponse.set_tcp_nodelay):
+    try:
+        set_tcp_nodelay(self, value)
+    except (OSError, AttributeError):
+        pass
+StreamResponse.set_tcp_nodelay = set_tcp_nodelay
 
 import aiohttp_cors
 
 # local
-from yaml_storage import YAMLChunker
+from yaml_storage import YAMLChunker, YAMLReader, ChunkPacker
+from catalog import ChunkCatalog
 from index import HLSIndex
+import metrics
+import mpegts
 
 
-def get_chunk_index(path, base='', complete=False):
+http_request_seconds = metrics.Histogram('hlschunker_http_request_seconds', 'Chunk server request time',
+                                         ['handler', 'status'])
+playlist_cache_requests = metrics.Counter('hlschunker_playlist_cache_requests_total', 'Chunk playlist cache lookups',
+                                          ['result'])
+download_budget_limit = metrics.Gauge('hlschunker_download_budget_limit', 'Concurrent downloads allowed for all feeds')
+download_budget_in_use = metrics.Gauge('hlschunker_download_budget_in_use', 'Concurrent downloads of all feeds')
+download_budget_waiting = metrics.Gauge('hlschunker_download_budget_waiting', 'Downloads waiting for budget')
+
+
+content_types = {'.ts': 'video/MP2T', '.aac': 'audio/aac'}
+
+feed_id_pattern = r'[A-Za-z0-9_-]+'     # feeds added by admin API (id is directory name in data directory)
+
+def playlist_suffix(audio_format=None):
+    """Chunk playlist suffix: .m3u8 for segments, .audio.m3u8 or .aac.m3u8 for extracted audio"""
+    return os.path.splitext(mpegts.extensions[audio_format])[0] + '.m3u8' if audio_format else '.m3u8'
+
+def get_chunk_index(path, base='', complete=False, audio_format=None, packed_path=None):
+    """packed_path: path of packed chunk file relative to base, segments with offset are byte ranges of it"""
     if not path.lower().endswith('.yaml'):
         path += '.yaml'
     segments = YAMLChunker.read_chunk_segments(path, False)
+    if audio_format:
+        # playlist of audio extracted from segments (audio is not packed)
+        segments = [segment._replace(path=mpegts.audio_path(segment.path, audio_format), offset=None, length=None)
+                    for segment in segments]
+    elif packed_path:
+        segments = [segment._replace(path=packed_path) if segment.offset is not None else segment
+                    for segment in segments]
     return HLSIndex.segments_to_index(segments, base, complete)
 
+def parse_range(value, size):
+    """Single byte range of Range header value (bytes=start-end, bytes=start-, bytes=-suffix),
+    returns (start, end) with end exclusive, None if range is not satisfiable"""
+    unit, _, spec = value.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        raise ValueError('unsupported range: %s' % value)
+    start, _, end = spec.strip().partition('-')
+    if not start:
+        start, end = max(size - int(end), 0), size
+    else:
+        start, end = int(start), min(int(end) + 1, size) if end else size
+    if start >= end:
+        return None
+    return start, end
+
 def data_file(data_dir):
     async def handler(request):
         try:
             id = request.match_info.get('id')
             path = request.match_info.get('path')
             path = os.path.join(data_dir, id, path)
-            content_type = 'video/MP2T'
+            content_type = content_types.get(os.path.splitext(path)[1], 'application/octet-stream')
             with open(path, 'rb') as f:
-                return web.Response(body=f.read(), content_type=content_type)
+                if 'Range' not in request.headers:
+                    return web.Response(body=f.read(), content_type=content_type, headers={'Accept-Ranges': 'bytes'})
+                # byte range of packed chunk file (EXT-X-BYTERANGE segments)
+                size = os.fstat(f.fileno()).st_size
+                byterange = parse_range(request.headers['Range'], size)
+                if byterange is None:
+                    raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': 'bytes */%i' % size})
+                start, end = byterange
+                f.seek(start)
+                return web.Response(body=f.read(end - start), status=206, content_type=content_type,
+                                    headers={'Accept-Ranges': 'bytes',
+                                             'Content-Range': 'bytes %i-%i/%i' % (start, end - 1, size)})
+        except web.HTTPException:
+            raise
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            raise web.HTTPBadRequest
+        except FileNotFoundError as e:
+            print(e, file=sys.stderr)
+            raise web.HTTPNotFound
+        except Exception as e:
+            print(e, file=sys.stderr)
+            raise web.HTTPInternalServerError
+    return handler
+
+def chunk_parts(root, path):
+    """Byte ranges (file path, offset, length) of segments of chunk (chunk list path relative to root)
+    in order, the virtual concatenated chunk file; missing segments are left out"""
+    full_path = os.path.join(root, path)
+    packed_path = ChunkPacker.packed_path(full_path)
+    parts = []
+    for segment in YAMLChunker.read_chunk_segments(full_path, False):
+        if segment.offset is not None:
+            parts.append((packed_path, segment.offset, segment.length))
+            continue
+        try:
+            parts.append((os.path.join(root, segment.path), 0, os.path.getsize(os.path.join(root, segment.path))))
+        except FileNotFoundError:
+            pass
+    return parts
+
+def slice_parts(parts, start, end):
+    """Parts covering bytes start..end (exclusive) of concatenation of parts"""
+    position = 0
+    for path, offset, length in parts:
+        if position + length > start and position < end:
+            skip = max(start - position, 0)
+            yield path, offset + skip, min(end - position, length) - skip
+        position += length
+
+def _sendfile_cb(fut, out_fd, in_fd, offset, count, loop, registered):
+    if registered:
+        loop.remove_writer(out_fd)
+    if fut.cancelled():
+        return
+    try:
+        n = os.sendfile(out_fd, in_fd, offset, count)
+        if n == 0:
+            fut.set_exception(EOFError('file truncated, %i bytes not sent' % count))
+            return
+    except (BlockingIOError, InterruptedError):
+        n = 0
+    except Exception as exc:
+        fut.set_exception(exc)
+        return
+    if n < count:
+        loop.add_writer(out_fd, _sendfile_cb, fut, out_fd, in_fd, offset + n, count - n, loop, True)
+    else:
+        fut.set_result(None)
+
+async def sendfile(request, response, f, offset, count):
+    """Send count bytes of file f from offset to client with sendfile(2) (zero copy), copying through
+    response where sendfile is not available (TLS, platform)"""
+    transport = request.transport
+    sock = transport.get_extra_info('socket')
+    if hasattr(os, 'sendfile') and sock is not None and not transport.get_extra_info('sslcontext'):
+        await response.drain()
+        loop = request.app.loop
+        fut = asyncio.Future(loop=loop)
+        _sendfile_cb(fut, sock.fileno(), f.fileno(), offset, count, loop, False)
+        await fut
+        return
+    f.seek(offset)
+    while count > 0:
+        data = f.read(min(count, 256 * 1024))
+        if not data:
+            raise EOFError('file truncated, %i bytes not sent' % count)
+        response.write(data)
+        await response.drain()
+        count -= len(data)
+
+def chunk_stream(data_dir):
+    """GET /{id}/chunks/{date}/{name}.ts: segments of chunk concatenated (or packed chunk file) as
+    one media file, Range requests address the concatenation"""
+    async def handler(request):
+        try:
+            id = request.match_info.get('id')
+            path = os.path.join('chunks', request.match_info.get('date'), request.match_info.get('name') + '.yaml')
+            parts = chunk_parts(os.path.join(data_dir, id), path)
+            size = sum(length for path, offset, length in parts)
+            headers = {'Accept-Ranges': 'bytes'}
+            status = 200
+            start, end = 0, size
+            if 'Range' in request.headers:
+                byterange = parse_range(request.headers['Range'], size)
+                if byterange is None:
+                    raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': 'bytes */%i' % size})
+                start, end = byterange
+                status = 206
+                headers['Content-Range'] = 'bytes %i-%i/%i' % (start, end - 1, size)
+        except web.HTTPException:
+            raise
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            raise web.HTTPBadRequest
         except FileNotFoundError as e:
             print(e, file=sys.stderr)
             raise web.HTTPNotFound
         except Exception as e:
             print(e, file=sys.stderr)
             raise web.HTTPInternalServerError
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_type = content_types['.ts']
+        response.content_length = end - start
+        await response.prepare(request)
+        try:
+            for part_path, offset, length in slice_parts(parts, start, end):
+                with open(part_path, 'rb') as f:
+                    await sendfile(request, response, f, offset, length)
+        except Exception as e:
+            # segment removed or truncated while streaming: announced length can't be met
+            print('Streaming chunk %s/%s failed: %s' % (id, path, e), file=sys.stderr)
+            request.transport.close()
+        return response
     return handler
 
-def chunk_index(data_dir, prefix='', root_path=True):
+class PlaylistCache:
+    """Rendered chunk playlists, valid while chunk list file is unchanged (modification time, size, inode);
+    every serving worker has its own cache, chunk list files keep them consistent"""
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()    # key -> (chunk list stat, content)
+    def get(self, path, render, *key):
+        """Content for chunk list path and key (other arguments of rendering), render() if not cached"""
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        key = (path,) + key
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == version:
+            self.entries.move_to_end(key)
+            playlist_cache_requests.labels(result='hit').inc()
+            return entry[1]
+        playlist_cache_requests.labels(result='miss').inc()
+        content = render()
+        self.entries[key] = (version, content)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return content
+
+playlist_cache = PlaylistCache()
+
+def chunk_index(data_dir, prefix='', root_path=True, audio_format=None, cache=playlist_cache):
+    suffix = playlist_suffix(audio_format)
     async def handler(request):
         try:
             id = request.match_info.get('id')
             path = request.match_info.get('path')
-            print('Generating chunk HLS index: %s/chunks/%s' % (id, path), file=sys.stderr)
-            path = os.path.join(data_dir, id, 'chunks', os.path.splitext(path)[0]+'.yaml')
-            content = get_chunk_index(path, urljoin(prefix, '/%s/' % id if root_path else ''), True).encode('utf8')
+            packed_path = os.path.join('chunks', path[:-len(suffix)] + ChunkPacker.ext)
+            yaml_path = os.path.join(data_dir, id, 'chunks', path[:-len(suffix)]+'.yaml')
+            base = urljoin(prefix, '/%s/' % id if root_path else '')
+            def render():
+                print('Generating chunk HLS index: %s/chunks/%s' % (id, path), file=sys.stderr)
+                return get_chunk_index(yaml_path, base, True, audio_format, packed_path).encode('utf8')
+            content = cache.get(yaml_path, render, base, audio_format)
             content_type = 'application/x-mpegURL'
             return web.Response(body=content, content_type=content_type)
         except FileNotFoundError as e:
@@ -58,7 +269,184 @@ def chunk_index(data_dir, prefix='', root_path=True):
             raise web.HTTPInternalServerError
     return handler
 
-def serve_chunks(data_dir='', host='0.0.0.0', port=6000, prefix='', full_path=False):
+def chunk_catalog(data_dir):
+    """Completed chunks of feed: GET /{id}/chunks?from=&to=&limit=&cursor= (from, to: datetimes of chunk end),
+    next and prev are URLs of adjacent pages; GET /{id}/chunks/latest: latest completed chunk"""
+    catalogs = {}
+    def get_catalog(id):
+        if id not in catalogs:
+            if not os.path.isdir(os.path.join(data_dir, id)):
+                raise web.HTTPNotFound
+            catalogs[id] = ChunkCatalog(os.path.join(data_dir, id))
+        return catalogs[id]
+    def parse_datetime(value):
+        if value is None:
+            return None
+        dt = YAMLReader.parse_datetime(value)
+        if dt is None:
+            raise ValueError('invalid datetime: %s' % value)
+        return dt
+    def page_url(request, cursor):
+        if cursor is None:
+            return None
+        query = dict(request.GET, cursor=cursor)
+        return '%s?%s' % (request.path, urlencode(sorted(query.items())))
+    async def handler(request):
+        try:
+            id = request.match_info.get('id')
+            catalog = get_catalog(id)
+            if request.match_info.get('latest'):
+                content = catalog.latest(id)
+                if content is None:
+                    raise web.HTTPNotFound
+            else:
+                limit = request.GET.get('limit')
+                cursor = request.GET.get('cursor')
+                if limit and int(limit) <= 0:
+                    raise ValueError('invalid limit: %s' % limit)
+                chunks, prev_cursor, next_cursor = catalog.query(id, parse_datetime(request.GET.get('from')),
+                                                                 parse_datetime(request.GET.get('to')),
+                                                                 int(limit) if limit else None,
+                                                                 int(cursor) if cursor else None)
+                content = dict(chunks=chunks, prev=page_url(request, prev_cursor), next=page_url(request, next_cursor))
+            return web.Response(body=json.dumps(content, separators=(',', ':')).encode('utf8'),
+                                content_type='application/json')
+        except web.HTTPException:
+            raise
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            raise web.HTTPBadRequest
+        except Exception as e:
+            print(e, file=sys.stderr)
+            raise web.HTTPInternalServerError
+    return handler
+
+def timed(name, handler):
+    """Measure request time of handler"""
+    async def timed_handler(request):
+        start = time.time()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            http_request_seconds.labels(handler=name, status=status).observe(time.time() - start)
+    return timed_handler
+
+def metrics_handler(metrics_dir):
+    async def handler(request):
+        try:
+            content = metrics.render_all(metrics_dir).encode('utf8')
+            return web.Response(body=content, content_type='text/plain')
+        except Exception as e:
+            print(e, file=sys.stderr)
+            raise web.HTTPInternalServerError
+    return handler
+
+def collect_budget_metrics(budget):
+    def collect():
+        stats = budget.stats
+        download_budget_limit.labels().set(stats['limit'])
+        download_budget_in_use.labels().set(sum(stats['in_use']))
+        download_budget_waiting.labels().set(sum(stats['waiting']))
+    return collect
+
+def download_budget(budget):
+    """GET: budget state; POST: update budget with limit and/or minimum query parameters"""
+    async def handler(request):
+        try:
+            if request.method == 'POST':
+                values = dict((key, int(request.GET[key])) for key in ('limit', 'minimum') if key in request.GET)
+                if any(value < 1 for value in values.values()):
+                    raise ValueError('budget limit and minimum must be positive: %s' % values)
+                for key, value in values.items():
+                    setattr(budget, key, value)
+            content = json.dumps(budget.stats).encode('utf8')
+            return web.Response(body=content, content_type='application/json')
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            raise web.HTTPBadRequest
+        except Exception as e:
+            print(e, file=sys.stderr)
+            raise web.HTTPInternalServerError
+    return handler
+
+def feed_admin(feeds):
+    """Feeds of chunker (FeedManager): GET /admin/feeds: running feeds; PUT /admin/feeds/{id} with feed
+    configuration (JSON object as in feeds of config.yaml): start or reconfigure feed; DELETE /admin/feeds/{id}:
+    stop feed; POST /admin/feeds/reload: apply configuration file"""
+    def json_response(content, status=200):
+        return web.Response(body=json.dumps(content).encode('utf8'), status=status, content_type='application/json')
+    async def handler(request):
+        try:
+            id = request.match_info.get('id')
+            if request.method == 'GET':
+                return json_response(feeds.status)
+            if request.method == 'PUT':
+                feed = await request.json()
+                if type(feed) is not dict:
+                    raise ValueError('feed configuration must be an object')
+                changed = await feeds.update(id, feed)
+                return json_response(dict(id=id, started=changed), 201 if changed else 200)
+            if request.method == 'DELETE':
+                await feeds.remove(id)
+                return json_response(dict(id=id, stopped=True))
+            return json_response(await feeds.reload())
+        except web.HTTPException:
+            raise
+        except KeyError as e:
+            print('Unknown feed', e, file=sys.stderr)
+            raise web.HTTPNotFound
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            raise web.HTTPBadRequest
+        except Exception as e:
+            print(e, file=sys.stderr)
+            raise web.HTTPInternalServerError
+    return handler
+
+def listen(host='0.0.0.0', port=6000, backlog=128):
+    """Listening socket of chunk server (can be handed over to next instance, see handover.py)"""
+    family, type, proto, canonname, address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM,
+                                                                 flags=socket.AI_PASSIVE)[0]
+    sock = socket.socket(family, type, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+def start_server(app, sock):
+    handler = app.make_handler()
+    server = app.loop.run_until_complete(app.loop.create_server(handler, sock=sock))
+    print('======== Running on %s ========' % (sock.getsockname(),))
+    return app, handler, server
+
+def stop_server(app, handler, server, shutdown_timeout=60.0):
+    loop = app.loop
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.run_until_complete(app.shutdown())
+    loop.run_until_complete(handler.finish_connections(shutdown_timeout))
+    loop.run_until_complete(app.cleanup())
+
+def run_app(app, sock, shutdown_timeout=60.0, admin=None):
+    """web.run_app on listening socket (and admin app on its socket: admin=(app, sock)); returns when
+    loop is stopped (handover) or interrupted"""
+    servers = [start_server(app, sock)] + ([start_server(*admin)] if admin else [])
+    try:
+        app.loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            stop_server(*server, shutdown_timeout=shutdown_timeout)
+
+def make_app(data_dir='', prefix='', full_path=False, budget=None, metrics_dir=None):
     app = web.Application()
     cors = aiohttp_cors.setup(app, defaults={
         "*": aiohttp_cors.ResourceOptions(
@@ -67,15 +455,106 @@ def serve_chunks(data_dir='', host='0.0.0.0', port=6000, prefix='', full_path=Fa
                 allow_headers="*",
             )
     })
+    catalog = timed('chunk_catalog', chunk_catalog(data_dir))
+    cors.add(app.router.add_resource(r'/{id}/chunks').add_route('GET', catalog))
+    cors.add(app.router.add_resource(r'/{id}/chunks/{latest:latest}').add_route('GET', catalog))
+    # chunk as one media file (before data file routes, packed chunk files have the same path)
+    cors.add(app.router.add_resource(r'/{id}/chunks/{date}/{name:[^/]+}.ts').add_route('GET', timed('chunk_stream', chunk_stream(data_dir))))
+    # playlists of extracted audio: <chunk>.audio.m3u8 (audio-only transport stream), <chunk>.aac.m3u8 (ADTS)
+    for audio_format in ('ts', 'adts'):
+        suffix = playlist_suffix(audio_format).replace('.', r'\.')
+        handler = chunk_index(data_dir, audio_format=audio_format) if full_path else \
+                  chunk_index(data_dir, prefix, False, audio_format)
+        cors.add(app.router.add_resource(r'/{id}/chunks/{path:.*%s}' % suffix).add_route('GET', timed('chunk_index', handler)))
     if full_path:
         # root path segments
-        cors.add(app.router.add_resource(r'/{id}/chunks/{path:.*.m3u8}').add_route('GET', chunk_index(data_dir)))
-        cors.add(app.router.add_resource(r'/{id}/{path:.*.ts}').add_route('GET', data_file(data_dir)))
+        cors.add(app.router.add_resource(r'/{id}/chunks/{path:.*.m3u8}').add_route('GET', timed('chunk_index', chunk_index(data_dir))))
+        cors.add(app.router.add_resource(r'/{id}/{path:.*.ts}').add_route('GET', timed('data_file', data_file(data_dir))))
+        cors.add(app.router.add_resource(r'/{id}/{path:.*\.aac}').add_route('GET', timed('data_file', data_file(data_dir))))
     else:
         # relative path segments
-        cors.add(app.router.add_resource(r'/{id}/chunks/{path:.*.m3u8}').add_route('GET', chunk_index(data_dir, prefix, False)))
-        cors.add(app.router.add_resource(r'/{id}/chunks/{date}/{path:.*.ts}').add_route('GET', data_file(data_dir)))
-    web.run_app(app, host=host, port=port)
+        cors.add(app.router.add_resource(r'/{id}/chunks/{path:.*.m3u8}').add_route('GET', timed('chunk_index', chunk_index(data_dir, prefix, False))))
+        cors.add(app.router.add_resource(r'/{id}/chunks/{date}/{path:.*.ts}').add_route('GET', timed('data_file', data_file(data_dir))))
+        cors.add(app.router.add_resource(r'/{id}/chunks/{date}/{path:.*\.aac}').add_route('GET', timed('data_file', data_file(data_dir))))
+    if metrics_dir is None:
+        metrics_dir = os.path.join(data_dir, '.metrics')
+    app.router.add_route('GET', '/metrics', metrics_handler(metrics_dir))
+    if budget is not None:
+        metrics.REGISTRY.add_collector(collect_budget_metrics(budget))
+    return app
+
+def make_admin_app(budget=None, feeds=None):
+    """Admin API, served on its own listener (localhost, see chunker.py) by the process owning budget and feeds"""
+    app = web.Application()
+    if budget is not None:
+        app.router.add_route('GET', '/admin/budget', download_budget(budget))
+        app.router.add_route('POST', '/admin/budget', download_budget(budget))
+    if feeds is not None:
+        handler = feed_admin(feeds)
+        app.router.add_route('GET', '/admin/feeds', handler)
+        app.router.add_route('POST', '/admin/feeds/reload', handler)
+        app.router.add_route('PUT', '/admin/feeds/{id:%s}' % feed_id_pattern, handler)
+        app.router.add_route('DELETE', '/admin/feeds/{id:%s}' % feed_id_pattern, handler)
+    return app
+
+def serve_worker(sock, app_kwargs, metrics_path=None):
+    """Serving worker process: own event loop, stops gracefully on SIGTERM"""
+    loop = asyncio.new_event_loop()     # not the forked loop of parent
+    asyncio.set_event_loop(loop)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    if metrics_path:
+        asyncio.ensure_future(metrics.write_snapshots(metrics_path))
+    run_app(make_app(**app_kwargs), sock)
+
+async def supervise(workers, start, interval=5):
+    """Restart serving workers that died"""
+    while True:
+        await asyncio.sleep(interval)
+        for i, worker in enumerate(workers):
+            if not worker.is_alive():
+                print('Serving worker %i (pid %i) exited with %s, restarting' % (i, worker.pid, worker.exitcode),
+                      file=sys.stderr)
+                workers[i] = start(i)
+
+def serve_chunks(data_dir='', host='0.0.0.0', port=6000, prefix='', full_path=False, budget=None,
+                 metrics_dir=None, feeds=None, sock=None, workers=1, admin_sock=None):
+    """Serve chunks on sock (listening socket, default: listen on host and port). With workers > 1 the
+    socket is served by that many pre-forked worker processes (accepts are shared by kernel), returns
+    when event loop of this process is stopped (handover) or interrupted. Admin API of budget and feeds
+    is served by this process on admin_sock only (never on the public chunk server socket)"""
+    if sock is None:
+        sock = listen(host, port)
+    if metrics_dir is None:
+        metrics_dir = os.path.join(data_dir, '.metrics')
+    app_kwargs = dict(data_dir=data_dir, prefix=prefix, full_path=full_path, budget=budget,
+                      metrics_dir=metrics_dir)
+    admin = (make_admin_app(budget, feeds), admin_sock) if admin_sock is not None else None
+    if workers <= 1:
+        run_app(make_app(**app_kwargs), sock, admin=admin)
+        return
+    def start(i):
+        worker = Process(target=serve_worker, args=(sock, app_kwargs, os.path.join(metrics_dir, 'serve-%i.json' % i)),
+                         name='serve-%i' % i)
+        worker.start()
+        return worker
+    processes = [start(i) for i in range(workers)]
+    print('======== Serving on %s by %i workers ========' % (sock.getsockname(), workers))
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)     # workers are stopped with this process
+    supervisor = asyncio.ensure_future(supervise(processes, start))
+    admin = start_server(*admin) if admin else None
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.cancel()
+        if admin:
+            stop_server(*admin)
+        for worker in processes:
+            worker.terminate()  # SIGTERM: worker finishes its requests
+        for worker in processes:
+            worker.join()
 
 
 if __name__ == "__main__":
@@ -88,7 +567,8 @@ if __name__ == "__main__":
     parser.add_argument('--port', type=int, default=6000, help='port for HTTP server')
     parser.add_argument('--prefix', type=str, default='', help='prefix for segment URL')
     parser.add_argument('--full-path', action='store_true', help='use full path addressing for segment URL')
+    parser.add_argument('--workers', '-w', type=int, default=1, help='serving worker processes')
 
     args = parser.parse_args()
 
-    serve_chunks(args.data_dir, args.host, args.port, args.prefix, args.full_path)
+    serve_chunks(args.data_dir, args.host, args.port, args.prefix, args.full_path, workers=args.workers)
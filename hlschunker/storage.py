@@ -1,19 +1,36 @@
 #!/usr/bin/env python3
 
-import os, json, traceback
-from collections import deque
+import os, json, traceback, hashlib
+from collections import deque, OrderedDict
+from datetime import datetime, timedelta
 import asyncio
 import concurrent.futures
+import heapq
 import time
+from multiprocessing import Array, Lock, Value
 
 # must be installed
 import aiohttp
 from aiohttp.errors import *
 
 from index import *
+import metrics
+import tracing
 
 
-HTTPResponse = namedtuple('HTTPResponse', 'headers, status')
+chunk_notify_seconds = metrics.Histogram('hlschunker_chunk_notify_seconds',
+                                         'Time from chunk close to successful notification', ['feed'])
+chunk_notify_backlog = metrics.Gauge('hlschunker_chunk_notify_backlog',
+                                     'Chunk notifications waiting to be sent', ['feed'])
+reorder_wait_seconds = metrics.Histogram('hlschunker_reorder_wait_seconds',
+                                         'Time from item promise to write into segment lists', ['feed'])
+
+
+HTTPResponse = namedtuple('HTTPResponse', 'headers, status, digest, skipped, resumed, linked')
+# digest: hex digest of downloaded content if requested; skipped: size of existing file kept (not downloaded);
+# resumed: size of partial download continued with range request; linked: size of content linked from
+# content store instead of downloaded (ETag of already stored content)
+HTTPResponse.__new__.__defaults__ = (None, 0, 0, 0)
 HTTPResponseContent = namedtuple('HTTPResponseContent', 'content, headers, status')
 
 if hasattr(aiohttp.client, 'URL'):
@@ -26,44 +43,180 @@ if hasattr(aiohttp.client, 'URL'):
 else:
     prep_url = lambda url: url
 
-async def download_to_file(url, path, method='GET'):
-    async with aiohttp.ClientSession() as session:
-        response = await session.request(method, prep_url(url))
-        try:
-            size = os.path.getsize(path)
-        except OSError:
-            size = -1 
+download_chunk_size = 64*1024
+
+_client_session = None
+
+def client_session():
+    """Client session shared by all requests of process: keep-alive connections and DNS cache are reused"""
+    global _client_session
+    if _client_session is None or _client_session.closed:
+        _client_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(use_dns_cache=True))
+    return _client_session
+
+class shared_session:
+    """async with shared_session() as session: like aiohttp.ClientSession(), but the session is shared
+    and not closed on exit"""
+    async def __aenter__(self):
+        return client_session()
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+async def close_client_session():
+    global _client_session
+    session, _client_session = _client_session, None
+    if session is not None and not session.closed:
+        closing = session.close()
+        if hasattr(closing, '__await__'):   # coroutine in later aiohttp versions
+            await closing
+
+async def preconnect(url):
+    """Resolve host of url and open keep-alive connection to it (HEAD request); returns status"""
+    async with shared_session() as session:
+        response = await session.request('HEAD', prep_url(url))
+        await response.release()
+        return response.status
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return -1
+
+def file_digest(path, algorithm, hashes=None):
+    """Hash content of file with algorithm or update given hash objects"""
+    hashes = hashes or [hashlib.new(algorithm)]
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(download_chunk_size)
+            if not data:
+                break
+            for content_hash in hashes:
+                content_hash.update(data)
+    return hashes[0].hexdigest()
+
+def etag_md5(headers):
+    """MD5 of content if ETag is MD5 hex digest (like S3 and many static file servers), None otherwise"""
+    etag = headers.get('ETAG', '')
+    if etag.startswith('W/'):
+        return None
+    etag = etag.strip('"').lower()
+    if len(etag) == 32 and all(c in '0123456789abcdef' for c in etag):
+        return etag
+    return None
+
+def content_length(response):
+    """Full length of content (of range response too), None if unknown"""
+    content_range = response.headers.get('CONTENT-RANGE')
+    if response.status == 206 and content_range and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get('CONTENT-LENGTH')
+    return int(length) if length and length.isdigit() else None
+
+async def download_to_file(url, path, method='GET', suffix='.part', throttle=None, digest=None, byterange=None,
+                           resume=True, verify=False, content_store=None):
+    """Download url to path; body is streamed to path+suffix and moved in place when complete.
+    throttle: TokenBucket objects limiting download bandwidth; digest: hash algorithm (hashlib name)
+    of content hashed while downloading; byterange: (length, offset) to download sub-range of url
+    (status 206, or 200 if server ignores range and the sub-range is cut from full content).
+    Existing file of the same length as content is not downloaded again, with verify also MD5 of content
+    (if ETag is MD5) must match. With resume, partial download left by previous attempt is continued
+    with range request (if server supports it). With content_store, content already stored (MD5 ETag seen
+    before) is linked from it, body is neither downloaded nor written."""
+    loop = asyncio.get_event_loop()
+    tmp_path = path + suffix
+    size = file_size(path)
+    partial = file_size(tmp_path) if resume and not byterange and size < 0 else -1
+    if byterange:
+        headers = {'Range': 'bytes=%i-%i' % (byterange[1], byterange[1] + byterange[0] - 1)}
+    elif partial > 0:
+        headers = {'Range': 'bytes=%i-' % partial}
+    else:
+        headers = None
+    async with shared_session() as session:
+        response = await session.request(method, prep_url(url), headers=headers)
         try:
-            if response.status != 200:  # TODO: other possible error codees ?
+            if response.status not in (200, 206):  # TODO: other possible error codees ?
                 return HTTPResponse(response.headers, response.status)
                 # return
                 #return HTTPDownload(False, False, response.headers, response.status)
-            if response.headers.get('CONTENT-LENGTH', -2) != size:
-                content = await response.content.read()
-                try:
-                    dirname = os.path.dirname(path)
-                    if not os.path.isdir(dirname):
-                        os.makedirs(dirname)
-                    with open(path, 'wb') as f:
-                        if type(content) is str:
-                            content = content.encode('utf8')
-                        f.write(content)
-                    #return HTTPDownload(True, True, response.headers, response.status)
-                except:
-                    # NOTE: debug
-                    traceback.print_exc()
-                    return HTTPResponse(None, -1)
-                    #return HTTPDownload(False, False, response.headers, response.status)
+            md5 = etag_md5(response.headers) if verify and not byterange else None
+            if size >= 0 and (byterange[0] if byterange else content_length(response)) == size:
+                if not md5 or await loop.run_in_executor(None, file_digest, path, 'md5') == md5:
+                    return HTTPResponse(response.headers, response.status, skipped=size)
+            if content_store is not None and not byterange:
+                linked = content_store.link(etag_md5(response.headers), content_length(response), path)
+                if linked:
+                    if partial > 0:
+                        os.remove(tmp_path)
+                    return HTTPResponse(response.headers, response.status, linked=linked)
+            try:
+                dirname = os.path.dirname(path)
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                # continue partial download only if server responded with requested range
+                resumed = partial if partial > 0 and response.status == 206 and \
+                          response.headers.get('CONTENT-RANGE', '').startswith('bytes %i-' % partial) else 0
+                f = open(tmp_path, 'ab' if resumed else 'wb')
+                #return HTTPDownload(True, True, response.headers, response.status)
+            except:
+                # NOTE: debug
+                traceback.print_exc()
+                return HTTPResponse(None, -1)
+                #return HTTPDownload(False, False, response.headers, response.status)
+            content_hash = hashlib.new(digest) if digest else None
+            md5_hash = hashlib.new('md5') if md5 else None
+            hashes = [h for h in (content_hash, md5_hash) if h]
+            if resumed and hashes:
+                await loop.run_in_executor(None, file_digest, tmp_path, None, hashes)
+            skip, remaining = (byterange[1], byterange[0]) if byterange and response.status == 200 else (0, None)
+            try:
+                with f:
+                    while remaining != 0:
+                        chunk = await response.content.read(download_chunk_size)
+                        if not chunk:
+                            break
+                        if skip:
+                            if len(chunk) <= skip:
+                                skip -= len(chunk)
+                                continue
+                            chunk, skip = chunk[skip:], 0
+                        if remaining is not None:
+                            chunk = chunk[:remaining]
+                            remaining -= len(chunk)
+                        for bucket in throttle or ():
+                            await bucket.consume(len(chunk))
+                        f.write(chunk)
+                        for h in hashes:
+                            h.update(chunk)
+                if md5_hash and md5_hash.hexdigest() != md5:
+                    os.remove(tmp_path)
+                    print('warning: MD5 of %s does not match ETag, discarded' % url)
+                    return HTTPResponse(response.headers, -1)
+                os.replace(tmp_path, path)
+            except BaseException as e:
+                # partial download is kept to be resumed after network error, not when cancelled (hedge lost,
+                # deadline reached: never resumed) or segment is stored anyway
+                keep = resume and not byterange and not isinstance(e, asyncio.CancelledError) and not os.path.exists(path)
+                if os.path.exists(tmp_path) and not (keep and os.path.getsize(tmp_path)):
+                    os.remove(tmp_path)
+                raise
             # content = content.decode('utf8', errors='ignore')
-            return HTTPResponse(response.headers, response.status)
+            return HTTPResponse(response.headers, response.status, content_hash.hexdigest() if content_hash else None,
+                                resumed=resumed)
             #return HTTPDownload(True, False, response.headers, response.status)
         finally:
-            response.close()
+            # connection is reused only if content was read completely
+            if response.content.at_eof():
+                await response.release()
+            else:
+                response.close()
 
 async def request(url, params=None, data=None, method=None, headers=None):
     if method is None:
         method = 'GET' if data is None else 'POST'
-    async with aiohttp.ClientSession() as session:
+    async with shared_session() as session:
         async with session.request(method, prep_url(url), params=params, data=data, headers=headers) as response:
             content = await response.content.read()
             # content = content.decode('utf8', errors='ignore')
@@ -73,33 +226,449 @@ async def request(url, params=None, data=None, method=None, headers=None):
 
 
 class AsyncScheduler:
-    def __init__(self, max_count=None, loop=None):
+    """Runs coroutines with limited concurrency. Queued coroutines are started by priority (lower first,
+    FIFO within the same priority); running coroutines are cancelled when their deadline is reached."""
+    def __init__(self, max_count=None, loop=None, max_queued=None):
         self.max_count = max_count
+        self.max_queued = max_queued    # producers awaiting ready() are held back while queue is full
         self.loop = loop
-        self.coroutines = deque()
+        self.coroutines = []            # heap of queue entries
+        self.counter = 0                # keeps FIFO order within the same priority
         self.tasks = set()
-        self.stop = False
+        self.expiring = {}              # task -> deadline timer handle
+        self.expired_tasks = set()
+        self.waiters = deque()          # producers waiting for free queue slot
+        self._stop = False
+        # statistics
+        self.started = 0
+        self.expired = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+    Entry = namedtuple('Entry', 'priority, counter, coroutine, deadline, on_expire, queued')
+    @property
+    def stop(self):
+        return self._stop
+    @stop.setter
+    def stop(self, value):
+        self._stop = value
+        if value:
+            self.release_waiters()
+    def release_waiters(self):
+        # producers blocked in ready() return, nothing more will be started
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
     async def wait(self, stop=None):
         if stop is not None:
             self.stop = stop
+        self.release_waiters()
         if self.tasks:
-            for coroutine in self.coroutines:
-                asyncio.ensure_future(coroutine).cancel()
+            for entry in self.coroutines:
+                asyncio.ensure_future(entry.coroutine, loop=self.loop).cancel()
+            self.coroutines.clear()
             # print(asyncio.gather(iter(self.coroutines)).cancel())
             await asyncio.wait(self.tasks, loop=self.loop)   # wait for tasks to complete
+    async def ready(self):
+        """Wait until there is space in queue (back-pressure for producer)"""
+        while self.max_queued is not None and len(self.coroutines) >= self.max_queued and not self.stop:
+            waiter = asyncio.Future(loop=self.loop)
+            self.waiters.append(waiter)
+            await waiter
+    @property
+    def stats(self):
+        return dict(running=len(self.tasks), queued=len(self.coroutines), started=self.started,
+                    expired=self.expired, max_wait_time=self.max_wait_time,
+                    avg_wait_time=self.total_wait_time / self.started if self.started else 0.0)
     def __bool__(self):
         return bool(self.tasks) # any running coroutines
     def __len__(self):
         return len(self.tasks) + len(self.coroutines)
-    def __call__(self, coroutine=None):
+    def __call__(self, coroutine=None, priority=0, deadline=None, on_expire=None):
+        """Schedule coroutine; deadline is absolute time (time.time()), on_expire is called if coroutine
+        is cancelled or dropped because the deadline is reached"""
         if coroutine is not None:
-            self.coroutines.append(coroutine)
+            self.counter += 1
+            heapq.heappush(self.coroutines, self.Entry(priority, self.counter, coroutine, deadline, on_expire, time.time()))
         # while len(self.tasks) < self.max_count and self.coroutines:
-        if (self.max_count is None or len(self.tasks) < self.max_count) and self.coroutines:
-            coroutine = self.coroutines.popleft()
-            task = asyncio.ensure_future(coroutine, loop=self.loop)
+        while (self.max_count is None or len(self.tasks) < self.max_count) and self.coroutines:
+            entry = heapq.heappop(self.coroutines)
+            while self.waiters:
+                waiter = self.waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    break
+            now = time.time()
+            if entry.deadline is not None and entry.deadline <= now:
+                # missed deadline before even started
+                entry.coroutine.close()
+                self.expired += 1
+                if entry.on_expire:
+                    entry.on_expire()
+                continue
+            wait_time = now - entry.queued
+            self.started += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            task = asyncio.ensure_future(entry.coroutine, loop=self.loop)
             self.tasks.add(task)
-            task.add_done_callback(lambda task: self.tasks.remove(task) or self.stop or self())
+            if entry.deadline is not None:
+                loop = self.loop or asyncio.get_event_loop()
+                self.expiring[task] = loop.call_later(entry.deadline - now, self.expire, task)
+            task.add_done_callback(lambda task, entry=entry: self.done(task, entry))
+    def expire(self, task):
+        self.expiring.pop(task, None)
+        if not task.done():
+            self.expired_tasks.add(task)
+            task.cancel()
+    def done(self, task, entry):
+        self.tasks.remove(task)
+        handle = self.expiring.pop(task, None)
+        if handle:
+            handle.cancel()
+        if task in self.expired_tasks:
+            self.expired_tasks.remove(task)
+            self.expired += 1
+            if entry.on_expire:
+                entry.on_expire()
+        if not self.stop:
+            self()
+
+
+class DownloadHedger:
+    """Issues a second (hedge) request when a download takes longer than a latency percentile of the feed;
+    whichever request completes first wins and the other is cancelled"""
+    def __init__(self, percentile=95, window=200, min_samples=20, min_delay=0.5, max_ratio=0.1, loop=None):
+        self.percentile = percentile
+        self.min_samples = min_samples      # no hedging until enough latencies are known
+        self.min_delay = min_delay          # never hedge sooner than this (seconds)
+        self.max_ratio = max_ratio          # cap extra load: at most this fraction of requests are hedged
+        self.loop = loop
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0                       # hedge request completed before the original one
+    @property
+    def delay(self):
+        if len(self.latencies) < self.min_samples:
+            return None
+        latencies = sorted(self.latencies)
+        i = min(len(latencies)-1, int(len(latencies) * self.percentile / 100))
+        return max(self.min_delay, latencies[i])
+    @property
+    def hedge_rate(self):
+        return self.hedges / self.requests if self.requests else 0.0
+    @property
+    def stats(self):
+        return dict(requests=self.requests, hedges=self.hedges, wins=self.wins,
+                    hedge_rate=self.hedge_rate, delay=self.delay)
+    def allow_hedge(self):
+        return self.hedges < self.max_ratio * self.requests
+    async def __call__(self, url, path, **kwargs):
+        self.requests += 1
+        start = time.time()
+        primary = asyncio.ensure_future(download_to_file(url, path, suffix='.part', **kwargs), loop=self.loop)
+        pending = {primary}
+        try:
+            delay = self.delay
+            if delay is not None:
+                done, pending = await asyncio.wait(pending, timeout=delay, loop=self.loop)
+                if pending and self.allow_hedge():
+                    self.hedges += 1
+                    pending.add(asyncio.ensure_future(download_to_file(url, path, suffix='.hedge', resume=False, **kwargs), loop=self.loop))
+                pending |= done
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED, loop=self.loop)
+                for task in done:
+                    if not task.exception() and task.result().status in (200, 206):
+                        if task is not primary:
+                            self.wins += 1
+                        self.latencies.append(time.time() - start)
+                        return task.result()
+            # all requests failed, report as if there was no hedge
+            return primary.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+class ContentStore:
+    """Content addressed storage of segments: first file with given content is hard linked as blob
+    (<dirname>/<digest[:2]>/<digest>), files with the same content are replaced by hard link of the blob.
+    Blobs of recent downloads are also known by MD5 ETag of origin, such content is linked without
+    being downloaded and written again (see download_to_file)"""
+    max_etags = 10000
+    def __init__(self, dirname, algorithm='sha1'):
+        self.dirname = dirname
+        self.algorithm = algorithm
+        self.etags = OrderedDict()  # MD5 ETag -> digest of stored content
+        self.stored = 0
+        self.duplicates = 0
+        self.bytes_saved = 0
+        self.bytes_collected = 0
+    def blob_path(self, digest):
+        return os.path.join(self.dirname, digest[:2], digest)
+    def store(self, path, digest, etag=None):
+        """Deduplicate file at path with given content digest; returns True if content was already stored"""
+        blob = self.blob_path(digest)
+        if etag:
+            self.etags[etag] = digest
+            self.etags.move_to_end(etag)
+            if len(self.etags) > self.max_etags:
+                self.etags.popitem(last=False)
+        try:
+            if os.path.exists(blob):
+                stat = os.stat(path)
+                if os.path.samefile(blob, path):
+                    return True
+                os.link(blob, path + '.link')
+                os.replace(path + '.link', path)
+                self.duplicates += 1
+                self.bytes_saved += stat.st_size
+                return True
+            dirname = os.path.dirname(blob)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            os.link(path, blob)
+            self.stored += 1
+        except OSError as e:
+            print('warning: unable to deduplicate %s: %s' % (path, e))
+        return False
+    def link(self, etag, size, path):
+        """Link blob of content with MD5 ETag to path; returns size of linked content, 0 if not stored"""
+        digest = self.etags.get(etag) if etag else None
+        if digest is None:
+            return 0
+        blob = self.blob_path(digest)
+        try:
+            if size is None or os.path.getsize(blob) != size:
+                return 0
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            os.link(blob, path + '.link')
+            os.replace(path + '.link', path)
+        except OSError:
+            # blob collected (retention)
+            self.etags.pop(etag, None)
+            return 0
+        self.duplicates += 1
+        self.bytes_saved += size
+        return size
+    def collect(self):
+        """Remove blobs not linked by any file; returns number of removed blobs"""
+        removed = 0
+        for dirpath, dirnames, filenames in os.walk(self.dirname):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_nlink == 1:
+                        os.remove(path)
+                        removed += 1
+                        self.bytes_collected += stat.st_size
+                except OSError:
+                    pass
+        return removed
+    @property
+    def stats(self):
+        return dict(stored=self.stored, duplicates=self.duplicates, bytes_saved=self.bytes_saved)
+
+
+def parse_http_datetime(string, default=None):
+    if string:
+        for fmt in ['%a, %d %b %Y %H:%M:%S %Z']:
+            try:
+                return datetime.strptime(string, fmt)
+            except ValueError:
+                pass
+    return default
+
+
+class OriginClock:
+    """Clock offset of origin server (origin time minus local UTC time) estimated from Date headers.
+    Date has 1 second resolution, but each response bounds the offset by request send and receive times,
+    so intersection of bounds of many responses converges. Bounds are shared through file by all feeds
+    (processes) of the same origin host."""
+    max_age = 3600      # seconds, bounds older than that are discarded (clock drift)
+    save_interval = 60  # seconds between saves, unless bounds are narrowed
+    def __init__(self, path=None):
+        self.path = path
+        self.low = None     # offset bounds in seconds
+        self.high = None
+        self.updated = 0
+        self.saved = 0
+        self.load()
+    @property
+    def offset(self):
+        if self.low is None or time.time() - self.updated > self.max_age:
+            return None
+        return (self.low + self.high) / 2
+    @property
+    def accuracy(self):
+        return (self.high - self.low) / 2 if self.offset is not None else None
+    def now(self, local=None):
+        """Origin time at local UTC time (now by default)"""
+        return (local or datetime.utcnow()) + timedelta(seconds=self.offset or 0)
+    def sample(self, date, sent, received):
+        """Add bounds of response with Date header date (datetime), request sent and response received
+        at local UTC times"""
+        if date is None:
+            return
+        low = (date - received).total_seconds()
+        high = (date + timedelta(seconds=1) - sent).total_seconds()
+        narrowed = self.merge(low, high, time.time())
+        if self.path and (narrowed or time.time() - self.saved > self.save_interval):
+            self.save()
+    def merge(self, low, high, updated):
+        """Intersect bounds, returns True if bounds were narrowed"""
+        if self.offset is None:
+            self.low, self.high = low, high
+        elif low > self.high or high < self.low:
+            # origin clock jumped: start over with newer bounds
+            if updated < self.updated:
+                return False
+            self.low, self.high = low, high
+        elif low > self.low or high < self.high:
+            self.low, self.high = max(low, self.low), min(high, self.high)
+        else:
+            self.updated = max(self.updated, updated)
+            return False
+        self.updated = max(self.updated, updated)
+        return True
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+            if time.time() - state['updated'] <= self.max_age:
+                self.merge(state['low'], state['high'], state['updated'])
+        except (TypeError, OSError, ValueError, KeyError):
+            pass
+    def save(self):
+        """Merge bounds saved by other processes and save result"""
+        self.load()
+        try:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname, exist_ok=True)
+            tmp_path = '%s.%i.tmp' % (self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(dict(low=self.low, high=self.high, updated=self.updated), f)
+            os.replace(tmp_path, self.path)
+            self.saved = time.time()
+        except OSError as e:
+            print('warning: unable to save origin clock %s: %s' % (self.path, e))
+
+
+class TokenBucket:
+    """Token bucket bandwidth limit: rate in bytes per second, burst in bytes. With shared=True the bucket
+    state is kept in shared memory, so a bucket created before feed processes are started limits them all
+    together. Throttling statistics are counted per process."""
+    def __init__(self, rate, burst=None, shared=False, name='feed'):
+        self.name = name
+        self.rate = rate
+        self.burst = burst or rate
+        if shared:
+            self.state = Array('d', [self.burst, time.time()], lock=False)    # tokens, last update
+            self.lock = Lock()
+        else:
+            self.state = [self.burst, time.time()]
+            self.lock = None
+        self.bytes = 0
+        self.throttled = 0          # number of times transfer was paused
+        self.throttled_time = 0.0   # total seconds transfers were paused
+    @property
+    def stats(self):
+        return dict(name=self.name, rate=self.rate, burst=self.burst, bytes=self.bytes,
+                    throttled=self.throttled, throttled_time=self.throttled_time)
+    def take(self, amount):
+        """Take amount of tokens (may go into debt), returns seconds to wait until the debt is paid"""
+        if self.lock:
+            self.lock.acquire()
+        try:
+            now = time.time()
+            tokens = min(self.burst, self.state[0] + (now - self.state[1]) * self.rate) - amount
+            self.state[0] = tokens
+            self.state[1] = now
+        finally:
+            if self.lock:
+                self.lock.release()
+        return -tokens / self.rate if tokens < 0 else 0
+    async def consume(self, amount):
+        self.bytes += amount
+        delay = self.take(amount)
+        if delay > 0:
+            self.throttled += 1
+            self.throttled_time += delay
+            await asyncio.sleep(delay)
+
+
+class DownloadBudget:
+    """Download concurrency budget shared by all feed processes. Free slots are shared fairly between
+    feeds with running or waiting downloads, and each feed is always allowed a minimum number of slots.
+    Must be created before feed processes are started; limit and minimum can be changed at runtime."""
+    poll_interval = 0.05    # seconds between attempts to acquire a slot
+    def __init__(self, limit, feeds, minimum=1):
+        self._limit = Value('i', limit, lock=False)
+        self._minimum = Value('i', minimum, lock=False)
+        self.in_use = Array('i', feeds, lock=False)
+        self.waiting = Array('i', feeds, lock=False)
+        self.lock = Lock()
+    @property
+    def limit(self):
+        return self._limit.value
+    @limit.setter
+    def limit(self, value):
+        with self.lock:
+            self._limit.value = value
+    @property
+    def minimum(self):
+        return self._minimum.value
+    @minimum.setter
+    def minimum(self, value):
+        with self.lock:
+            self._minimum.value = value
+    @property
+    def stats(self):
+        with self.lock:
+            return dict(limit=self.limit, minimum=self.minimum, in_use=list(self.in_use),
+                        waiting=list(self.waiting), share=self.share())
+    def share(self):
+        """Fair share of single feed, must be called with lock held"""
+        active = sum(1 for used, waiting in zip(self.in_use, self.waiting) if used or waiting) or 1
+        return max(self.minimum, self.limit // active)
+    def try_acquire(self, feed):
+        with self.lock:
+            used = self.in_use[feed]
+            if used < self.minimum or (sum(self.in_use) < self.limit and used < self.share()):
+                self.in_use[feed] = used + 1
+                return True
+            return False
+    async def acquire(self, feed):
+        with self.lock:
+            self.waiting[feed] += 1
+        try:
+            while not self.try_acquire(feed):
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            with self.lock:
+                self.waiting[feed] -= 1
+    def release(self, feed):
+        with self.lock:
+            self.in_use[feed] -= 1
+    def feed(self, feed):
+        return FeedDownloadBudget(self, feed)
+
+
+class FeedDownloadBudget:
+    """Single feed's handle to shared DownloadBudget, use as: async with budget: ..."""
+    def __init__(self, budget, feed):
+        self.budget = budget
+        self.feed = feed
+    async def __aenter__(self):
+        await self.budget.acquire(self.feed)
+    async def __aexit__(self, exc_type, exc, tb):
+        self.budget.release(self.feed)
 
 
 class ChunkNotifier:
@@ -108,6 +677,11 @@ class ChunkNotifier:
         self.metadata = {} if metadata is None else metadata
         self.scheduler = AsyncScheduler(1, loop=loop)   # one by one
         self.retry_sleep = retry_sleep
+        stream_id = self.metadata.get('id') if self.metadata and isinstance(self.metadata, dict) else self.metadata
+        self.notify_seconds = chunk_notify_seconds.labels(feed=stream_id)
+        backlog = chunk_notify_backlog.labels(feed=stream_id)
+        metrics.REGISTRY.add_collector(lambda: backlog.set(len(self.scheduler)))
+        self.delivered = 0
     async def send(self, data):
         stream_id = self.metadata.get('id') if self.metadata and isinstance(self.metadata, dict) else self.metadata
         exception = None
@@ -116,10 +690,12 @@ class ChunkNotifier:
             if self.scheduler.stop:
                 break
             try:
-                response = await request(self.endpoint, data=json.dumps(data, ensure_ascii=False), headers={'Content-Type': 'application/json'})
+                with tracing.span('notify', attempt=i):
+                    response = await request(self.endpoint, data=json.dumps(data, ensure_ascii=False), headers={'Content-Type': 'application/json'})
                 if response.status == 200 or response.status == 201:
                     print('Chunk for stream %s successfully submitted' % (self.metadata and self.metadata.get('id')))
-                    break
+                    self.delivered += 1
+                    return True
                 print('Stream %s: error submitting chunk, HTTP response code:' % stream_id, response.status, file=sys.stderr)
             except (ClientOSError, ClientResponseError, ServerDisconnectedError, concurrent.futures.TimeoutError) as e:
                 print('Stream %s: error submitting chunk at this time, will try again after %i seconds.'
@@ -132,23 +708,60 @@ class ChunkNotifier:
             await asyncio.sleep(self.retry_sleep)
         print('Stream %s: giving up submitting chunk, last error was:' % stream_id,
                 (exception or response and 'HTTP response %s'+str(response.status)), file=sys.stderr)
+        return False
     async def notify(self, path, start=None, end=None):
         data = dict(self.metadata, path=path)
         await self.send(data)
+    async def timed_notify(self, closed, **kwargs):
+        delivered = self.delivered
+        await self.notify(**kwargs)
+        if self.delivered > delivered:
+            self.notify_seconds.observe(time.time() - closed)
     def __call__(self, path, start=None, end=None, **kwargs):
-        self.scheduler(self.notify(path=path, start=start, end=end, **kwargs))
+        self.scheduler(self.timed_notify(time.time(), path=path, start=start, end=end, **kwargs))
 
 
 class SegmentsListStorage:
-    def __init__(self, timeout=300):    # default timeout: 5 minutes
+    """Reorder buffer: items are promised in order, completed in any order and written in promise order.
+    Segments still downloading are cancelled when their timeout is reached (timer) or when more than
+    max_pending items are buffered (overflow='cancel'); with overflow='wait' producers awaiting ready()
+    are held back instead."""
+    def __init__(self, timeout=300, max_pending=1000, overflow='cancel', loop=None):    # default timeout: 5 minutes
         self.timeout = timeout  # failsafe: promised items will be canceled after timeout is reached
-        self.pending = deque()
-    def promise(self, item):
+        self.max_pending = max_pending
+        self.overflow = overflow
+        self.loop = loop
+        self.feed = None
+        self.pending = {}       # promise counter -> (item, promise time)
+        self.head = 0           # counter of the first item not written yet
+        self.counter = 0        # counter of the next promised item
+        self.timeouts = []      # heap of (timeout, promise counter) of segments
+        self.timer = None       # timer handle of the earliest timeout
+        self.timer_at = None
+        self.waiters = deque()  # producers waiting for space in buffer (overflow='wait')
+        self._stop = False
+        # statistics
+        self.written = 0
+        self.timed_out = 0
+        self.overflowed = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+    def promise(self, item, timeout=None):
+        counter = self.counter
+        self.counter += 1
+        now = time.time()
+        self.pending[counter] = (item, now)
         if type(item) is HLSSegment:
             item.status = 0
-            item.timeout = time.time() + self.timeout   # downloadable HLS segment items will be automatically cancelled if the timeout is reached
+            item.timeout = now + (self.timeout if timeout is None else timeout)   # downloadable HLS segment items will be automatically cancelled if the timeout is reached
+            item.promise = counter
+            heapq.heappush(self.timeouts, (item.timeout, counter))
+            self.schedule()
             # NOTE: HLSTag and subclasses are expected to have always status = 1
-        self.pending.append(item)
+        elif counter == self.head:
+            self.flush()
+        if self.max_pending and len(self.pending) > self.max_pending and self.overflow == 'cancel':
+            self.cancel_overflow()
     def cancel(self, item):
         item.status = -1
         self.flush()
@@ -156,21 +769,92 @@ class SegmentsListStorage:
         item.status = 1
         self.flush()
     def replace(self, item, replacement):
-        try:
-            i = self.pending.index(item)
-            self.pending[i] = replacement
-            flush()
-            return True
-        except ValueError:
+        counter = getattr(item, 'promise', None)
+        entry = self.pending.get(counter)
+        if entry is None or entry[0] is not item:
             return False
+        self.pending[counter] = (replacement, entry[1])
+        self.flush()
+        return True
+    @property
+    def stop(self):
+        return self._stop
+    @stop.setter
+    def stop(self, value):
+        self._stop = value
+        while value and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+    async def ready(self):
+        """Wait until there is space in buffer (back-pressure for producer, overflow='wait' only)"""
+        while self.overflow == 'wait' and self.max_pending and len(self.pending) >= self.max_pending and not self.stop:
+            waiter = asyncio.Future(loop=self.loop)
+            self.waiters.append(waiter)
+            await waiter
+    @property
+    def stats(self):
+        return dict(pending=len(self.pending), written=self.written, timed_out=self.timed_out,
+                    overflowed=self.overflowed, max_wait_time=self.max_wait_time,
+                    avg_wait_time=self.total_wait_time / self.written if self.written else 0.0)
     def flush(self):
+        with tracing.span('flush', pending=len(self.pending)):
+            self._flush()
+    def _flush(self):
+        pending = self.pending
+        while self.head in pending:
+            item, promised = pending[self.head]
+            if type(item) is HLSSegment and item.status == 0:
+                break
+            del pending[self.head]
+            self.head += 1
+            wait_time = time.time() - promised
+            self.written += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            reorder_wait_seconds.labels(feed=self.feed).observe(wait_time)
+            self.write(item)
+        while self.waiters and (not self.max_pending or len(pending) < self.max_pending):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+    def cancel_overflow(self):
+        # give up on the oldest segments until buffer fits
+        while len(self.pending) > self.max_pending:
+            item = self.pending[self.head][0]
+            if type(item) is HLSSegment and item.status == 0:
+                print('warning: reorder buffer full (%i items), segments item cancelled' % len(self.pending))
+                item.status = -1
+                self.overflowed += 1
+            self.flush()
+    def schedule(self):
+        # drop timeouts of written items, (re)arm timer for the earliest one
+        timeouts = self.timeouts
+        while timeouts and timeouts[0][1] < self.head:
+            heapq.heappop(timeouts)
+        if not timeouts or (self.timer is not None and self.timer_at <= timeouts[0][0]):
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        loop = self.loop or asyncio.get_event_loop()
+        self.timer_at = timeouts[0][0]
+        self.timer = loop.call_later(max(0, self.timer_at - time.time()), self.expire)
+    def expire(self):
+        self.timer = self.timer_at = None
         now = time.time()
-        while self.pending and (type(self.pending[0]) is not HLSSegment or self.pending[0].status != 0 or self.pending[0].timeout >= now):
-            item = self.pending.popleft()
-            if type(item) is HLSSegment and item.status == 0 and item.timeout >= now:
+        while self.timeouts and self.timeouts[0][0] <= now:
+            timeout, counter = heapq.heappop(self.timeouts)
+            entry = self.pending.get(counter)
+            if entry and type(entry[0]) is HLSSegment and entry[0].status == 0:
                 print('warning: segments item timeout reached, item cancelled')
-                item.status = -1    # timeout reached, mark as cancelled
-            self.write(item)
+                entry[0].status = -1    # timeout reached, mark as cancelled
+                self.timed_out += 1
+        self.flush()
+        self.schedule()
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = self.timer_at = None
     def write(self, item):
         raise NotImplemented('write must be implemented')
 
@@ -195,7 +879,7 @@ class Formatter:
             if hasattr(item, 'epoch') and item.epoch:
                 t = time.strftime("%Y-%m-%d_%H-%M-%S", time.gmtime(item.epoch))
                 args['timestamp'] = t
-            elif seq:
+            elif seq is not None:
                 args['timestamp'] = seq
             args.update(kwargs)
             return item.datetime.strftime(template).format_map(args)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+import os, sys, json, time, random, logging, signal
+import atexit
+
+# Lightweight span tracing of feed processing stages (pull -> store -> chunk -> notify).
+# Spans are sampled: all stages of the same segment sequence are either traced or not;
+# spans without segment sequence are sampled randomly. Output is either JSON lines or
+# Chrome trace event format (open in chrome://tracing or https://ui.perfetto.dev).
+
+logger = logging.getLogger(__name__)
+
+
+class NullSpan:
+    """Span of disabled tracer, does nothing"""
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        return False
+    def tag(self, **tags):
+        pass
+
+null_span = NullSpan()
+
+
+class Span:
+    def __init__(self, tracer, name, seq, tags):
+        self.tracer = tracer
+        self.name = name
+        self.seq = seq
+        self.tags = tags
+        self.start = None
+    def __enter__(self):
+        self.start = time.time()
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.tags['error'] = exc_type.__name__
+        self.tracer.emit(self.name, self.start, time.time(), self.seq, self.tags)
+        return False
+    def tag(self, **tags):
+        self.tags.update(tags)
+
+
+class Tracer:
+    flush_every = 100   # events
+
+    def __init__(self, path=None, feed=None, sample_rate=0.0, format='jsonl'):
+        self.path = path
+        self.feed = feed
+        self.sample_rate = sample_rate if path else 0.0
+        self.format = format
+        self.file = None
+        self.pending = 0
+        self.pid = os.getpid()
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    def sampled(self, seq=None):
+        if self.sample_rate <= 0:
+            return False
+        if self.sample_rate >= 1:
+            return True
+        if seq is None:
+            return random.random() < self.sample_rate
+        # deterministic for sequence (multiplicative hashing), so that all stages of a segment are traced
+        return (seq * 2654435761) % 2**32 < self.sample_rate * 2**32
+
+    def span(self, name, seq=None, **tags):
+        """Context manager measuring a stage: with tracer.span('download', seq=item.sequence): ..."""
+        if not self.sampled(seq):
+            return null_span
+        return Span(self, name, seq, tags)
+
+    def record(self, name, start, end, seq=None, **tags):
+        """Record span with known start and end times (seconds since epoch)"""
+        if self.sampled(seq):
+            self.emit(name, start, end, seq, tags)
+
+    def emit(self, name, start, end, seq, tags):
+        if self.file is None:
+            self.open()
+        tags = dict(tags, feed=self.feed)
+        if seq is not None:
+            tags['seq'] = seq
+        if self.format == 'chrome':
+            event = dict(name=name, cat='hlschunker', ph='X', ts=int(start*1e6), dur=int((end-start)*1e6),
+                         pid=self.pid, tid=seq if seq is not None else 0, args=tags)
+            self.file.write(json.dumps(event, default=str) + ',\n')
+        else:
+            event = dict(tags, name=name, start=start, duration=end-start)
+            self.file.write(json.dumps(event, default=str) + '\n')
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def open(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self.file = open(self.path, 'a')
+        if self.format == 'chrome' and new:
+            # JSON array format; trace viewers accept the array without closing bracket
+            self.file.write('[\n')
+        atexit.register(self.close)
+
+    def flush(self):
+        if self.file:
+            self.file.flush()
+        self.pending = 0
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+# process wide tracer, disabled until configured
+tracer = Tracer()
+
+def configure(path, feed=None, sample_rate=0.01, format='jsonl'):
+    global tracer
+    tracer.close()
+    tracer = Tracer(path, feed, sample_rate, format)
+    return tracer
+
+def span(name, seq=None, **tags):
+    return tracer.span(name, seq, **tags)
+
+def record(name, start, end, seq=None, **tags):
+    tracer.record(name, start, end, seq, **tags)
+
+
+class Profiler:
+    """On signal (default SIGUSR1) profiles the process with cProfile and tracemalloc for a while and
+    dumps results to directory: profile-<time>.pstats (view with python -m pstats or snakeviz) and
+    tracemalloc-<time>.snapshot (load with tracemalloc.Snapshot.load)"""
+    def __init__(self, dirname, duration=30, loop=None, signum=signal.SIGUSR1):
+        self.dirname = dirname
+        self.duration = duration
+        self.loop = loop
+        self.signum = signum
+        self.profile = None
+    def install(self):
+        import asyncio
+        loop = self.loop or asyncio.get_event_loop()
+        loop.add_signal_handler(self.signum, self.start)
+        logger.info('Profiling trigger installed: kill -%s %i' % (self.signum.name if hasattr(self.signum, 'name') else self.signum, os.getpid()))
+        return self
+    def start(self):
+        import asyncio, cProfile, tracemalloc
+        if self.profile is not None:
+            logger.info('Profiling already in progress')
+            return
+        logger.info('Profiling for %s seconds' % self.duration)
+        tracemalloc.start()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        loop = self.loop or asyncio.get_event_loop()
+        loop.call_later(self.duration, self.stop)
+    def stop(self):
+        import tracemalloc
+        if self.profile is None:
+            return
+        self.profile.disable()
+        if not os.path.isdir(self.dirname):
+            os.makedirs(self.dirname)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(self.dirname, 'profile-%s.pstats' % stamp)
+        self.profile.dump_stats(path)
+        self.profile = None
+        snapshot_path = os.path.join(self.dirname, 'tracemalloc-%s.snapshot' % stamp)
+        tracemalloc.take_snapshot().dump(snapshot_path)
+        tracemalloc.stop()
+        logger.info('Profile written to %s and %s' % (path, snapshot_path))
+
+
+if __name__ == "__main__":
+
+    # summarize JSON lines trace: per stage count, mean and max duration
+    if len(sys.argv) == 1:
+        print('usage: %s [trace.jsonl]' % sys.argv[0])
+        sys.exit(0)
+
+    stages = {}
+    with open(sys.argv[1]) as f:
+        for line in f:
+            event = json.loads(line)
+            stages.setdefault(event['name'], []).append(event['duration'])
+    for name, durations in sorted(stages.items(), key=lambda item: -sum(item[1])):
+        print('%-16s count=%-8i total=%10.3fs mean=%8.2fms max=%8.2fms'
+              % (name, len(durations), sum(durations), sum(durations)/len(durations)*1e3, max(durations)*1e3))
@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 
-import sys, os, json, logging
+import sys, os, json, logging, time, shutil
 from datetime import datetime, timedelta
 from collections import namedtuple
 import asyncio
 import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor
 
 # for debugging
 from inspect import currentframe, getframeinfo
@@ -17,11 +18,53 @@ from aiohttp.errors import *
 from tail import tail_lines_backwards_yield
 from index import HLSSegment, HLSTag, HLSDiscontinuity, HLSPullDiscontinuity, HLSPullError, \
                     HLSSourceDiscontinuity, HLSEnd, HLSSourceEnd, HLSChunkEnd
-from storage import Formatter, SegmentsListStorage, AsyncScheduler, download_to_file
+from storage import Formatter, SegmentsListStorage, AsyncScheduler, DownloadHedger, TokenBucket, ContentStore, \
+                    download_to_file, etag_md5
+import metrics
+import tracing
+import mpegts
 
 
 logger = logging.getLogger(__name__)
 
+segment_download_seconds = metrics.Histogram('hlschunker_segment_download_seconds',
+                                             'Segment download time', ['feed'])
+segment_download_throughput = metrics.Histogram('hlschunker_segment_download_throughput_bytes_per_second',
+                                                'Segment download throughput', ['feed'],
+                                                buckets=metrics.throughput_buckets)
+segment_bytes_written = metrics.Counter('hlschunker_segment_bytes_written_total', 'Segment bytes written', ['feed'])
+segments_stored = metrics.Counter('hlschunker_segments_total', 'Segments by download result', ['feed', 'result'])
+download_queue_depth = metrics.Gauge('hlschunker_download_queue_depth', 'Segment downloads waiting in queue', ['feed'])
+downloads_running = metrics.Gauge('hlschunker_downloads_running', 'Segment downloads in progress', ['feed'])
+downloads_started = metrics.Counter('hlschunker_downloads_started_total', 'Segment downloads started', ['feed'])
+download_wait_seconds = metrics.Counter('hlschunker_download_wait_seconds_total',
+                                        'Total time segment downloads waited in queue', ['feed'])
+downloads_expired = metrics.Counter('hlschunker_downloads_expired_total',
+                                    'Segment downloads cancelled at deadline', ['feed'])
+reorder_pending = metrics.Gauge('hlschunker_reorder_pending_items',
+                                'Items waiting to be written in order to segment lists', ['feed'])
+reorder_cancelled = metrics.Counter('hlschunker_reorder_cancelled_total',
+                                    'Segments given up by reorder buffer', ['feed', 'reason'])
+hedge_requests = metrics.Counter('hlschunker_hedge_requests_total', 'Hedge requests issued', ['feed'])
+hedge_wins = metrics.Counter('hlschunker_hedge_wins_total', 'Hedge requests completed first', ['feed'])
+audio_extraction_seconds = metrics.Histogram('hlschunker_audio_extraction_seconds',
+                                            'Audio extraction time of segment', ['feed'])
+audio_extraction_bytes = metrics.Counter('hlschunker_audio_extraction_bytes_total',
+                                         'Bytes processed and written by audio extraction', ['feed', 'direction'])
+dedup_segments = metrics.Counter('hlschunker_dedup_segments_total', 'Segments by content deduplication result',
+                                 ['feed', 'result'])
+dedup_bytes_saved = metrics.Counter('hlschunker_dedup_bytes_saved_total',
+                                    'Bytes of duplicate segments replaced by links', ['feed'])
+chunk_pack_seconds = metrics.Histogram('hlschunker_chunk_pack_seconds', 'Time to pack segments of completed chunk',
+                                      ['feed'])
+download_bytes_avoided = metrics.Counter('hlschunker_download_bytes_avoided_total',
+                                         'Bytes not downloaded: existing segments kept, partial downloads resumed '
+                                         'or content linked from content store',
+                                         ['feed', 'reason'])
+throttled_seconds = metrics.Counter('hlschunker_throttled_seconds_total',
+                                    'Time downloads were paused by bandwidth limit', ['feed', 'limit'])
+
+
 class FileWriter:
     """Wrapper for writable file; main property: auto-open on write, auto-close on directory change"""
     def __init__(self, filename='', dirname='', root='', mode='a'):
@@ -280,14 +323,95 @@ class YAMLChunkList(YAMLWriter):
         self.last_action = item
 
 
+class ChunkPacker:
+    """Concatenates segments of completed chunk into single media file next to chunk list
+    (chunks/YYYY-MM-DD/HHMMSS.ts); chunk list items get offset and length of segment in packed file"""
+    ext = '.ts'
+    def __init__(self, root, remove_segments=False, loop=None, feed=None):
+        self.root = root
+        self.feed = feed
+        self.remove_segments = remove_segments  # remove packed segment files (audio extracted from them is kept)
+        self.loop = loop
+        self.lock = asyncio.Lock()              # chunks are packed (and notified) one at a time, in order
+        self.tasks = set()
+    @classmethod
+    def packed_path(cls, chunk_path):
+        return os.path.splitext(chunk_path)[0] + cls.ext
+    def pack(self, chunk_path):
+        """Pack chunk (path relative to root), returns number of packed segments and bytes; blocking"""
+        full_path = os.path.join(self.root, chunk_path)
+        packed_path = self.packed_path(full_path)
+        segments = YAMLChunker.read_chunk_segments(full_path, False)
+        if any(segment.offset is not None for segment in segments):
+            logger.warning('Chunk %s is already packed' % chunk_path)
+            return 0, 0
+        items = []
+        packed = []
+        offset = 0
+        try:
+            with open(packed_path + '.tmp', 'wb') as dst:
+                for segment in segments:
+                    try:
+                        with open(os.path.join(self.root, segment.path), 'rb') as src:
+                            shutil.copyfileobj(src, dst)
+                        segment = segment._replace(offset=offset, length=dst.tell() - offset)
+                        offset = dst.tell()
+                        packed.append(segment.path)
+                        items.append(list(segment))
+                    except FileNotFoundError:
+                        # missing segment stays in list as is
+                        logger.warning('Segment %s of chunk %s not found, not packed' % (segment.path, chunk_path))
+                        items.append(list(segment[:4]))
+            with open(full_path + '.tmp', 'w') as f:
+                for item in items:
+                    print('- %s' % json.dumps(item, default=YAMLWriter.json_serialize, ensure_ascii=False), file=f)
+            # packed file must be in place before chunk list refers to it
+            os.replace(packed_path + '.tmp', packed_path)
+            os.replace(full_path + '.tmp', full_path)
+        except:
+            for path in (packed_path + '.tmp', full_path + '.tmp'):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        if self.remove_segments:
+            for path in packed:
+                os.remove(os.path.join(self.root, path))
+        return len(packed), offset
+    def schedule(self, chunk_path, callback=None):
+        """Pack chunk in background, callback is called when done (also if packing fails)"""
+        loop = self.loop or asyncio.get_event_loop()
+        task = loop.create_task(self.run(chunk_path, callback))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+    async def run(self, chunk_path, callback=None):
+        async with self.lock:
+            loop = self.loop or asyncio.get_event_loop()
+            start = time.time()
+            try:
+                count, size = await loop.run_in_executor(None, self.pack, chunk_path)
+                chunk_pack_seconds.labels(feed=self.feed).observe(time.time() - start)
+                logger.info('Chunk %s packed: %i segments, %i bytes in %.3fs' % (chunk_path, count, size, time.time() - start))
+            except Exception as e:
+                logger.error('Packing chunk %s failed: %s' % (chunk_path, e))
+            if callback:
+                callback()
+    async def wait(self):
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
+
+
 class YAMLChunker:
     chunk_path_template = '%Y-%m-%d/%H%M%S.yaml'
-    ChunkSegment = namedtuple('ChunkSegment', 'sequence, duration, datetime, path')
+    # offset and length: byte range of segment in packed chunk file (see ChunkPacker)
+    ChunkSegment = namedtuple('ChunkSegment', 'sequence, duration, datetime, path, offset, length')
+    ChunkSegment.__new__.__defaults__ = (None, None)
     def __init__(self, formatter, notifier=None, list_dirname='',
                  chunk_dirname='chunks', root='', min_duration=5*60,
-                 metadata=None, **kwargs):
+                 metadata=None, packer=None, **kwargs):
         self.formatter = formatter
         self.notifier = notifier
+        self.packer = packer        # ChunkPacker: completed chunks are packed before notification
         self.min_duration = min_duration
         self.chunk_path_template = os.path.join(chunk_dirname, self.chunk_path_template)
         self.metadata = metadata
@@ -303,10 +427,15 @@ class YAMLChunker:
             self.projected_end = self.start + timedelta(seconds=self.min_duration)
         self._last_item = None
     def notify(self, start, end, path):
+        notify = None
         if self.notifier:
             prev_path = self.list.prev_chunk_end.path if self.list.prev_chunk_end else None
             next_path = end.strftime(self.chunk_path_template)
-            self.notifier(path=path, start=start, end=end, prev_path=prev_path, next_path=next_path)
+            notify = lambda: self.notifier(path=path, start=start, end=end, prev_path=prev_path, next_path=next_path)
+        if self.packer:
+            self.packer.schedule(path, notify)
+        elif notify:
+            notify()
     @classmethod
     def read_chunk_segments(cls, path, noexcept=True):
         try:
@@ -478,10 +607,11 @@ class YAMLSegmentsListWriter(YAMLIndexedItemListWriter):
 
 class SegmentsListYAMLStorage(SegmentsListStorage):
     def __init__(self, root, formatter=None, chunk_notifier=None, ext='ts',
-                 chunk_size=5*60, metadata=None, **kwargs):
+                 chunk_size=5*60, metadata=None, pack_chunks=None, **kwargs):
         super().__init__()
         self.root = root
         self.metadata = metadata
+        self.feed = metadata.get('id') if metadata and isinstance(metadata, dict) else metadata
         if not formatter:
             # formatter = YAMLFormatter('%Y-%m-%d/%H/{seq}.{ext}', '', '%Y-%m-%d/%H', ext=ext)
             formatter = YAMLFormatter('%Y-%m-%d/%H/{timestamp}.{ext}', '', '%Y-%m-%d/%H', ext=ext)
@@ -493,17 +623,52 @@ class SegmentsListYAMLStorage(SegmentsListStorage):
                 setattr(self, key, value)
             else:
                 raise ValueError('unknown keyword argument: %s' % key)
-        chunker = YAMLChunker(formatter, notifier=chunk_notifier, root=root,
-                              min_duration=chunk_size, metadata=metadata)
-        self.master = YAMLSegmentsListWriter(formatter, chunker=chunker, root=root)
-        self.sublists = [YAMLSegmentsListWriter(formatter.split(depth), root=root)
-                         for depth in range(1,len(formatter))]
+        # pack_chunks: True or dict(remove_segments=<bool>), see ChunkPacker
+        if pack_chunks:
+            pack_chunks = dict(pack_chunks) if type(pack_chunks) is dict else {}
+            self.packer = ChunkPacker(root, loop=self.loop, feed=self.feed, **pack_chunks)
+        else:
+            self.packer = None
+        self.chunk_notifier = chunk_notifier
+        self.chunk_size = chunk_size
+        self.open_lists()
+    def open_lists(self):
+        chunker = YAMLChunker(self.formatter, notifier=self.chunk_notifier, root=self.root,
+                              min_duration=self.chunk_size, metadata=self.metadata, packer=self.packer)
+        self.master = YAMLSegmentsListWriter(self.formatter, chunker=chunker, root=self.root)
+        self.sublists = [YAMLSegmentsListWriter(self.formatter.split(depth), root=self.root)
+                         for depth in range(1,len(self.formatter))]
     def load(self):
         self.master.load()
+    def reload(self):
+        """Load lists and chunk in progress again (written by other instance meanwhile, handover)"""
+        self.close()
+        self.open_lists()
     def close(self):
+        super().close()
+        self.master.close()
+        for lst in self.sublists:
+            lst.close()
+    async def drain(self, end_chunk=True):
+        """End chunk in progress with last stored segment (feed is stopped), wait until completed chunks
+        are packed and notified; end_chunk=False: chunk is continued by other instance (handover)"""
+        chunker = self.master.chunker
+        if chunker:
+            if end_chunk:
+                chunker.end()
+            if self.packer:
+                await self.packer.wait()
+            # queued notifications are started as running ones complete (scheduler.wait would cancel them)
+            scheduler = chunker.notifier.scheduler if chunker.notifier else None
+            while scheduler and scheduler.tasks:
+                await asyncio.wait(list(scheduler.tasks))
+    def reopen(self):
+        """Close list files to be reopened on next write (lists were rewritten, e.g. by retention)"""
         self.master.close()
         for lst in self.sublists:
             lst.close()
+        if self.master.chunker:
+            self.master.chunker.list.close()
     @property
     def last_item(self):
         return self.master.last_item
@@ -511,9 +676,10 @@ class SegmentsListYAMLStorage(SegmentsListStorage):
     def last_segment(self):
         return self.master.last_segment
     def write(self, item):
-        self.master.write(item)
-        for lst in self.sublists:
-            lst.write(item)
+        with tracing.span('yaml_write', seq=item.sequence if type(item) is HLSSegment else None):
+            self.master.write(item)
+            for lst in self.sublists:
+                lst.write(item)
     def resume(self):
         # open sublists to be resumed
         last = self.last_segment
@@ -525,33 +691,176 @@ class SegmentsListYAMLStorage(SegmentsListStorage):
 
 class YAMLSegmentsStorage:
 
+    report_interval = 100     # log download statistics every that many downloads
+    blobs_dirname = '.blobs'  # content store of deduplicated segments (in feed directory)
+
     def __init__(self, root, ext='ts', chunk_notifier=None, parallel_downloads=4,
-                 chunk_size=5*60, loop=None, metadata=None, **kwargs):
+                 chunk_size=5*60, loop=None, metadata=None, hedge=None, max_queued=100,
+                 budget=None, bandwidth_limit=None, throttle=None, reorder=None, extract_audio=None,
+                 deduplicate=None, pack_chunks=None, verify_existing=False, **kwargs):
 
         # create destination directory if not exist
         if not os.path.isdir(root):
             os.makedirs(root)
 
         self.root = root
+        # reorder: dict of reorder buffer options (timeout, max_pending, overflow)
         self.list = SegmentsListYAMLStorage(root, chunk_notifier=chunk_notifier,
                                             chunk_size=chunk_size, ext='ts',
-                                            metadata=metadata)
+                                            metadata=metadata, loop=loop, pack_chunks=pack_chunks,
+                                            **(reorder or {}))
         self.formatter = self.list.formatter
         # self.list.load()
 
         self.sequence = self.list.last_segment.sequence+1 if self.list.last_segment else 0
         self.loop = loop
         self.metadata = metadata
-        self.scheduler = AsyncScheduler(parallel_downloads, loop=loop)
+        self.scheduler = AsyncScheduler(parallel_downloads, loop=loop, max_queued=max_queued)
+        # hedge: True for defaults or dict of DownloadHedger arguments (percentile, max_ratio, ...)
+        self.hedger = DownloadHedger(loop=loop, **(hedge if type(hedge) is dict else {})) if hedge else None
+        self.budget = budget    # FeedDownloadBudget: share of download concurrency budget common for all feeds
+        # bandwidth_limit: bytes per second or dict(rate=..., burst=...) for this feed;
+        # throttle: list of additional (shared) TokenBucket objects
+        self.throttle = list(throttle or [])
+        if bandwidth_limit:
+            if type(bandwidth_limit) is not dict:
+                bandwidth_limit = dict(rate=bandwidth_limit)
+            self.throttle.insert(0, TokenBucket(**bandwidth_limit))
+        # extract_audio: True or dict(format='ts'|'adts', language=<code>, replace=<bool>, workers=<number>);
+        # audio of downloaded segments is extracted in worker processes (CPU bound)
+        if extract_audio:
+            extract_audio = dict(extract_audio) if type(extract_audio) is dict else {}
+            self.audio_format = extract_audio.get('format', 'ts')
+            self.audio_language = extract_audio.get('language')
+            self.audio_replace = extract_audio.get('replace', False)     # overwrite segment with extracted audio
+            self.extractor = ProcessPoolExecutor(extract_audio.get('workers', 1))
+        else:
+            self.extractor = None
+        # deduplicate: True or dict(algorithm=<hashlib name>, dir=<blobs directory>)
+        if deduplicate:
+            deduplicate = dict(deduplicate) if type(deduplicate) is dict else {}
+            self.content_store = ContentStore(deduplicate.get('dir') or os.path.join(root, self.blobs_dirname),
+                                              deduplicate.get('algorithm', 'sha1'))
+        else:
+            self.content_store = None
+        # existing segment is kept if its length matches, with verify_existing also MD5 of ETag
+        self.verify_existing = verify_existing
+        self.on_first_segment = None    # called once when first segment is stored
+        self.downloads = 0
+        self.stream_id = metadata.get('id') if metadata and isinstance(metadata, dict) else metadata
+        metrics.REGISTRY.add_collector(self.collect_metrics)
+
+    def reload(self):
+        """Continue from lists as stored by other instance (feed taken over)"""
+        self.list.reload()
+        self.sequence = self.list.last_segment.sequence+1 if self.list.last_segment else 0
 
     @property
     def stop(self):
         return self.scheduler.stop
     @stop.setter
     def stop(self, value):
+        # also wakes producers waiting in ready()
         self.scheduler.stop = value
+        self.list.stop = value
+
+    async def fetch(self, url, path, byterange=None):
+        if self.budget:
+            async with self.budget:
+                return await self._fetch(url, path, byterange)
+        return await self._fetch(url, path, byterange)
+
+    async def _fetch(self, url, path, byterange=None):
+        self.downloads += 1
+        if self.downloads % self.report_interval == 0:
+            self.report()
+        digest = self.content_store.algorithm if self.content_store else None
+        if not self.hedger:
+            return await download_to_file(url, path, throttle=self.throttle, digest=digest, byterange=byterange,
+                                          verify=self.verify_existing, content_store=self.content_store)
+        return await self.hedger(url, path, throttle=self.throttle, digest=digest, byterange=byterange,
+                                 verify=self.verify_existing, content_store=self.content_store)
+
+    def collect_metrics(self):
+        feed = self.stream_id
+        stats = self.scheduler.stats
+        download_queue_depth.labels(feed=feed).set(stats['queued'])
+        downloads_running.labels(feed=feed).set(stats['running'])
+        downloads_started.labels(feed=feed).set(stats['started'])
+        download_wait_seconds.labels(feed=feed).set(self.scheduler.total_wait_time)
+        downloads_expired.labels(feed=feed).set(stats['expired'])
+        reorder_pending.labels(feed=feed).set(len(self.list.pending))
+        reorder_cancelled.labels(feed=feed, reason='timeout').set(self.list.timed_out)
+        reorder_cancelled.labels(feed=feed, reason='overflow').set(self.list.overflowed)
+        if self.hedger:
+            hedge_requests.labels(feed=feed).set(self.hedger.hedges)
+            hedge_wins.labels(feed=feed).set(self.hedger.wins)
+        for bucket in self.throttle:
+            throttled_seconds.labels(feed=feed, limit=bucket.name).set(bucket.throttled_time)
+        if self.content_store:
+            dedup_segments.labels(feed=feed, result='stored').set(self.content_store.stored)
+            dedup_segments.labels(feed=feed, result='duplicate').set(self.content_store.duplicates)
+            dedup_bytes_saved.labels(feed=feed).set(self.content_store.bytes_saved)
+
+    def report(self):
+        stream_id = self.metadata.get('id') if self.metadata and isinstance(self.metadata, dict) else self.metadata
+        if self.hedger:
+            logger.info('Stream %s: hedged %i of %i downloads (%.1f%%), hedge won %i time(s), hedge delay %s s'
+                        % (stream_id, self.hedger.hedges, self.hedger.requests, self.hedger.hedge_rate*100,
+                           self.hedger.wins, self.hedger.delay))
+        if self.content_store:
+            logger.info('Stream %s: %i duplicate segment(s) linked to stored content, %i bytes saved'
+                        % (stream_id, self.content_store.duplicates, self.content_store.bytes_saved))
+        for bucket in self.throttle:
+            logger.info('Stream %s: %s bandwidth limit %i B/s throttled downloads %i time(s) for %.1f s in total'
+                        % (stream_id, bucket.name, bucket.rate, bucket.throttled, bucket.throttled_time))
+
+    def measure(self, path, duration):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        feed = self.stream_id
+        segment_download_seconds.labels(feed=feed).observe(duration)
+        if duration > 0:
+            segment_download_throughput.labels(feed=feed).observe(size / duration)
+        segment_bytes_written.labels(feed=feed).inc(size)
+        segments_stored.labels(feed=feed, result='done').inc()
+
+    async def extract_audio(self, item, path):
+        loop = self.loop or asyncio.get_event_loop()
+        target = path if self.audio_replace else mpegts.audio_path(path, self.audio_format)
+        start = time.time()
+        try:
+            with tracing.span('extract_audio', seq=item.sequence):
+                size, written = await loop.run_in_executor(self.extractor, mpegts.extract_audio_file, path, target,
+                                                           self.audio_format, self.audio_language)
+        except Exception as e:
+            # segment is kept as downloaded
+            logger.warning('Stream %s: audio extraction failed for %s: %s' % (self.stream_id, path, e))
+            return
+        feed = self.stream_id
+        audio_extraction_seconds.labels(feed=feed).observe(time.time() - start)
+        audio_extraction_bytes.labels(feed=feed, direction='in').inc(size)
+        audio_extraction_bytes.labels(feed=feed, direction='out').inc(written)
 
     async def download(self, item):
+        stored = await self.download_segment(item)
+        if stored:
+            self.list.done(item)
+        elif stored is False:
+            self.list.cancel(item)
+            # self.list.replace(item, HLSPullDiscontinuity)
+            # self.list.replace(item, HLSPullError)
+
+    def first_segment(self):
+        if self.on_first_segment:
+            callback, self.on_first_segment = self.on_first_segment, None
+            callback()
+
+    async def download_segment(self, item):
+        """Download segment with retries (and post-process it); returns True if stored, False if failed,
+        None if stopped"""
 
         # if not item.datetime:
         #     raise ValueError('item datetime not set')
@@ -572,11 +881,37 @@ class YAMLSegmentsStorage:
             try:
                 if self.scheduler.stop:
                     return
-                response = await download_to_file(item.url, path)
-                if response.status == 200:
-                    self.list.done(item)
+                start = time.time()
+                if i == 0 and hasattr(item, 'queued'):
+                    tracing.record('queue_wait', item.queued, start, item.sequence)
+                with tracing.span('download', seq=item.sequence, attempt=i):
+                    response = await self.fetch(item.url, path, item.byterange)
+                if response.status in (200, 206) and response.skipped:
+                    # already stored (e.g. before restart)
+                    segments_stored.labels(feed=stream_id, result='skipped').inc()
+                    download_bytes_avoided.labels(feed=stream_id, reason='skip').inc(response.skipped)
+                    print(' ', item.source_sequence, '==>', path, '(exists)')
+                    self.first_segment()
+                    return True
+                if response.status in (200, 206):
+                    if response.resumed:
+                        download_bytes_avoided.labels(feed=stream_id, reason='resume').inc(response.resumed)
+                    if response.linked:
+                        download_bytes_avoided.labels(feed=stream_id, reason='dedup').inc(response.linked)
+                    else:
+                        self.measure(path, time.time() - start)
+                    if self.content_store and response.digest:
+                        self.content_store.store(path, response.digest, etag_md5(response.headers))
+                    if self.extractor:
+                        await self.extract_audio(item, path)
                     print(' ', item.source_sequence, '==>', path)
-                    return
+                    self.first_segment()
+                    return True
+            except asyncio.CancelledError:
+                # deadline reached, scheduler cancels the item
+                segments_stored.labels(feed=stream_id, result='expired').inc()
+                print('Stream %s: download deadline reached' % stream_id, '  =X=>', path)
+                raise
             except (ClientOSError, ClientResponseError, ServerDisconnectedError, concurrent.futures.TimeoutError) as e:
                 # if self.stop:
                 #     return
@@ -588,9 +923,9 @@ class YAMLSegmentsStorage:
                     error_sleep *= 2    # 10s, 20s, 40s, 1m20s
             except Exception as e:
                 print('Stream %s: UNEXPECTED ERROR:' % stream_id, e)
-                self.list.cancel(item)
+                segments_stored.labels(feed=stream_id, result='failed').inc()
                 print('  =X=>', path)
-                return
+                return False
             # except KeyboardInterrupt:
             #     print('downloader keyboard interrupt')
             #     raise
@@ -601,9 +936,8 @@ class YAMLSegmentsStorage:
             print('ERROR (', str(exception), ')  =X=>', path)
         else:
             print('UNKNOWN ERROR  =X=>', path)
-        self.list.cancel(item)
-        # self.list.replace(item, HLSPullDiscontinuity)
-        # self.list.replace(item, HLSPullError)
+        segments_stored.labels(feed=stream_id, result='failed').inc()
+        return False
 
     async def wait(self):
         if self.downloaders:
@@ -612,7 +946,13 @@ class YAMLSegmentsStorage:
             # self.downloaders.clear()                          # must be already self-cleaned
         self.filelist.close()                                   # closed only when all downloads are finished
 
-    def store(self, item):
+    async def ready(self):
+        """Wait until downloads queue and reorder buffer accept more items"""
+        await self.scheduler.ready()
+        await self.list.ready()
+
+    def store(self, item, priority=0, deadline=None):
+        """Store item; segments are downloaded by priority (lower first), download is cancelled at deadline"""
         self.list.promise(item)
         # check type
         if isinstance(item, HLSSegment) or issubclass(item, HLSSegment):
@@ -620,7 +960,8 @@ class YAMLSegmentsStorage:
             self.sequence += 1
             if not item.datetime:
                 raise ValueError('item datetime not set')
-            self.scheduler(self.download(item))
+            item.queued = time.time()
+            self.scheduler(self.download(item), priority, deadline, on_expire=lambda: self.list.cancel(item))
 
 
 